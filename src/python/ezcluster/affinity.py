@@ -0,0 +1,264 @@
+import glob
+import errno
+import ctypes
+import ctypes.util
+import resource
+import multiprocessing
+
+from ezcluster.core import *
+
+logger = logging.getLogger('daemon')
+
+#thread pools of the numerical libraries, sized to the cores a job was given
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS']
+
+
+def parse_cpulist(cpulist):
+    """ The cpus of a kernel cpu list such as '0-3,8-11'. """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if len(part) == 0:
+            continue
+        (first, sep, last) = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def read_file(path):
+    f = open(path, 'r')
+    data = f.read()
+    f.close()
+    return data
+
+
+def numa_nodes():
+    """ The online cpus of each NUMA node, as a list of sorted lists, a single node if the machine has no NUMA. """
+    nodes = []
+    node_dirs = glob.glob('/sys/devices/system/node/node[0-9]*')
+    for node_dir in sorted(node_dirs, key=lambda d: int(os.path.basename(d)[len('node'):])):
+        try:
+            cpus = parse_cpulist(read_file(os.path.join(node_dir, 'cpulist')))
+        except (IOError, ValueError):
+            continue
+        if len(cpus) > 0:
+            nodes.append(sorted(cpus))
+    if len(nodes) == 0:
+        try:
+            nodes = [sorted(parse_cpulist(read_file('/sys/devices/system/cpu/online')))]
+        except (IOError, ValueError):
+            nodes = [range(multiprocessing.cpu_count())]
+    return nodes
+
+
+def memory_total():
+    """ Bytes of physical memory, from /proc/meminfo. """
+    for line in read_file('/proc/meminfo').splitlines():
+        if line.startswith('MemTotal:'):
+            return int(line.split()[1]) * 1024
+    raise ConfigException('Cannot read MemTotal from /proc/meminfo')
+
+
+def thread_env(num_threads):
+    """ Environment variables that size the BLAS and OpenMP thread pools of a job. """
+    return dict([(name, str(num_threads)) for name in THREAD_ENV_VARS])
+
+
+class CpuAllocator():
+    """ Hands out a dedicated set of cpus to every running job.
+
+        The daemon already keeps the cores of running jobs within num_cores, so an
+        allocation always succeeds. A job's cpus come from a single NUMA node if one
+        has enough free cpus, the fullest node that fits (best fit, to keep whole
+        nodes free for larger jobs), so its memory stays local. Larger jobs take the
+        emptiest nodes first. With num_cores below the number of cpus, only the first
+        num_cores cpus, spread evenly over the nodes, are used. With more cores than
+        cpus, pinning is turned off (enabled is False).
+    """
+
+    def __init__(self, num_cores):
+        nodes = numa_nodes()
+        num_cpus = sum([len(cpus) for cpus in nodes])
+        self.enabled = num_cores <= num_cpus
+        #take cpus round robin over the nodes, so a partial machine is balanced
+        self.free = [[] for cpus in nodes]
+        k = 0
+        while k < num_cores and self.enabled:
+            for n,cpus in enumerate(nodes):
+                if len(cpus) > len(self.free[n]) and k < num_cores:
+                    self.free[n].append(cpus[len(self.free[n])])
+                    k += 1
+        self.allocated = {}
+
+    def allocate(self, key, num_cpus):
+        """ Take num_cpus cpus for key, returns the sorted list of cpus, or None if pinning is off. """
+        if not self.enabled:
+            return None
+        fits = [n for n in range(len(self.free)) if len(self.free[n]) >= num_cpus]
+        if len(fits) > 0:
+            order = [min(fits, key=lambda n: (len(self.free[n]), n))]
+        else:
+            order = sorted(range(len(self.free)), key=lambda n: (-len(self.free[n]), n))
+        cpus = []
+        for n in order:
+            self.free[n].sort()
+            take = self.free[n][:num_cpus - len(cpus)]
+            self.free[n] = self.free[n][len(take):]
+            cpus.extend([(n, c) for c in take])
+            if len(cpus) == num_cpus:
+                break
+        self.allocated[key] = cpus
+        return sorted([c for (n, c) in cpus])
+
+    def release(self, key):
+        for (n, c) in self.allocated.pop(key, []):
+            self.free[n].append(c)
+
+
+class MemoryCgroups():
+    """ A memory cgroup per job under root, so a job that goes over its limit is the one the kernel OOM-kills.
+
+        Works with both the unified (v2) hierarchy, root under /sys/fs/cgroup, and the
+        v1 memory hierarchy, root under /sys/fs/cgroup/memory. available is False when
+        root can't be created or written to, usually because the daemon doesn't run
+        as root and no cgroup was delegated to it.
+    """
+
+    def __init__(self, name='ezcluster'):
+        self.unified = os.path.exists('/sys/fs/cgroup/cgroup.controllers')
+        if self.unified:
+            self.root = os.path.join('/sys/fs/cgroup', name)
+            self.limit_file = 'memory.max'
+        else:
+            self.root = os.path.join('/sys/fs/cgroup/memory', name)
+            self.limit_file = 'memory.limit_in_bytes'
+        self.available = False
+        try:
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            if self.unified:
+                f = open(os.path.join(os.path.dirname(self.root), 'cgroup.subtree_control'), 'w')
+                f.write('+memory')
+                f.close()
+                f = open(os.path.join(self.root, 'cgroup.subtree_control'), 'w')
+                f.write('+memory')
+                f.close()
+            self.available = os.access(self.root, os.W_OK)
+        except (IOError, OSError), e:
+            logger.info('Memory cgroups are not available under %s: %s' % (self.root, str(e)))
+
+    def path(self, key):
+        return os.path.join(self.root, 'job-%s' % key)
+
+    def create(self, key, limit):
+        """ Make the cgroup of a job with a memory limit in bytes, returns its cgroup.procs file or None. """
+        cgroup_dir = self.path(key)
+        try:
+            if not os.path.isdir(cgroup_dir):
+                os.mkdir(cgroup_dir)
+            f = open(os.path.join(cgroup_dir, self.limit_file), 'w')
+            f.write(str(int(limit)))
+            f.close()
+        except (IOError, OSError), e:
+            logger.warning('Could not make the memory cgroup of job %s: %s' % (key, str(e)))
+            self.remove(key)
+            return None
+        return os.path.join(cgroup_dir, 'cgroup.procs')
+
+    def remove(self, key):
+        """ Called once the job's processes are gone, a cgroup with processes left in it is kept. """
+        try:
+            os.rmdir(self.path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                logger.warning('Could not remove the memory cgroup of job %s: %s' % (key, str(e)))
+
+
+class JobIsolation():
+    """ Pins jobs to their cpus, limits their memory and sizes their thread pools.
+
+        For each job, prepare returns the environment and the preexec_fn of its
+        Popen. The environment sets the thread counts of OpenMP, MKL, OpenBLAS,
+        numexpr and vecLib to the job's cores. If pin_cpus is True the process is
+        bound to the cpus of a CpuAllocator with sched_setaffinity, which its
+        children inherit. If memory_per_core is given, a job may use that many
+        bytes per core it runs on, enforced by a memory cgroup when one can be made
+        and by an RLIMIT_AS address space limit otherwise. The rlimit is per
+        process and counts virtual memory, so it is a looser guard than the cgroup.
+
+        Everything that allocates is done before the fork, the preexec_fn only
+        makes system calls, since the daemon has other threads running.
+    """
+
+    def __init__(self, num_cores, pin_cpus=True, memory_per_core=None):
+        self.cpus = None
+        if pin_cpus:
+            self.cpus = CpuAllocator(num_cores)
+            if not self.cpus.enabled:
+                logger.warning('More cores (%d) than cpus, jobs are not pinned' % num_cores)
+                self.cpus = None
+        self.libc = None
+        if self.cpus is not None:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.memory_per_core = memory_per_core
+        self.cgroups = None
+        if memory_per_core is not None:
+            self.cgroups = MemoryCgroups()
+            if not self.cgroups.available:
+                self.cgroups = None
+
+    def cpu_mask(self, cpus):
+        nbits = 8 * ctypes.sizeof(ctypes.c_ulong)
+        mask = (ctypes.c_ulong * (max(cpus) / nbits + 1))()
+        for c in cpus:
+            mask[c / nbits] |= 1 << (c % nbits)
+        return mask
+
+    def prepare(self, key, num_cpus):
+        """ Returns a tuple (env, preexec_fn, cpus) for the job key, which runs on num_cpus cores. """
+        env = dict(os.environ)
+        env.update(thread_env(num_cpus))
+        cpus = None
+        mask = None
+        if self.cpus is not None:
+            cpus = self.cpus.allocate(key, num_cpus)
+            mask = self.cpu_mask(cpus)
+            mask_size = ctypes.sizeof(mask)
+            mask_ref = ctypes.byref(mask)
+        procs_file = None
+        limit = None
+        if self.memory_per_core is not None:
+            limit = int(self.memory_per_core * num_cpus)
+            if self.cgroups is not None:
+                procs_file = self.cgroups.create(key, limit)
+        libc = self.libc
+
+        def preexec_fn():
+            if mask is not None:
+                libc.sched_setaffinity(0, mask_size, mask_ref)
+            if procs_file is not None:
+                #'0' moves the writing process itself
+                fd = os.open(procs_file, os.O_WRONLY)
+                os.write(fd, '0')
+                os.close(fd)
+            elif limit is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        return (env, preexec_fn, cpus)
+
+    def release(self, key):
+        """ Give back the cpus and cgroup of a job once it has exited. """
+        if self.cpus is not None:
+            self.cpus.release(key)
+        if self.cgroups is not None:
+            self.cgroups.remove(key)
+
+
+def memory_per_core(value, num_cores):
+    """ Parse the MEMORY_PER_CORE setting: None or '' for no limit, 'auto' for an even share of the
+        machine's memory, or a number of bytes.
+    """
+    if value in [None, '', 'None']:
+        return None
+    if value == 'auto':
+        return memory_total() / max(num_cores, 1)
+    return int(float(value))
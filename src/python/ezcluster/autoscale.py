@@ -0,0 +1,171 @@
+import math
+import threading
+
+from ezcluster.core import *
+from ezcluster.pool import POOL_TAG
+
+
+class Autoscaler():
+    """ Grows and shrinks the set of worker instances of a Launcher with the amount of queued work.
+
+        Every check_interval seconds, the autoscaler reads the approximate depth of
+        the job queues and the status messages of the running batch, estimates the
+        remaining work from the jobs' expected_runtime, and sizes the cluster so
+        that work would be done in about target_time seconds, between
+        min_instances and max_instances. Jobs held for their dependencies are
+        released along the way, see Launcher.release_jobs. New instances are brought up in the
+        background through Launcher.add_instances. Instances that have not run a
+        job for idle_time seconds while the queue is empty are terminated right
+        away instead of waiting for quit_when_empty. Instances whose daemon quit,
+        which then stopped, terminated or parked them in the warm pool, no longer
+        count towards the cluster size.
+    """
+
+    def __init__(self, launcher, max_instances, min_instances=0, target_time=3600.0,
+                 idle_time=120.0, check_interval=60.0):
+        self.launcher = launcher
+        self.max_instances = max_instances
+        self.min_instances = min_instances
+        self.target_time = target_time
+        self.idle_time = idle_time
+        self.check_interval = check_interval
+        self.monitor = launcher.get_monitor()
+        self.num_pending = 0
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def queue_depth(self):
+        """ Returns a tuple (# visible messages, # messages in flight) summed over the job queues. """
+        num_visible = 0
+        num_in_flight = 0
+        for queue in self.launcher.job_queues.values():
+            attrs = queue.get_attributes()
+            num_visible += int(attrs.get('ApproximateNumberOfMessages', 0))
+            num_in_flight += int(attrs.get('ApproximateNumberOfMessagesNotVisible', 0))
+        return (num_visible, num_in_flight)
+
+    def remaining_jobs(self, num_visible, num_in_flight):
+        """ Jobs left to finish: from the status messages when a batch was posted, else from the queue depth. """
+        if self.launcher.batch_id is not None:
+            stats = self.monitor.batch_stats(self.launcher.batch_id)
+            return max(self.launcher.num_batch_jobs - stats['num_finished'], 0)
+        return num_visible + num_in_flight
+
+    def mean_runtime(self):
+        """ Mean expected_runtime of the launcher's jobs, or None if no job has one. """
+        runtimes = [float(j.expected_runtime) for j in self.launcher.jobs if float(j.expected_runtime) > 0]
+        if len(runtimes) == 0:
+            return None
+        return sum(runtimes) / len(runtimes)
+
+    def desired_instances(self, num_remaining, runtime):
+        slots = max(self.launcher.num_jobs_per_instance, 1)
+        if runtime is None:
+            #without runtimes, give every remaining job a slot
+            num = int(math.ceil(num_remaining / float(slots)))
+        else:
+            num = int(math.ceil(num_remaining * runtime / (self.target_time * slots)))
+        return min(max(num, self.min_instances), self.max_instances)
+
+    def add_instances(self, num_instances):
+        try:
+            self.launcher.add_instances(num_instances)
+        except Exception, e:
+            print 'Autoscaler could not add instances: %s' % str(e)
+        with self.lock:
+            self.num_pending -= num_instances
+
+    def idle_instances(self):
+        """ Instances that are running no job and have reported nothing for idle_time seconds. """
+        now = time.time()
+        idle = []
+        with self.launcher.instances_lock:
+            instances = list(self.launcher.instances)
+        for inst in instances:
+            info = self.monitor.instances.get(inst.id)
+            if info is None:
+                last_update = getattr(inst, 'ready_time', self.start_time)
+                running = 0
+            else:
+                last_update = info['last_update']
+                running = len(info['running'])
+            if running == 0 and (now - last_update) > self.idle_time:
+                idle.append(inst)
+        return idle
+
+    def retire_instances(self, instances):
+        """ Terminate instances and take them out of the launcher's, in place, since
+            add_instances threads may be adding to it.
+        """
+        ids = [inst.id for inst in instances]
+        self.launcher.terminate_instances(ids)
+        with self.launcher.instances_lock:
+            self.launcher.instances[:] = [inst for inst in self.launcher.instances if inst.id not in ids]
+
+    def prune_instances(self):
+        """ Take the instances that can't run jobs anymore out of the launcher's: the ones
+            that are no longer pending or running, and the ones parked in the warm pool.
+        """
+        with self.launcher.instances_lock:
+            instances = list(self.launcher.instances)
+        gone = []
+        for inst in instances:
+            try:
+                state = inst.update()
+            except Exception, e:
+                print 'Autoscaler could not check instance %s: %s' % (inst.id, str(e))
+                continue
+            if state not in ['pending', 'running'] or (getattr(inst, 'tags', None) or {}).get(POOL_TAG) == 'parked':
+                gone.append(inst.id)
+        if len(gone) > 0:
+            print 'Autoscaler: instances %s are gone' % ','.join(gone)
+            with self.launcher.instances_lock:
+                self.launcher.instances[:] = [inst for inst in self.launcher.instances if inst.id not in gone]
+
+    def step(self):
+        """ Make one scaling decision, returns the number of jobs left to finish. """
+        self.monitor.poll(wait_time=0)
+        self.launcher.release_jobs(self.monitor)
+        (num_visible, num_in_flight) = self.queue_depth()
+        num_remaining = self.remaining_jobs(num_visible, num_in_flight)
+        runtime = self.mean_runtime()
+        desired = self.desired_instances(num_remaining, runtime)
+        self.prune_instances()
+        with self.lock:
+            num_pending = self.num_pending
+        num_current = len(self.launcher.instances) + num_pending
+
+        runtime_str = 'unknown'
+        if runtime is not None:
+            runtime_str = '%0.1fs' % runtime
+        metrics_str = 'queue visible=%d in_flight=%d, remaining jobs=%d, mean runtime=%s, instances=%d (+%d starting), desired=%d' % \
+                      (num_visible, num_in_flight, num_remaining, runtime_str, len(self.launcher.instances), num_pending, desired)
+
+        if desired > num_current:
+            num_add = desired - num_current
+            print 'Autoscaler: adding %d instances [%s]' % (num_add, metrics_str)
+            with self.lock:
+                self.num_pending += num_add
+            t = threading.Thread(target=self.add_instances, args=(num_add,))
+            t.daemon = True
+            t.start()
+        elif num_visible + num_in_flight == 0 and self.launcher.graph.num_held() == 0:
+            idle = self.idle_instances()
+            num_keep = max(self.min_instances, desired)
+            num_retire = min(len(idle), len(self.launcher.instances) - num_keep)
+            if num_retire > 0:
+                print 'Autoscaler: retiring %d idle instances %s [%s]' % \
+                      (num_retire, ','.join([inst.id for inst in idle[:num_retire]]), metrics_str)
+                self.retire_instances(idle[:num_retire])
+        return num_remaining
+
+    def run(self, timeout_after=None):
+        """ Scale until the launcher's batch is done, or forever if no batch was posted. """
+        while True:
+            num_remaining = self.step()
+            if self.launcher.batch_id is not None and num_remaining == 0:
+                break
+            if timeout_after is not None and (time.time() - self.start_time) > timeout_after:
+                break
+            time.sleep(self.check_interval)
+        print 'Autoscaler: done, %d jobs left' % num_remaining
@@ -0,0 +1,118 @@
+from boto.s3.multipart import MultiPartUpload
+
+from ezcluster.core import *
+
+
+def get_backend():
+    """ The backend named by the 'type' option of the [backend] config section, 'aws' (the default) or 'local'.
+
+        The EZCLUSTER_BACKEND environment variable overrides the config file.
+    """
+    btype = 'aws'
+    if config.has_option('backend', 'type'):
+        btype = config.get('backend', 'type')
+    btype = os.environ.get('EZCLUSTER_BACKEND', btype)
+    if btype == 'aws':
+        return AWSBackend()
+    if btype == 'local':
+        from ezcluster.local import LocalBackend
+        return LocalBackend()
+    raise ConfigException('Unknown backend type: %s' % btype)
+
+
+class AWSBackend():
+    """ Job and status queues on SQS, blobs on S3 and instances on EC2.
+
+        A backend hands out the job queue, status queue, blob store and
+        instances used by the Launcher and the Daemon. Queues follow the boto SQS
+        Queue interface (new_message, write, write_batch, get_messages,
+        delete_message, delete_message_batch, get_attributes) and their
+        messages the boto Message interface (get_body, get_body_encoded,
+        change_visibility). Every call to connect_queue or connect_blob_store
+        makes a new connection, so each thread should make its own.
+    """
+
+    is_local = False
+
+    def connect_queue(self, qname):
+        queue = boto.connect_sqs().get_queue(qname)
+        if queue is None:
+            raise ConfigException('Cannot connect to SQS queue: %s' % qname)
+        return queue
+
+    def connect_blob_store(self):
+        return S3BlobStore(config.get('s3', 'bucket'))
+
+    def get_instance(self, instance_id):
+        """ The instance a daemon runs on, it is terminated when the daemon is done. """
+        conn = boto.ec2.connect_to_region(config.get('ec2', 'region'))
+        res = conn.get_all_instances([instance_id])
+        if len(res) == 0:
+            raise ConfigException('No instance found for id %s' % instance_id)
+        return res[0].instances[0]
+
+
+class S3BlobStore():
+    """ Stores blobs as keys in an S3 bucket, under the path given after the bucket name ('bucket/path/to').
+
+        get_file and exists also take full s3://bucket/key URLs, to read from other buckets.
+    """
+
+    def __init__(self, bucket_path):
+        bsp = bucket_path.split('/')
+        self.bucket_name = bsp[0]
+        self.prefix = '/'.join(bsp[1:])
+        self.bucket = boto.connect_s3().get_bucket(self.bucket_name)
+
+    def key_name(self, name):
+        return os.path.join(self.prefix, name)
+
+    def url(self, name):
+        return 's3://%s/%s' % (self.bucket_name, self.key_name(name))
+
+    def put(self, name, data):
+        self.bucket.new_key(self.key_name(name)).set_contents_from_string(data)
+
+    def put_file(self, name, file_name):
+        self.bucket.new_key(self.key_name(name)).set_contents_from_filename(file_name)
+
+    def multipart(self, name, upload_id):
+        #rebuild the upload on this connection, parts can be sent over different connections
+        mp = MultiPartUpload(self.bucket)
+        mp.key_name = self.key_name(name)
+        mp.id = upload_id
+        return mp
+
+    def start_multipart(self, name):
+        """ Start a multipart upload, returns its id. """
+        return self.bucket.initiate_multipart_upload(self.key_name(name)).id
+
+    def put_part(self, name, upload_id, part_num, fp, size):
+        """ Send size bytes from file object fp as part part_num (starting at 1) of a multipart upload. """
+        self.multipart(name, upload_id).upload_part_from_file(fp, part_num, size=size)
+
+    def complete_multipart(self, name, upload_id):
+        self.multipart(name, upload_id).complete_upload()
+
+    def cancel_multipart(self, name, upload_id):
+        self.multipart(name, upload_id).cancel_upload()
+
+    def get_key(self, name):
+        if name.startswith('s3://'):
+            (bucket_name, sep, key_name) = name[len('s3://'):].partition('/')
+            return self.bucket.connection.get_bucket(bucket_name).get_key(key_name)
+        return self.bucket.get_key(self.key_name(name))
+
+    def get_file(self, name, file_name):
+        key = self.get_key(name)
+        if key is None:
+            raise KeyError(name)
+        key.get_contents_to_filename(file_name)
+
+    def exists(self, name):
+        return self.get_key(name) is not None
+
+    def list(self, prefix):
+        """ Names of all the blobs under prefix. """
+        start = len(self.key_name(''))
+        return [key.name[start:] for key in self.bucket.list(prefix=self.key_name(prefix))]
@@ -0,0 +1,189 @@
+import shutil
+import argparse
+import itertools
+
+from ezcluster.core import *
+from ezcluster.monitor import BatchMonitor
+from ezcluster.launcher import Launcher
+
+
+class BenchMonitor(BatchMonitor):
+    """ A BatchMonitor that also keeps every status message, to time job starts and ends. """
+
+    def __init__(self, backend=None):
+        BatchMonitor.__init__(self, backend=backend)
+        self.events = []
+
+    def add_status(self, status_msg):
+        if status_msg.get('type') == 'job_status':
+            self.events.append((status_msg['instance'], status_msg['job']['id'],
+                                status_msg['status'], status_msg['last_update']))
+        BatchMonitor.add_status(self, status_msg)
+
+
+def mean(vals):
+    if len(vals) == 0:
+        return None
+    return sum(vals) / float(len(vals))
+
+
+def percentile(vals, p):
+    if len(vals) == 0:
+        return None
+    vals = sorted(vals)
+    return vals[min(int(p * len(vals)), len(vals)-1)]
+
+
+def dispatch_gaps(events):
+    """ Seconds each slot sat idle between a job finishing and the next job starting on the same instance. """
+    by_instance = {}
+    for (instance, job_id, status, t) in events:
+        by_instance.setdefault(instance, {'starts':[], 'ends':[]})
+        if status == 'finished':
+            by_instance[instance]['ends'].append(t)
+        else:
+            by_instance[instance]['starts'].append(t)
+    gaps = []
+    for times in by_instance.values():
+        starts = sorted(times['starts'])
+        for end_time in sorted(times['ends']):
+            later = [t for t in starts if t >= end_time]
+            if len(later) > 0:
+                gaps.append(later[0] - end_time)
+                starts.remove(later[0])
+    return gaps
+
+
+def run_benchmark(num_jobs, duration, num_jobs_per_instance, num_workers, latency=0.0,
+                  startup_delay=0.0, timeout_after=600.0):
+    """ Run num_jobs jobs of duration seconds through the real Launcher and Daemon code on
+        the local backend, with latency seconds added to every queue and blob store request
+        and startup_delay seconds to every worker start, and return a dictionary of results.
+
+        Workers are daemon processes started by Launcher.start_local_workers, not EC2
+        instances brought up by bring_up_instances, so the time to first job only covers
+        daemon startup, startup_delay and queue polling. Instance bring-up (SSH, init)
+        is not measured here.
+    """
+    root = tempfile.mkdtemp(prefix='ezcluster-bench-')
+    os.environ['EZCLUSTER_BACKEND'] = 'local'
+    os.environ['EZCLUSTER_LOCAL_ROOT'] = root
+    os.environ['EZCLUSTER_LOCAL_LATENCY'] = str(latency)
+    os.environ['EZCLUSTER_LOCAL_STARTUP_DELAY'] = str(startup_delay)
+
+    l = Launcher(None, None, num_instances=num_workers, num_jobs_per_instance=num_jobs_per_instance,
+                 num_cores_per_instance=num_jobs_per_instance, quit_when_done=True, upload_code=False)
+    for k in range(num_jobs):
+        l.add_batch_job(['sleep', '%f' % duration], expected_runtime=duration,
+                        log_file_template='bench_%d.log' % k)
+
+    monitor = BenchMonitor(backend=l.backend)
+    try:
+        start_time = time.time()
+        num_failed = l.post_jobs()
+        post_time = time.time()
+        l.start_instances()
+        started_time = time.time()
+        stats = monitor.wait_for_batch(l.batch_id, num_jobs, timeout_after=timeout_after, report_interval=1e9)
+        done_time = time.time()
+    finally:
+        l.terminate_instances([inst.id for inst in l.instances])
+        for inst in l.instances:
+            inst.proc.wait()
+        shutil.rmtree(root, ignore_errors=True)
+
+    first_starts = {}
+    for (instance, job_id, status, t) in monitor.events:
+        if status == 'running' and (instance not in first_starts or t < first_starts[instance]):
+            first_starts[instance] = t
+    bring_up = [t - started_time for t in first_starts.values()]
+    gaps = dispatch_gaps(monitor.events)
+    makespan = done_time - post_time
+    num_slots = num_workers * num_jobs_per_instance
+
+    return {'num_jobs':num_jobs,
+            'duration':duration,
+            'num_jobs_per_instance':num_jobs_per_instance,
+            'num_workers':num_workers,
+            'latency':latency,
+            'startup_delay':startup_delay,
+            'completed':stats is not None,
+            'num_post_failed':num_failed,
+            'submit_time':post_time - start_time,
+            'submit_rate':num_jobs / max(post_time - start_time, 1e-6),
+            'makespan':makespan,
+            'throughput':num_jobs / max(makespan, 1e-6),
+            'overhead_per_job':(makespan * num_slots - num_jobs * duration) / num_jobs,
+            'mean_time_to_first_job':mean(bring_up),
+            'max_time_to_first_job':max(bring_up or [None]),
+            'mean_dispatch_gap':mean(gaps),
+            'p95_dispatch_gap':percentile(gaps, 0.95)}
+
+
+def run_autoscale_check(check_interval=90.0, timeout_after=600.0):
+    """ Check that the autoscaler replaces a worker that quit while jobs were held for their dependencies.
+
+        With max_instances=1, a second stage that depends on a first is released only
+        after the first stage's worker ran out of work and quit, as long as check_interval
+        is longer than the daemon's quit_when_empty timeout. Returns True if both stages
+        finished before timeout_after seconds.
+    """
+    root = tempfile.mkdtemp(prefix='ezcluster-check-')
+    os.environ['EZCLUSTER_BACKEND'] = 'local'
+    os.environ['EZCLUSTER_LOCAL_ROOT'] = root
+
+    l = Launcher(None, None, num_jobs_per_instance=1, num_cores_per_instance=1, quit_when_done=True, upload_code=False)
+    stage1 = l.add_batch_job(['sleep', '1'], log_file_template='stage1.log')
+    l.add_batch_job(['true'], depends_on=[stage1], log_file_template='stage2.log')
+    try:
+        l.autoscale(max_instances=1, check_interval=check_interval, timeout_after=timeout_after)
+        stats = l.get_monitor().batch_stats(l.batch_id)
+    finally:
+        l.terminate_instances([inst.id for inst in l.instances])
+        for inst in l.instances:
+            inst.proc.wait()
+        shutil.rmtree(root, ignore_errors=True)
+    return stats['num_finished'] == 2
+
+
+def float_list(s):
+    return [float(v) for v in s.split(',')]
+
+def int_list(s):
+    return [int(v) for v in s.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ezcluster dispatch overhead on the local backend. '
+                                                 'Every combination of the comma separated values is run, and '
+                                                 'results are appended to the output file as JSON lines.')
+    parser.add_argument('--jobs', type=int_list, default=[100], help='number of jobs')
+    parser.add_argument('--durations', type=float_list, default=[0.0], help='seconds each job sleeps')
+    parser.add_argument('--jobs-per-instance', type=int_list, default=[1, 4], help='num_jobs_per_instance')
+    parser.add_argument('--workers', type=int_list, default=[1, 4], help='number of worker daemons')
+    parser.add_argument('--latency', type=float_list, default=[0.0], help='seconds added to each queue/blob request')
+    parser.add_argument('--startup-delay', type=float, default=0.0, help='seconds before each worker starts')
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds to wait for each run')
+    parser.add_argument('--output', default='bench_results.jsonl', help='file to append results to')
+    parser.add_argument('--autoscale-check', action='store_true',
+                        help='instead of benchmarking, check that the autoscaler replaces workers that quit')
+    args = parser.parse_args()
+
+    if args.autoscale_check:
+        ok = run_autoscale_check(timeout_after=args.timeout)
+        print 'Autoscale check %s' % ('passed' if ok else 'FAILED')
+        sys.exit(0 if ok else 1)
+
+    for (num_jobs, duration, slots, workers, latency) in itertools.product(args.jobs, args.durations,
+                                                                            args.jobs_per_instance,
+                                                                            args.workers, args.latency):
+        res = run_benchmark(num_jobs, duration, slots, workers, latency=latency,
+                            startup_delay=args.startup_delay, timeout_after=args.timeout)
+        res['timestamp'] = time.time()
+        print 'jobs=%d duration=%0.2fs slots=%d workers=%d latency=%0.3fs: %0.1f jobs/sec, makespan %0.2fs, ' \
+              'overhead %0.3fs/job, mean dispatch gap %s' % \
+              (num_jobs, duration, slots, workers, latency, res['throughput'], res['makespan'],
+               res['overhead_per_job'], res['mean_dispatch_gap'])
+        f = open(args.output, 'a')
+        f.write(json.dumps(res) + '\n')
+        f.close()
@@ -0,0 +1,164 @@
+import errno
+import threading
+from Queue import Queue
+
+from ezcluster.core import *
+
+logger = logging.getLogger('daemon')
+
+
+class CacheEntry():
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.size = 0
+        self.last_used = time.time()
+        self.num_refs = 0
+        self.ready = threading.Event()
+        self.error = None
+
+
+class InputCache():
+    """ A size-bounded LRU cache of job inputs from the blob store, on local disk.
+
+        All jobs on an instance share the cache. Inputs are downloaded by a small
+        pool of threads, each with its own blob store connection, so prefetch can
+        start the downloads for queued jobs while other jobs run. A job pins its
+        inputs from get until release, and only unpinned inputs are evicted, least
+        recently used first, once the cache holds more than max_bytes. Files left
+        in cache_dir by an earlier daemon are picked up again. A download that
+        fails is tried max_retries times, waiting retry_delay seconds after the
+        first failure and twice as long after each one after that.
+    """
+
+    def __init__(self, connect_blob_store, cache_dir, max_bytes, num_threads=2, max_retries=4, retry_delay=2.0):
+        self.connect_blob_store = connect_blob_store
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.downloads = Queue()
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.load()
+        self.threads = [threading.Thread(target=self.worker) for k in range(num_threads)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def file_name(self, name):
+        """ Cache file names are unique per input name and keep its base name, for readable job logs. """
+        return '%s-%s' % (hashlib.sha1(name).hexdigest()[:16], os.path.basename(name.rstrip('/')))
+
+    def load(self):
+        for fname in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fname)
+            if '.tmp-' in fname:
+                os.remove(path)
+                continue
+            e = CacheEntry(None, path)
+            e.size = os.path.getsize(path)
+            e.last_used = os.path.getmtime(path)
+            e.ready.set()
+            self.entries[fname] = e
+        if len(self.entries) > 0:
+            logger.info('Input cache has %d files, %d bytes' % (len(self.entries), self.num_bytes()))
+
+    def num_bytes(self):
+        return sum([e.size for e in self.entries.values()])
+
+    def prefetch(self, name):
+        """ Start downloading an input in the background, unless it is cached or on its way. """
+        fname = self.file_name(name)
+        with self.lock:
+            e = self.entries.get(fname)
+            if e is None:
+                e = CacheEntry(name, os.path.join(self.cache_dir, fname))
+                self.entries[fname] = e
+                self.downloads.put(e)
+            return e
+
+    def get(self, name, timeout=None):
+        """ Wait for an input to be in the cache and pin it, returns its local path.
+
+            Returns None if the input is not ready after timeout seconds, it keeps
+            downloading for the next call. Raises the download error if the input
+            could not be fetched.
+        """
+        while True:
+            e = self.prefetch(name)
+            if not e.ready.wait(timeout):
+                return None
+            with self.lock:
+                if e.error is not None:
+                    if self.entries.get(self.file_name(name)) is e:
+                        del self.entries[self.file_name(name)]
+                    raise e.error
+                #the input could have been evicted between the download and now
+                if self.entries.get(self.file_name(name)) is e:
+                    e.num_refs += 1
+                    e.last_used = time.time()
+                    return e.path
+
+    def release(self, name):
+        """ Unpin an input, it stays in the cache until it is evicted. """
+        with self.lock:
+            e = self.entries.get(self.file_name(name))
+            if e is not None:
+                e.num_refs = max(e.num_refs - 1, 0)
+                e.last_used = time.time()
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            total = self.num_bytes()
+            if total <= self.max_bytes:
+                return
+            unpinned = sorted([(e.last_used, fname) for fname,e in self.entries.iteritems()
+                               if e.num_refs == 0 and e.ready.is_set()])
+            for (last_used, fname) in unpinned:
+                if total <= self.max_bytes:
+                    break
+                e = self.entries.pop(fname)
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass
+                total -= e.size
+                logger.debug('Evicted %s (%d bytes) from the input cache' % (e.path, e.size))
+
+    def worker(self):
+        store = self.connect_blob_store()
+        while True:
+            e = self.downloads.get()
+            start_time = time.time()
+            for k in range(self.max_retries):
+                tmp_file = '%s.tmp-%s' % (e.path, random_string(6))
+                try:
+                    store.get_file(e.name, tmp_file)
+                    os.rename(tmp_file, e.path)
+                    e.size = os.path.getsize(e.path)
+                    e.error = None
+                    logger.debug('Cached input %s, %d bytes in %0.1fs' % (e.name, e.size, time.time() - start_time))
+                    break
+                except Exception, ex:
+                    e.error = ex
+                    if os.path.exists(tmp_file):
+                        os.remove(tmp_file)
+                    if k == self.max_retries - 1:
+                        logger.error('Could not download input %s after %d tries: %s' % (e.name, k + 1, str(ex)))
+                        break
+                    logger.warning('Error downloading input %s, retrying: %s' % (e.name, str(ex)))
+                    time.sleep(self.retry_delay * 2**k)
+                    try:
+                        store = self.connect_blob_store()
+                    except Exception:
+                        pass
+            e.ready.set()
+            self.evict()
@@ -3,6 +3,8 @@ import sys
 import time
 import string
 import random
+import uuid
+import hashlib
 import logging
 import tempfile
 import subprocess
@@ -13,52 +15,121 @@ import numpy as np
 import boto.ec2
 import simplejson as json
 
-from ezcluster.config import config, ConfigException, SH_DIR, ROOT_DIR
+from ezcluster.config import config, ConfigException, SH_DIR, SRC_DIR, ROOT_DIR
 
 def random_string(size=6, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for x in range(size))
 
+def code_hash():
+    """ SHA1 of the relative path and contents of every file in the ezcluster tree, skipping .git and .pyc files. """
+    sha = hashlib.sha1()
+    for (dirpath, dirnames, filenames) in os.walk(ROOT_DIR):
+        dirnames[:] = sorted([d for d in dirnames if d != '.git'])
+        for fname in sorted(filenames):
+            if fname.endswith('.pyc'):
+                continue
+            fpath = os.path.join(dirpath, fname)
+            sha.update(os.path.relpath(fpath, ROOT_DIR))
+            sha.update('\0')
+            f = open(fpath, 'rb')
+            while True:
+                data = f.read(1048576)
+                if not data:
+                    break
+                sha.update(data)
+            f.close()
+            sha.update('\0')
+    return sha.hexdigest()
+
 def create_self_tgz():
     base_dir = os.path.abspath(os.path.join(ROOT_DIR, '..'))
     (tfd, temp_name) = tempfile.mkstemp(suffix='.tgz', prefix='ezcluster-')
-    ret_code = subprocess.call(['tar', 'cvzf', temp_name,
+    os.close(tfd)
+    ret_code = subprocess.call(['tar', 'czf', temp_name,
                                 '-C', base_dir,
                                 '--exclude=.git',
+                                '--exclude=*.pyc',
                                 'ezcluster'])
     if ret_code != 0:
         print 'create_self_tgz failed for some reason, ret_code=%d' % ret_code
     return temp_name
 
+def bundle_key_name(chash):
+    """ S3 key of the code bundle with the given content hash, relative to the bucket. """
+    bsp = config.get('s3', 'bucket').split('/')
+    return '/'.join(bsp[1:] + ['bundles', 'ezcluster-%s.tgz' % chash])
+
 def send_self_tgz_to_s3():
-      
-    tgz_file = create_self_tgz()
-    
+    """ Upload the ezcluster tree to S3 as a bundle keyed by its content hash, and return the hash.
+
+        If a bundle with the same hash is already in the bucket, the tree is
+        neither tarred nor uploaded again.
+    """
+    chash = code_hash()
     bpath = config.get('s3', 'bucket')
-    bsp = bpath.split('/')
-    bucket_name = bsp[0]
-    dest_file = '%s/ezcluster.tgz' % '/'.join(bsp[1:])
+    bucket_name = bpath.split('/')[0]
+    dest_file = bundle_key_name(chash)
     s3 = boto.connect_s3()
     bucket = s3.get_bucket(bucket_name)
+    if bucket.get_key(dest_file) is not None:
+        print 'Code bundle %s is already in s3://%s/%s' % (chash, bucket_name, dest_file)
+        return chash
+
+    tgz_file = create_self_tgz()
     key = bucket.new_key(dest_file)
     key.set_contents_from_filename(tgz_file)
     os.remove(tgz_file)
+    print 'Uploaded code bundle %s to s3://%s/%s' % (chash, bucket_name, dest_file)
+    return chash
     
 
+def job_key(cmds, inputs={}, outputs=[], salt=''):
+    """ Content key of a job: SHA1 of the command, the declared inputs and outputs and a salt.
+
+        Identical jobs get the same key, which is what the completion index in the
+        blob store (done/<key>) is looked up by when jobs that already succeeded are
+        skipped. It is not the job's id, every job posted gets an id of its own, see
+        new_job_id, so identical jobs posted together all run.
+    """
+    return hashlib.sha1(json.dumps([cmds, sorted(inputs.items()), outputs, salt])).hexdigest()
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
 class Job():
-    def __init__(self, cmds, num_cpus, expected_runtime, log_file_template='job_%d.log'):
+    """ A single command to run on a worker.
+
+        inputs is a dictionary of NAME to a blob store key (or s3:// URL). The
+        daemon stages each input to a local file before the job starts and
+        replaces #NAME# in the command with its path.
+
+        outputs is a list of file paths or globs that the daemon uploads to
+        outputs/<batch_id>/<job_id>/ in the blob store after the job exits.
+        Every job runs in an empty working directory of its own, relative paths
+        are taken from there. The directory is removed once the outputs are
+        uploaded.
+    """
+    def __init__(self, cmds, num_cpus, expected_runtime, log_file_template='job_%d.log', inputs={}, outputs=[]):
         self.id = None
+        self.key = None
         self.cmds = cmds        
         self.num_cpus = num_cpus
         self.expected_runtime = expected_runtime
         self.log_file_template = log_file_template          
+        self.inputs = inputs
+        self.outputs = outputs
         
     def to_dict(self):        
         return {'type':'job',
                 'id':self.id,
+                'key':self.key,
                 'command':self.cmds,
                 'num_cpus':self.num_cpus,
                 'expected_runtime':self.expected_runtime,
-                'log_file_template':self.log_file_template}
+                'log_file_template':self.log_file_template,
+                'inputs':self.inputs,
+                'outputs':self.outputs}
     
 def job_from_dict(ji):
     id = ji['id']
@@ -72,13 +143,121 @@ def job_from_dict(ji):
     log_file = 'None'
     if 'local_log_file' in ji:
         log_file = ji['local_log_file']
-    j = Job(command, num_cpus, expected_runtime, log_file_template=log_file_template)
+    j = Job(command, num_cpus, expected_runtime, log_file_template=log_file_template, inputs=ji.get('inputs', {}),
+            outputs=ji.get('outputs', []))
     j.id = id
+    j.key = ji.get('key')
     j.batch_id = batch_id
     j.log_file = log_file
     return j
 
 
+class JobArray():
+    """ A parameter sweep: a single command template expanded into many jobs.
+
+        Element k of the array fills the #NAME# placeholders in cmds and
+        log_file_template with params[NAME][k], and #INDEX# with k. params is a
+        dictionary of equal length lists, and can be empty for a plain #INDEX#
+        range of num_elements elements. The values of inputs and the outputs
+        (see Job) are filled in the same way. The array is posted as chunks covering
+        index ranges [start, end), and each daemon claims the elements it can run
+        from a chunk and puts the rest back on the queue. Element k has the id
+        <array id>-k, and its job_key, with salt, as its content key. Without a
+        log_file_template, element k logs to job_<array id>-k.log like a plain job.
+    """
+    def __init__(self, cmds, params, num_cpus, expected_runtime, log_file_template=None,
+                 num_elements=None, start=0, end=None, inputs={}, outputs=[], salt=''):
+        self.id = None
+        self.cmds = cmds
+        self.params = params
+        self.num_cpus = num_cpus
+        self.expected_runtime = expected_runtime
+        self.log_file_template = log_file_template
+        self.inputs = inputs
+        self.outputs = outputs
+        self.salt = salt
+        lens = set([len(v) for v in params.values()])
+        if len(lens) > 1:
+            raise ConfigException('All job array parameter lists must have the same length')
+        if num_elements is None:
+            if len(lens) == 0:
+                raise ConfigException('A job array needs parameter lists or num_elements')
+            num_elements = start + lens.pop()
+        self.start = start
+        self.end = end
+        if self.end is None:
+            self.end = num_elements
+
+    def __len__(self):
+        return self.end - self.start
+
+    def to_dict(self):
+        return {'type':'job_array',
+                'id':self.id,
+                'command':self.cmds,
+                'params':self.params,
+                'num_cpus':self.num_cpus,
+                'expected_runtime':self.expected_runtime,
+                'log_file_template':self.log_file_template,
+                'inputs':self.inputs,
+                'outputs':self.outputs,
+                'salt':self.salt,
+                'start':self.start,
+                'end':self.end}
+
+    def sub_array(self, start, end):
+        """ The elements with indices in [start, end), params only hold the values for that range. """
+        params = dict([(name, vals[start-self.start:end-self.start]) for name,vals in self.params.iteritems()])
+        ja = JobArray(self.cmds, params, self.num_cpus, self.expected_runtime,
+                      log_file_template=self.log_file_template, num_elements=end, start=start, end=end,
+                      inputs=self.inputs, outputs=self.outputs, salt=self.salt)
+        ja.id = self.id
+        ja.batch_id = getattr(self, 'batch_id', 'None')
+        return ja
+
+    def split(self, chunk_size):
+        return [self.sub_array(k, min(k+chunk_size, self.end)) for k in range(self.start, self.end, chunk_size)]
+
+    def element(self, index):
+        """ The Job for a single element of the array. """
+        params = dict([(name, vals[index-self.start]) for name,vals in self.params.iteritems()])
+        params['INDEX'] = index
+        cmds = [fill_template(c, params) for c in self.cmds]
+        inputs = dict([(name, fill_template(key, params)) for name,key in self.inputs.iteritems()])
+        log_file_template = None
+        if self.log_file_template is not None:
+            log_file_template = fill_template(self.log_file_template, params)
+        j = Job(cmds, self.num_cpus, self.expected_runtime, log_file_template=log_file_template, inputs=inputs,
+                outputs=[fill_template(o, params) for o in self.outputs])
+        j.id = '%s-%d' % (self.id, index)
+        j.key = job_key(cmds, inputs, j.outputs, self.salt)
+        j.batch_id = getattr(self, 'batch_id', 'None')
+        return j
+
+    def element_ids(self):
+        return ['%s-%d' % (self.id, index) for index in range(self.start, self.end)]
+
+    def element_keys(self):
+        return [self.element(index).key for index in range(self.start, self.end)]
+
+def job_array_from_dict(ji):
+    ja = JobArray(ji['command'], ji['params'], int(ji['num_cpus']), ji['expected_runtime'],
+                  log_file_template=ji['log_file_template'], num_elements=ji['end'],
+                  start=ji['start'], end=ji['end'], inputs=ji.get('inputs', {}),
+                  outputs=ji.get('outputs', []), salt=ji.get('salt', ''))
+    ja.id = ji['id']
+    ja.batch_id = ji.get('batch_id', 'None')
+    return ja
+
+
+def fill_template(template_str, params):
+    """ Replace each #NAME# in template_str with str(params[NAME]). """
+    for name,val in params.iteritems():
+        nStr = '#%s#' % name
+        template_str = string.replace(template_str, nStr, str(val))
+    return template_str
+
+
 class ScriptTemplate:
 
     def __init__(self, fname):
@@ -92,9 +271,4 @@ class ScriptTemplate:
 
     def fill(self, params):
 
-        script_str = self.template
-        for name,val in params.iteritems():
-            nStr = '#%s#' % name
-            script_str = string.replace(script_str, nStr, str(val))
-
-        return script_str
+        return fill_template(self.template, params)
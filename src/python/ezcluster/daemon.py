@@ -1,4 +1,19 @@
+import errno
+import shutil
+import signal
+import threading
+import multiprocessing
+
 from ezcluster.core import *
+from ezcluster.backend import get_backend
+from ezcluster.logship import LogShipper, LogStream
+from ezcluster.cache import InputCache
+from ezcluster.outputs import OutputUploader
+from ezcluster.lease import Lease
+from ezcluster.queues import job_queue_specs, QueuePoller
+from ezcluster.metrics import DaemonMetrics, job_usage
+from ezcluster.pool import pool_options, WarmPool
+from ezcluster.affinity import JobIsolation, memory_per_core
 
 logger = logging.getLogger('daemon')
 logger.setLevel(logging.DEBUG)
@@ -9,14 +24,14 @@ class Daemon():
         
     def __init__(self):
         
-        self.output_dir = '/tmp'        
+        self.output_dir = os.environ.get('EZCLUSTER_OUTPUT_DIR', '/tmp')
         log_file = os.path.join(self.output_dir, 'ezcluster-daemon.log')
         lh = logging.FileHandler(log_file)
         logger.addHandler(lh)
         
         logger.debug('Initializing daemon...')
         
-        self.conn = boto.ec2.connect_to_region(config.get('ec2', 'region'))
+        self.backend = get_backend()
         
         #get DNS name
         self.dns_name = os.environ['EC2_DNS_NAME']
@@ -31,141 +46,596 @@ class Daemon():
             raise ConfigException(estr)
 
         #get instance
-        res = self.conn.get_all_instances([self.instance_id])
-        if len(res) == 0:
-            estr = 'No instance found for id %s' % self.instance_id
-            logger.error(estr)
-            raise ConfigException(estr)
-        self.instance = res[0].instances[0]
+        try:
+            self.instance = self.backend.get_instance(self.instance_id)
+        except ConfigException, e:
+            logger.error(str(e))
+            raise
         if 'NUM_JOBS_PER_INSTANCE' not in os.environ:            
             logger.info('# of jobs per instance not found from environment variable NUM_JOBS_PER_INSTANCE, defaulting to 1')
             self.num_jobs_per_instance = 1
         else:
             self.num_jobs_per_instance = int(os.environ['NUM_JOBS_PER_INSTANCE'])
         self.num_running_jobs = 0
+        if os.environ.get('NUM_CORES', 'None') in ['', 'None', 'auto']:
+            self.num_cores = multiprocessing.cpu_count()
+        else:
+            self.num_cores = int(os.environ['NUM_CORES'])
+        #how long a job that doesn't fit yet can hold its reservation before going back to the queue
+        self.max_reservation_wait = 600.0
+        #jobs that don't fit go back to the queue for unfit_delay seconds, so they aren't read again right away
+        self.unfit_delay = 30
+        self.num_unfit = 0
+        self.msg_hold_time = 60
+        #running jobs hold their message for lease_time seconds, renewed every heartbeat_interval seconds
+        self.lease_time = 180
+        self.heartbeat_interval = 60.0
+        self.last_heartbeat = time.time()
         
-        #connect to SQS
-        self.sqs = boto.connect_sqs()
-        qname = config.get('sqs', 'job_queue')
-        self.job_queue = self.sqs.get_queue(qname)
-        if self.job_queue is None:
-            estr = 'Cannot connect to SQS jobs queue: %s' % qname
-            logger.error(estr)
-            raise ConfigException(estr)
-        
-        qname = config.get('sqs', 'status_queue')
-        self.status_queue = self.sqs.get_queue(qname)
-        if self.status_queue is None:
-            estr = 'Cannot connect to SQS status queue: %s' % qname
-            logger.error(estr)
-            raise ConfigException(estr)
+        #connect to the job queues, highest priority first, and the status queue
+        try:
+            specs = job_queue_specs()
+            self.job_queues = [self.backend.connect_queue(name) for (name, weight, max_runtime) in specs]
+            self.poller = QueuePoller(self.job_queues, [weight for (name, weight, max_runtime) in specs])
+            #the poll thread's own connections to the job queues, see start_poll
+            self.poll_queues = None
+            self.status_queue = self.backend.connect_queue(config.get('sqs', 'status_queue'))
+        except ConfigException, e:
+            logger.error(str(e))
+            raise
         
-        #do some s3 stuff         
-        bpath = config.get('s3', 'bucket')
-        bsp = bpath.split('/')
-        self.bucket_name = bsp[0]
-        self.bucket_path = ','.join(bsp[1:])
-        self.connect_bucket()
+        #blob store for logs
+        self.blob_store = self.backend.connect_blob_store()
+        self.log_shipper = LogShipper(self.backend.connect_blob_store)
+        self.log_streams = []
+
+        #local cache of job inputs, shared by all jobs
+        cache_size = os.environ.get('INPUT_CACHE_SIZE', 'None')
+        if cache_size in ['', 'None']:
+            cache_size = 10*1024**3
+        self.input_cache = InputCache(self.backend.connect_blob_store,
+                                      os.environ.get('INPUT_CACHE_DIR', os.path.join(self.output_dir, 'ezcluster-cache')),
+                                      int(cache_size))
+        #job outputs are uploaded in the background, a job is reported finished once they're done
+        self.output_uploader = OutputUploader(self.backend.connect_blob_store)
+        self.uploading = {}
+        #every job runs in a directory of its own, its relative output paths are taken from there
+        self.jobs_dir = os.path.join(self.output_dir, 'ezcluster-jobs')
+
+        #slot utilization, idle time and job resource usage, for scraping
+        self.metrics = DaemonMetrics(os.path.join(self.output_dir, 'ezcluster-metrics.prom'), self.instance_id,
+                                     self.num_jobs_per_instance, self.num_cores)
+
+        #each job runs on cpus of its own, within its share of memory, with thread pools sized to its cores
+        self.isolation = JobIsolation(self.num_cores, pin_cpus=os.environ.get('PIN_CPUS', 'True') == 'True',
+                                      memory_per_core=memory_per_core(os.environ.get('MEMORY_PER_CORE'), self.num_cores))
+
+        #finished instances are parked in the warm pool, if there is one
+        self.pool = None
+        (pool_size, pool_linger, pool_max_idle) = pool_options()
+        if pool_size > 0 and not self.backend.is_local:
+            self.pool = WarmPool(boto.ec2.connect_to_region(config.get('ec2', 'region')), self.instance.image_id,
+                                 self.instance.instance_type, self.instance.key_name, pool_size,
+                                 linger=pool_linger, max_idle=pool_max_idle)
+
+        #look ahead in the queue for inputs to stage only once jobs with inputs have shown up
+        self.look_ahead_inputs = False
         
-        self.jobs = {}        
+        self.jobs = {}
+        self.prefetched = []
+        #the job queues are long polled from a thread, so an exiting job can interrupt the wait
+        self.poll_thread = None
+        self.poll_result = None
+        self.child_exited = threading.Event()
         logger.info('Daemon initialized and started on instance %s' % self.instance_id)
         logger.info('DNS name: %s' % self.dns_name)
         logger.info('# of jobs per instance: %d' % self.num_jobs_per_instance)
-        logger.info('SQS job queue name: %s' % self.job_queue.name)
-        logger.info('SQS status queue name: %s' % self.status_queue.name)
-        logger.info('S3 path: %s/%s' % (self.bucket_name, self.bucket_path))
-                
+        logger.info('# of cores: %d' % self.num_cores)
+        logger.info('Job queue names: %s' % ', '.join(['%s (weight %g)' % (q.name, w) for q,w in
+                                                       zip(self.job_queues, self.poller.weights)]))
+        logger.info('Status queue name: %s' % self.status_queue.name)
+        logger.info('Log path: %s' % self.blob_store.url('logs'))
+        logger.info('Input cache: %s, %d bytes' % (self.input_cache.cache_dir, self.input_cache.max_bytes))
+        logger.info('Metrics file: %s' % self.metrics.path)
+        logger.info('CPU pinning: %s, memory per core: %s (%s)' % \
+                    (self.isolation.cpus is not None, self.isolation.memory_per_core,
+                     self.isolation.cgroups is not None and 'cgroup' or 'rlimit'))
 
-    def connect_bucket(self):
-        self.s3_conn = boto.connect_s3()
-        self.bucket = self.s3_conn.get_bucket(self.bucket_name)
+    def get_next_job(self, timeout_after=30.0, wait_time=20, msg_hold_time=None, num_prefetch=1):
+        """ Get the next available job in the SQS queues that fits on the free cores.
 
-    def get_next_job(self, timeout_after=30.0, sleep_time=1.00, msg_hold_time=15):
-        """ Get the next available job in the SQS queue. """        
+            Messages are read with SQS long polling, up to num_prefetch (at most 10)
+            at a time from one queue, chosen by the weighted order of QueuePoller, and
+            kept in a local buffer so that the next free slots are filled without
+            another request. Returns a tuple (lease, job_info), or None
+            if no runnable job shows up within timeout_after seconds, or earlier if a
+            running job has finished. The long poll runs in a thread (see start_poll),
+            so a job exiting (SIGCHLD) ends the wait right away and the poll carries on,
+            its messages are picked up by the next call. If the buffered jobs had to be
+            given back because they don't fit, it waits for a running job to finish, up
+            to unfit_delay seconds, instead of polling again.
+        """
         
+        if msg_hold_time is None:
+            msg_hold_time = self.msg_hold_time
         logger.debug('Looking for next job...')
         start_time = time.time()
-        timed_out = False
-        while not timed_out:
-            msg = self.job_queue.read(msg_hold_time)
-            if msg is not None:
-                msg_data = json.loads(msg.get_body())
-                #logger.debug('Got a message of type %s' % msg_data['type'])
-                if msg_data['type'] == 'job':
-                    job_info = copy(msg_data)
-                    self.job_queue.delete_message(msg)
-                    logger.debug('Got job from batch %s with id %s, deleted work order from queue.' %\
-                                  (job_info['batch_id'], job_info['id']))
-                    return job_info
-            time.sleep(sleep_time)
-            timed_out = (time.time() - start_time) > timeout_after
-        logger.debug('No jobs found, timing out returning None...')
-        return None
-
-    def run(self, quit_when_empty=False, timeout_after=30.0, sleep_time=10.0):
-        """ Run until there are no jobs left to run """        
+        while True:
+            next_job = self.pick_job()
+            if next_job is not None:
+                return next_job
+            remaining = timeout_after - (time.time() - start_time)
+            if remaining <= 0 or self.child_exited.is_set():
+                logger.debug('No jobs found, timing out returning None...')
+                return None
+            if self.num_unfit > 0:
+                self.child_exited.wait(min(remaining, self.unfit_delay))
+                return None
+            if self.poll_thread is None:
+                self.start_poll(max(1, min(num_prefetch, 10)), msg_hold_time, int(max(1, min(wait_time, remaining))))
+            while self.poll_thread.is_alive() and not self.child_exited.is_set():
+                self.poll_thread.join(0.1)
+            self.collect_poll(max(num_prefetch, 1))
+
+    def start_poll(self, num_messages, visibility_timeout, wait_time_seconds):
+        """ Long poll the job queues in a thread, see collect_poll. Only one poll runs at a time.
+
+            The thread reads through its own queue connections, made on its first poll, so
+            the main thread can keep using its own while a poll is running.
+        """
+        result = []
+
+        def poll():
+            try:
+                if self.poll_queues is None:
+                    self.poll_queues = [self.backend.connect_queue(q.name) for q in self.job_queues]
+                result.append(self.poller.get_messages(num_messages=num_messages,
+                                                       visibility_timeout=visibility_timeout,
+                                                       wait_time_seconds=wait_time_seconds,
+                                                       queues=self.poll_queues))
+            except Exception, e:
+                logger.warning('Could not poll the job queues: %s' % str(e))
+                result.append((None, []))
+
+        self.poll_result = result
+        self.poll_thread = threading.Thread(target=poll)
+        self.poll_thread.daemon = True
+        self.poll_thread.start()
+
+    def collect_poll(self, num_claim, wait=False):
+        """ Buffer the messages of the poll thread once it has returned, or right away with wait.
+
+            The messages are moved to the main thread's connection of their queue, for the
+            leases. Returns False if a poll is still running.
+        """
+        if self.poll_thread is None:
+            return True
+        if wait:
+            self.poll_thread.join()
+        if self.poll_thread.is_alive():
+            return False
+        (queue, msgs) = self.poll_result[0]
+        self.poll_thread = None
+        self.poll_result = None
+        if queue is not None:
+            queue = self.job_queues[self.poller.rank(queue)]
+        for msg in msgs:
+            msg.queue = queue
+            self.add_message(queue, msg, num_claim)
+        return True
+
+    def add_message(self, queue, msg, num_claim):
+        """ Buffer the jobs of a message from the job queue, see claim_job_array for job arrays.
+
+            A message received more than max_retries+1 times means its jobs were started
+            that many times without finishing, those jobs are reported as failed.
+        """
+        msg_data = json.loads(msg.get_body())
+        lease = Lease(queue, msg, whole=msg_data['type'] == 'job')
+        num_starts = lease.receive_count() - 1
+        if num_starts > int(msg_data.get('max_retries', 3)):
+            jobs = [job_from_dict(msg_data)]
+            if msg_data['type'] == 'job_array':
+                ja = job_array_from_dict(msg_data)
+                jobs = [ja.element(index) for index in range(ja.start, ja.end)]
+            logger.error('Message for %s was started %d times without finishing, giving up' % (msg_data['id'], num_starts))
+            for j in jobs:
+                self.post_failed_job(j, 'Started %d times without finishing' % num_starts)
+            lease.job_done()
+            return
+        if num_starts > 0:
+            logger.info('Retrying %s, started %d times before' % (msg_data['id'], num_starts))
+        if msg_data['type'] == 'job':
+            self.add_prefetched(lease, copy(msg_data))
+        elif msg_data['type'] == 'job_array':
+            self.claim_job_array(lease, msg_data, num_claim)
+
+    def add_prefetched(self, lease, job_info):
+        """ Buffer a job and start downloading its inputs. """
+        self.prefetched.append((lease, job_info))
+        for key in job_info.get('inputs', {}).values():
+            self.look_ahead_inputs = True
+            self.input_cache.prefetch(key)
+
+    def look_ahead(self):
+        """ While every slot is busy, hold on to the next queued job if it has inputs to stage.
+
+            Its inputs download while the running jobs finish, and its message is kept
+            invisible until a slot frees up. Jobs without inputs go right back to the queue,
+            and so do all buffered jobs without look_ahead_inputs, including the ones read
+            by a poll that was still running when the slots filled up.
+        """
+        polled = self.collect_poll(1)
+        self.release_unstaged()
+        if len(self.prefetched) > 0:
+            self.renew_prefetched()
+        elif self.look_ahead_inputs and polled:
+            (queue, msgs) = self.poller.get_messages(num_messages=1, visibility_timeout=self.msg_hold_time)
+            for msg in msgs:
+                self.add_message(queue, msg, 1)
+            self.release_unstaged()
+
+    def release_unstaged(self):
+        """ Give the buffered jobs that have no inputs to stage back to the queue, all of them without look_ahead_inputs. """
+        keep = []
+        for (lease, job_info) in self.prefetched:
+            if self.look_ahead_inputs and len(job_info.get('inputs', {})) > 0:
+                logger.debug('Holding job %s to stage its inputs' % job_info['id'])
+                keep.append((lease, job_info))
+            else:
+                lease.release(job_info)
+        self.prefetched = keep
+
+    def renew_prefetched(self):
+        """ Keep buffered messages invisible, jobs whose message was lost are dropped from the buffer. """
+        keep = []
+        for (lease, job_info) in self.prefetched:
+            if lease.renew(self.msg_hold_time):
+                keep.append((lease, job_info))
+            else:
+                logger.debug('Lost the message for job %s, dropping it' % job_info['id'])
+        self.prefetched = keep
+
+    def claim_job_array(self, lease, msg_data, num_claim):
+        """ Claim the first num_claim elements of a job array chunk and expand them into the prefetch buffer.
+
+            The claimed elements share the chunk's lease. The rest of a larger chunk is
+            posted back to the same queue as a new chunk, for the next poll. If that post
+            fails, nothing is claimed and the whole chunk is given back to the queue. The
+            lease is still on the original message, so if the daemon dies before the claimed
+            elements finish, the whole chunk comes back and the rest can run twice.
+        """
+        ja = job_array_from_dict(msg_data)
+        if len(ja) > num_claim:
+            rest_data = ja.sub_array(ja.start + num_claim, ja.end).to_dict()
+            for name in ['batch_id', 'max_retries', 'posted_on', 'skip_done']:
+                if name in msg_data:
+                    rest_data[name] = msg_data[name]
+            res = lease.queue.write_batch([('0', lease.queue.new_message(body=json.dumps(rest_data)).get_body_encoded(), 0)])
+            if len(res.errors) > 0:
+                logger.warning('Could not post the rest of job array %s from element %d, giving it back: %s' % \
+                               (ja.id, ja.start + num_claim, str(res.errors)))
+                lease.release(msg_data)
+                return
+            logger.debug('Split job array %s at element %d' % (ja.id, ja.start + num_claim))
+            ja = ja.sub_array(ja.start, ja.start + num_claim)
+        logger.debug('Claimed elements %d-%d of job array %s' % (ja.start, ja.end-1, ja.id))
+        lease.num_jobs = len(ja)
+        for index in range(ja.start, ja.end):
+            job_info = ja.element(index).to_dict()
+            job_info['batch_id'] = msg_data['batch_id']
+            job_info['max_retries'] = msg_data.get('max_retries', 3)
+            job_info['posted_on'] = msg_data.get('posted_on')
+            job_info['skip_done'] = msg_data.get('skip_done', False)
+            self.add_prefetched(lease, job_info)
+
+    def job_cpus(self, num_cpus):
+        """ Number of cores a job takes on this instance, jobs asking for more than we have get the whole machine. """
+        return min(max(int(num_cpus), 1), self.num_cores)
+
+    def has_room(self):
+        """ True if there's a free slot and at least one free core. """
+        return len(self.jobs) < self.num_jobs_per_instance and self.free_cores() > 0
+
+    def free_cores(self):
+        return self.num_cores - sum([self.job_cpus(j.num_cpus) for j in self.jobs.values()])
+
+    def reservation_time(self, num_cpus):
+        """ Estimate when num_cpus cores will be free, from the expected runtimes of the running jobs.
+
+            Returns a tuple (time, extra_cores), where extra_cores is the number of cores left over
+            at that time once the reservation is made, or (None, 0) if it can't be estimated.
+        """
+        free = self.free_cores()
+        now = time.time()
+        ends = []
+        for j in self.jobs.values():
+            if j.expected_runtime is None or float(j.expected_runtime) <= 0:
+                ends.append((None, self.job_cpus(j.num_cpus)))
+            else:
+                ends.append((j.start_time + float(j.expected_runtime), self.job_cpus(j.num_cpus)))
+        ends.sort(key=lambda e: e[0] is None and float('inf') or e[0])
+        for (end_time, ncpus) in ends:
+            if end_time is None:
+                break
+            free += ncpus
+            if free >= num_cpus:
+                return (max(end_time, now), free - num_cpus)
+        return (None, 0)
+
+    def pick_job(self):
+        """ Choose the next job to start from the prefetch buffer.
+
+            Jobs from higher priority queues go first, and within a queue jobs are packed
+            largest num_cpus first. The first job in that order that does not fit
+            holds a reservation for the time its cores are expected to free up, and
+            smaller jobs are backfilled around it only if their expected_runtime ends
+            before then or they use cores the reservation doesn't need. Every other job
+            that doesn't fit goes back to the queue for unfit_delay seconds, num_unfit
+            counts them.
+        """
+        self.num_unfit = 0
+        if len(self.prefetched) == 0 or not self.has_room():
+            return None
+
+        self.prefetched.sort(key=lambda p: (self.poller.rank(p[0].queue), -self.job_cpus(p[1]['num_cpus'])))
+        now = time.time()
+        free = self.free_cores()
+        reservation_made = False
+        shadow_time = None
+        extra_cores = 0
+        chosen = None
+        keep = []
+        for k,(lease, job_info) in enumerate(self.prefetched):
+            ncpus = self.job_cpus(job_info['num_cpus'])
+            if ncpus > free:
+                #hold on to the first job that doesn't fit only if its cores are expected to free up soon
+                if not reservation_made:
+                    reservation_made = True
+                    (shadow_time, extra_cores) = self.reservation_time(ncpus)
+                    if shadow_time is not None and shadow_time - now <= self.max_reservation_wait:
+                        if lease.renew(self.msg_hold_time):
+                            keep.append((lease, job_info))
+                        continue
+                    shadow_time = None
+                logger.debug('Job %s needs %d cores, %d free, returning it to the queue' %\
+                             (job_info['id'], ncpus, free))
+                lease.release(job_info, delay=self.unfit_delay)
+                self.num_unfit += 1
+                continue
+
+            runtime = float(job_info['expected_runtime'] or -1)
+            if shadow_time is None or (runtime > 0 and now + runtime <= shadow_time) or ncpus <= extra_cores:
+                chosen = (lease, job_info)
+                keep.extend(self.prefetched[k+1:])
+                break
+            logger.debug('Job %s would delay a reserved job, returning it to the queue' % job_info['id'])
+            lease.release(job_info, delay=self.unfit_delay)
+            self.num_unfit += 1
+        self.prefetched = keep
+
+        if chosen is None:
+            return None
+        (lease, job_info) = chosen
+        logger.debug('Got job from batch %s with id %s' % (job_info['batch_id'], job_info['id']))
+        return chosen
+
+    def release_prefetched(self):
+        """ Give any buffered jobs back to the queue, once the poll thread is done. """
+        self.collect_poll(1, wait=True)
+        for (lease, job_info) in self.prefetched:
+            lease.release(job_info)
+        self.prefetched = []
+
+    def heartbeat(self):
+        """ Every heartbeat_interval seconds, renew the leases of jobs that are running or
+            uploading outputs, and post a 'running' status for each running job.
+        """
+        if time.time() - self.last_heartbeat < self.heartbeat_interval:
+            return
+        self.last_heartbeat = time.time()
+        leases = dict([(id(j.lease), j.lease) for j in self.jobs.values() + self.uploading.values()])
+        for lease in leases.values():
+            if not lease.renew(self.lease_time):
+                logger.warning('Lost the lease on a running job, another instance may run it too')
+        for j in self.jobs.values():
+            status_msg = self.create_status_message(j, is_new=True)
+            status_msg['heartbeat'] = True
+            self.status_queue.write(self.status_queue.new_message(body=json.dumps(status_msg)))
+
+    def handle_sigchld(self, signum, frame):
+        """ Reap the jobs that exited right away, so their end time is taken when they exit. """
+        for j in self.jobs.values():
+            self.poll_job(j)
+        self.child_exited.set()
+
+    def run(self, quit_when_empty=False, timeout_after=30.0, sleep_time=60.0):
+        """ Run until there are no jobs left to run.
+
+            The loop wakes up as soon as a job process exits (SIGCHLD) and refills
+            free slots with long polling, so sleep_time only bounds how long it
+            waits while every slot is busy.
+        """        
         
         logger.debug('Starting daemon...')
+        signal.signal(signal.SIGCHLD, self.handle_sigchld)
+        #restart system calls (i.e. SQS requests) interrupted by SIGCHLD
+        signal.siginterrupt(signal.SIGCHLD, False)
         start_time = time.time()
         while True:
             # Update job statuses - delete finished jobs
+            self.child_exited.clear()
             if len(self.jobs) > 0:
                 for j in self.jobs.values():
                     self.update_job_status(j)
+            self.update_uploads()
+            self.heartbeat()
+            self.metrics.write()
         
             # Get as many jobs as we're allowed and run them
             next_job=None
-            while len(self.jobs) < self.num_jobs_per_instance:
-                next_job = self.get_next_job()
+            while self.has_room():
+                num_prefetch = min(self.num_jobs_per_instance - len(self.jobs), self.free_cores())
+                next_job = self.get_next_job(num_prefetch=num_prefetch)
                 if next_job is None:
                     break
-                self.run_job(next_job)
-
-            time.sleep(sleep_time)
+                self.run_job(*next_job)
 
-            # If there are no more jobs to run - sleep and check for timeout
-            if next_job is None and len(self.jobs)<self.num_jobs_per_instance:
+            # If there are no more jobs to run check for timeout, get_next_job has already waited
+            if next_job is None and len(self.prefetched) == 0 and self.num_unfit == 0 and self.has_room():
                 if quit_when_empty and (time.time() - start_time) > timeout_after:
                     break
-            # If just ran a job, reset start time for timeout
+            # If all slots or cores are busy or a job is waiting for cores, reset start time for timeout
             else:
                 start_time = time.time()
+                if not self.has_room():
+                    self.look_ahead()
+                    if len(self.prefetched) > 0 or self.poll_thread is not None:
+                        #wake up in time to renew the reservation, or the messages of the poll
+                        self.child_exited.wait(min(sleep_time, self.heartbeat_interval, self.msg_hold_time / 2.0))
+                    else:
+                        self.child_exited.wait(min(sleep_time, self.heartbeat_interval))
 
-        # Wait until currently running jobs are finished
+        self.release_prefetched()
+
+        # Wait until currently running jobs are finished, keeping their leases
         logger.debug('No jobs found, waiting for current jobs to complete...')
-        for j in self.jobs.values():
-            status_msg = self.create_status_message(j)
-            if not status_msg['status'] == 'finished':
-                j.proc.wait()
+        while len(self.jobs) + len(self.uploading) > 0:
+            self.child_exited.clear()
+            for j in self.jobs.values():
                 self.update_job_status(j)
+            self.update_uploads()
+            self.heartbeat()
+            self.metrics.write()
+            if len(self.jobs) + len(self.uploading) > 0:
+                self.child_exited.wait(self.heartbeat_interval)
+
+        # Finish shipping logs
+        for ls in self.log_streams:
+            ls.join()
+        self.log_shipper.close()
+        self.metrics.write(force=True)
+
+        self.retire_instance()
 
+    def retire_instance(self):
+        """ Park the instance in the warm pool, or terminate it if there is no pool or the pool is full. """
+        if self.pool is not None:
+            try:
+                if self.pool.park(self.instance, os.environ.get('CODE_HASH')):
+                    logger.debug('All jobs completed, parked instance for %0.0fs...' % self.pool.linger)
+                    if self.pool.linger_until_claimed(self.instance):
+                        logger.debug('Instance was claimed by a new launch')
+                    else:
+                        logger.debug('Instance stopped')
+                    return
+            except Exception, e:
+                logger.error('Could not park instance: %s' % str(e))
         # Kill instance
         logger.debug('All jobs completed, shutting down instance...')
         self.instance.terminate()
 
-    def run_job(self, job_info):
-        """ Run an individual job from the SQS queue. """
+    def run_job(self, lease, job_info):
+        """ Run an individual job from the SQS queue, its message is held under lease until it completes.
+
+            The state of a running job is kept under a token of its own, j.run_id, so a
+            job whose message is delivered twice can run twice on the same instance.
+        """
         
         j = job_from_dict(job_info)
         j.batch_id = job_info['batch_id']
+        j.lease = lease
+        j.run_id = new_job_id()
+
+        #an identical job already succeeded
+        if job_info.get('skip_done') and j.key is not None and self.blob_store.exists(self.done_key(j)):
+            logger.debug('Job %s is already done, skipping it' % j.id)
+            self.post_done_job(j)
+            lease.job_done()
+            return
+        lease.renew(self.lease_time)
         logger.debug('Starting job from batch %s with id %s' % (j.batch_id, j.id))
         
-        log_file = os.path.join(self.output_dir, j.log_file_template)
-        print 'Opening log file: %s' % log_file
-        fd = open(log_file, 'w')
-        j.fd = fd
-        j.log_file = log_file
-        logger.debug('Job log file: %s' % j.log_file)
+        #jobs added without a log file template log to a file named by their id
+        log_filename = os.path.basename(j.log_file_template or 'job_%s.log' % j.id)
+        j.log_key = os.path.join('logs', log_filename)
+        logger.debug('Job log: %s.gz.*' % self.blob_store.url(j.log_key))
+
+        #stage inputs, they were usually prefetched while the job was queued
+        input_paths = {}
+        try:
+            for name,key in j.inputs.iteritems():
+                input_paths[name] = self.stage_input(lease, key)
+        except Exception, e:
+            for name in input_paths.keys():
+                self.input_cache.release(j.inputs[name])
+            #the job goes back to the queue, unless its inputs failed too many times already
+            num_failures = int(job_info.get('staging_failures', 0)) + 1
+            if num_failures > int(job_info.get('max_retries', 3)):
+                logger.error('Could not stage inputs of job %s %d times: %s' % (j.id, num_failures, str(e)))
+                self.post_failed_job(j, 'Could not stage inputs: %s' % str(e))
+                lease.job_done()
+            else:
+                logger.warning('Could not stage inputs of job %s, returning it to the queue: %s' % (j.id, str(e)))
+                job_info['staging_failures'] = num_failures
+                lease.repost(job_info)
+            return
+        j.cmds = [fill_template(c, input_paths) for c in j.cmds]
         
-        proc = subprocess.Popen(j.cmds, stdout=fd, stderr=fd)
+        j.work_dir = os.path.join(self.jobs_dir, j.run_id)
+        (env, preexec_fn, j.cpus) = self.isolation.prepare(j.run_id, self.job_cpus(j.num_cpus))
+        j.start_time = time.time()
+        try:
+            os.makedirs(j.work_dir)
+            proc = subprocess.Popen(j.cmds, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True,
+                                    cwd=j.work_dir, env=env, preexec_fn=preexec_fn)
+        except OSError, e:
+            #e.g. the executable doesn't exist, the job can never start
+            logger.error('Could not start job %s: %s' % (j.id, str(e)))
+            self.remove_work_dir(j)
+            self.isolation.release(j.run_id)
+            for key in j.inputs.values():
+                self.input_cache.release(key)
+            self.post_failed_job(j, 'Could not start: %s' % str(e))
+            lease.job_done()
+            return
+        except:
+            self.isolation.release(j.run_id)
+            raise
         j.proc = proc
+        j.posted_on = job_info.get('posted_on')
+        j.log_stream = LogStream(self.log_shipper, proc.stdout, j.log_key)
+        self.log_streams.append(j.log_stream)
         logger.debug('Job command: %s' % ' '.join(j.cmds))
-        logger.debug('Process started with pid=%d' % j.proc.pid)
+        logger.debug('Process started with pid=%d on cpus %s' % (j.proc.pid, j.cpus))
                 
-        self.jobs[j.id] = j
+        self.jobs[j.run_id] = j
+        self.metrics.update(len(self.jobs), self.num_cores - self.free_cores())
+        queue_wait = None
+        if j.posted_on is not None:
+            queue_wait = j.start_time - float(j.posted_on)
+        self.metrics.job_started(queue_wait)
         self.update_job_status(j, is_new=True)
         
 
+    def stage_input(self, lease, key, poll_time=5.0):
+        """ Wait for an input of a job that is about to start to be in the cache, returns its local path.
+
+            While it downloads, the leases of the running jobs, of this job and of the
+            buffered jobs are renewed, so none of them go back to the queue.
+        """
+        last_renewal = time.time()
+        while True:
+            path = self.input_cache.get(key, timeout=poll_time)
+            if path is not None:
+                return path
+            logger.debug('Waiting for input %s...' % key)
+            self.heartbeat()
+            if time.time() - last_renewal >= min(self.heartbeat_interval, self.msg_hold_time / 2.0):
+                last_renewal = time.time()
+                self.renew_prefetched()
+                lease.renew(self.lease_time)
+
     def update_job_status(self, j, is_new=False):
         """ Update a job status in the SQS queue. """
         
@@ -174,26 +644,24 @@ class Daemon():
         write_to_queue = True
         if not is_new:
             if status_msg['status'] == 'finished':
-                logger.debug('Job %s is complete with exit code %d' % (j.id, status_msg['ret_code']))
-                j.fd.close()
-                del self.jobs[j.id]
-                
-                #copy logfile to s3 bucket
-                if os.path.exists(j.log_file):
-                    (rootdir, log_filename) = os.path.split(j.log_file)
-                    dest_file = os.path.join(self.bucket_path, 'logs', log_filename)
-
-                    try:
-                        self.connect_bucket()
-
-                        key = self.bucket.new_key(dest_file)
-                        key.set_contents_from_filename(j.log_file)
-                        logger.debug('Copied log file from %s to s3://%s/%s' % (j.log_file, self.bucket_name, dest_file))
-
-                        # remove log file from local machine
-                        os.remove(j.log_file)
-                    except Exception:
-                        logger.warning('Error copying log file from %s to s3://%s/%s' % (j.log_file, self.bucket_name, dest_file))
+                logger.debug('Job %s is complete with exit code %d after %0.1fs, %0.1fs CPU, max RSS %d bytes' % \
+                             (j.id, status_msg['ret_code'], status_msg.get('wall_time', -1),
+                              status_msg.get('user_time', 0) + status_msg.get('system_time', 0),
+                              status_msg.get('max_rss', 0)))
+                del self.jobs[j.run_id]
+                self.isolation.release(j.run_id)
+                self.metrics.update(len(self.jobs), self.num_cores - self.free_cores())
+                for key in j.inputs.values():
+                    self.input_cache.release(key)
+                #the log stream ships the rest of the output in the background
+                self.log_streams = [ls for ls in self.log_streams if not ls.is_done()]
+                #the slot is free again, the status is written when the outputs are uploaded
+                if len(j.outputs) > 0:
+                    j.upload = self.output_uploader.upload(j, j.outputs, on_done=self.child_exited.set)
+                    self.uploading[j.run_id] = j
+                    write_to_queue = False
+                else:
+                    self.remove_work_dir(j)
                 
             else:
                 write_to_queue = False
@@ -201,25 +669,127 @@ class Daemon():
         if write_to_queue:
             msg = self.status_queue.write(self.status_queue.new_message(body=json.dumps(status_msg)))
             j.msg = msg
+            if status_msg['status'] == 'finished':
+                self.metrics.job_finished(status_msg)
+                self.record_completion(j, status_msg)
+                j.lease.job_done()
             
 
+    def update_uploads(self):
+        """ Write the finished status of jobs whose outputs are done uploading. """
+        for j in self.uploading.values():
+            if j.upload.is_done():
+                del self.uploading[j.run_id]
+                status_msg = self.create_status_message(j)
+                logger.debug('Uploaded %d outputs of job %s, %d bytes in %0.1fs (%0.1f MB/s)' % \
+                             (len(status_msg['outputs']), j.id, status_msg['output_bytes'],
+                              status_msg['output_upload_time'], status_msg['output_throughput'] / 1024**2))
+                self.status_queue.write(self.status_queue.new_message(body=json.dumps(status_msg)))
+                self.metrics.job_finished(status_msg)
+                self.record_completion(j, status_msg)
+                j.lease.job_done()
+                if len(status_msg['output_errors']) == 0:
+                    self.remove_work_dir(j)
+                else:
+                    logger.warning('Keeping the working directory %s of job %s, some outputs were not uploaded' % \
+                                   (j.work_dir, j.id))
+
+    def remove_work_dir(self, j):
+        shutil.rmtree(j.work_dir, ignore_errors=True)
+
+    def done_key(self, j):
+        return 'done/%s' % j.key
+
+    def record_completion(self, j, status_msg):
+        """ Add a job that succeeded, outputs included, to the completion index in the blob store, under its content key. """
+        if j.key is None or status_msg['ret_code'] != 0 or len(status_msg.get('output_errors', [])) > 0:
+            return
+        record = {'id':j.id,
+                  'key':j.key,
+                  'batch_id':j.batch_id,
+                  'instance':self.instance_id,
+                  'finished_on':status_msg['last_update'],
+                  'outputs':status_msg.get('outputs', [])}
+        #small enough to go through the log shipper's upload threads, but never worth waiting behind log chunks
+        self.log_shipper.upload(self.done_key(j), json.dumps(record), block=False)
+
+    def post_done_job(self, j):
+        """ Report a job found in the completion index as finished, without running it. """
+        status_msg = {'type':'job_status',
+                      'job':j.to_dict(),
+                      'batch_id':j.batch_id,
+                      'instance':self.instance_id,
+                      'last_update':time.time(),
+                      'status':'finished',
+                      'ret_code':0,
+                      'memoized':True}
+        self.status_queue.write(self.status_queue.new_message(body=json.dumps(status_msg)))
+        self.metrics.job_finished(status_msg)
+
+    def post_failed_job(self, j, error):
+        """ Report a job that could not be started as finished with ret_code -1. """
+        status_msg = {'type':'job_status',
+                      'job':j.to_dict(),
+                      'batch_id':j.batch_id,
+                      'instance':self.instance_id,
+                      'last_update':time.time(),
+                      'status':'finished',
+                      'ret_code':-1,
+                      'error':error}
+        self.status_queue.write(self.status_queue.new_message(body=json.dumps(status_msg)))
+        self.metrics.job_finished(status_msg)
+
+    def poll_job(self, j):
+        """ Reap the process of a job if it has exited, returns its return code or None.
+
+            The process is waited for with os.wait4, so the resources it used (see job_usage)
+            are kept in j.usage, with the time it was reaped as its end time. Jobs are reaped
+            by the SIGCHLD handler, which Python runs in the main thread, so the end time can
+            only be late by the length of a blocking call the main thread is in, such as a
+            queue request, or for a job that exits before run_job has registered it, until the
+            next pass of the main loop.
+        """
+        if j.proc.returncode is not None:
+            return j.proc.returncode
+        try:
+            (pid, status, rusage) = os.wait4(j.proc.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            return j.proc.poll()
+        if pid == 0:
+            return None
+        if os.WIFSIGNALED(status):
+            j.proc.returncode = -os.WTERMSIG(status)
+        else:
+            j.proc.returncode = os.WEXITSTATUS(status)
+        j.usage = job_usage(rusage, j.start_time, time.time(), j.num_cpus)
+        return j.proc.returncode
+
     def create_status_message(self, j, is_new=False):
         status_msg = {}
         status_msg['type'] = 'job_status'
         status_msg['job'] = j.to_dict()        
+        status_msg['batch_id'] = j.batch_id
         status_msg['instance'] = self.instance_id
-        status_msg['started_on'] = time.time()
+        status_msg['started_on'] = j.start_time
+        status_msg['posted_on'] = j.posted_on
         status_msg['last_update'] = time.time()
-        status_msg['local_log_file'] = j.log_file
+        status_msg['log_key'] = self.blob_store.url(j.log_key)
         status_msg['pid'] = j.proc.pid
+        status_msg['cpus'] = j.cpus
         status_msg['status'] = 'running'
         
         if not is_new:
             #check for job completion
-            ret_code = j.proc.poll()
+            ret_code = self.poll_job(j)
             if ret_code is not None:                                
                 status_msg['status'] = 'finished'
                 status_msg['ret_code'] = ret_code
+                if hasattr(j, 'usage'):
+                    status_msg.update(j.usage)
+                if hasattr(j, 'upload') and j.upload.is_done():
+                    status_msg.update(j.upload.stats())
             
         return status_msg
 
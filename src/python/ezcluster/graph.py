@@ -0,0 +1,168 @@
+from ezcluster.core import *
+
+
+class JobGraph():
+    """ Holds back jobs until the jobs and batches they depend on have finished.
+
+        A job depends on a list of targets: Job or JobArray objects, job ids,
+        job array ids (every element of the array) or the batch_id of a batch
+        posted earlier. A held job is released as soon as every target has
+        finished with a return code of 0, or was already done before the batch
+        was posted (the done set). If any target fails or is cancelled, the job
+        is cancelled, and so is everything downstream of it. The state of the
+        targets is read from a BatchMonitor, see update, which has to be the same
+        monitor every time since status messages are only read once.
+    """
+
+    def __init__(self):
+        self.held = {}
+        self.dependencies = {}
+        self.array_elements = {}
+        self.batch_sizes = {}
+        self.known_ids = set()
+        self.done = set()
+        self.failed = set()
+        self.failed_batches = set()
+
+    def job_ids(self, j):
+        """ Ids of the status messages a job or job array posts. """
+        if isinstance(j, JobArray):
+            if j.id not in self.array_elements:
+                self.array_elements[j.id] = j.element_ids()
+            return self.array_elements[j.id]
+        return [j.id]
+
+    def resolve(self, targets):
+        """ Turn a list of dependency targets into a tuple (set of job ids, set of batch ids). """
+        job_ids = set()
+        batch_ids = set()
+        for t in targets:
+            if isinstance(t, (Job, JobArray)):
+                job_ids.update(self.job_ids(t))
+            elif t in self.array_elements:
+                job_ids.update(self.array_elements[t])
+            elif t in self.batch_sizes:
+                batch_ids.add(t)
+            else:
+                if t not in self.known_ids:
+                    print 'Warning: dependency %s is not a known job, job array or batch id' % t
+                job_ids.add(t)
+        return (job_ids, batch_ids)
+
+    def add_batch(self, batch_id, jobs):
+        """ Register the jobs of a batch that is being posted, returns the jobs that can be posted right away.
+
+            Jobs that are already done don't count towards the size of the batch.
+        """
+        ids = set()
+        for j in jobs:
+            ids.update(self.job_ids(j))
+        self.known_ids.update(ids)
+        self.batch_sizes[batch_id] = len(ids - self.done)
+
+        ready = []
+        for j in jobs:
+            targets = getattr(j, 'depends_on', [])
+            if len(targets) == 0:
+                ready.append(j)
+                continue
+            (job_ids, batch_ids) = self.resolve(targets)
+            if batch_id in batch_ids:
+                raise ConfigException('Job %s depends on its own batch %s' % (j.id, batch_id))
+            self.dependencies[j.id] = (job_ids, batch_ids)
+            self.held[j.id] = j
+        self.check_cycles()
+        return ready
+
+    def check_cycles(self):
+        """ Raise a ConfigException if held jobs depend on each other in a loop, they would never run. """
+        owners = {}
+        for jid,j in self.held.iteritems():
+            for eid in self.job_ids(j):
+                owners[eid] = jid
+
+        visiting = set()
+        done = set()
+        def visit(jid):
+            if jid in done:
+                return
+            if jid in visiting:
+                raise ConfigException('Job dependencies form a cycle through job %s' % jid)
+            visiting.add(jid)
+            for dep_id in self.dependencies[jid][0]:
+                if dep_id in owners:
+                    visit(owners[dep_id])
+            visiting.remove(jid)
+            done.add(jid)
+
+        for jid in self.held.keys():
+            visit(jid)
+
+    def num_held(self):
+        return sum([len(self.job_ids(j)) for j in self.held.values()])
+
+    def job_state(self, job_id, monitor):
+        """ 'done', 'failed' or 'waiting' """
+        if job_id in self.done:
+            return 'done'
+        if job_id in self.failed:
+            return 'failed'
+        status_msg = monitor.job_status.get(job_id)
+        if status_msg is None or status_msg['status'] != 'finished':
+            return 'waiting'
+        if status_msg.get('cancelled', False) or status_msg.get('ret_code', 0) != 0:
+            return 'failed'
+        return 'done'
+
+    def batch_state(self, batch_id, monitor, batch_stats=None):
+        """ 'done', 'failed' or 'waiting'. batch_stats caches monitor.batch_stats by batch id. """
+        if batch_id in self.failed_batches:
+            return 'failed'
+        if batch_stats is None:
+            batch_stats = {}
+        if batch_id not in batch_stats:
+            batch_stats[batch_id] = monitor.batch_stats(batch_id)
+        stats = batch_stats[batch_id]
+        if stats['num_failed'] + stats['num_cancelled'] > 0:
+            return 'failed'
+        if stats['num_finished'] >= self.batch_sizes[batch_id]:
+            return 'done'
+        return 'waiting'
+
+    def dependency_state(self, jid, monitor, batch_stats=None):
+        (job_ids, batch_ids) = self.dependencies[jid]
+        states = set([self.job_state(dep_id, monitor) for dep_id in job_ids] +
+                     [self.batch_state(b, monitor, batch_stats) for b in batch_ids])
+        if 'failed' in states:
+            return 'failed'
+        if 'waiting' in states:
+            return 'waiting'
+        return 'done'
+
+    def update(self, monitor):
+        """ Check the held jobs against the statuses read by monitor.
+
+            Returns a tuple (jobs to release, jobs to cancel). Cancelled jobs count as
+            failed for the jobs held behind them, so a failure cascades down the
+            whole graph in a single call. The stats of each batch depended on are read
+            from monitor once per call.
+        """
+        released = []
+        cancelled = []
+        batch_stats = {}
+        changed = True
+        while changed:
+            changed = False
+            for jid in self.held.keys():
+                state = self.dependency_state(jid, monitor, batch_stats)
+                if state == 'waiting':
+                    continue
+                j = self.held.pop(jid)
+                if state == 'done':
+                    released.append(j)
+                else:
+                    cancelled.append(j)
+                    self.failed.update(self.job_ids(j))
+                    self.failed_batches.add(j.batch_id)
+                    changed = True
+        return (released, cancelled)
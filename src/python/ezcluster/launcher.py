@@ -1,7 +1,18 @@
 import time
-import hashlib
+import tarfile
+import threading
+from Queue import Queue
+from cStringIO import StringIO
 
 from ezcluster.core import *
+from ezcluster.backend import get_backend
+from ezcluster.submit import BatchSubmitter
+from ezcluster.monitor import BatchMonitor
+from ezcluster.autoscale import Autoscaler
+from ezcluster.graph import JobGraph
+from ezcluster.queues import job_queue_specs, route_job
+from ezcluster.simulate import Planner, print_plan
+from ezcluster.pool import pool_options, WarmPool
 
 class Launcher():
     """ Launcher takes a bunch of job specifications and posts them to an SQS queue, creating the instances it needs to run them.
@@ -15,221 +26,750 @@ class Launcher():
         an image, add jobs in batch mode, and call launch(). Otherwise you can
         use the start_instances function and add_batch_job/post_jobs methods
         independently.
+
+        Batch jobs can depend on other jobs, job arrays or earlier batches (see
+        JobGraph). Those jobs are held by the launcher and posted as their
+        dependencies finish, which happens while it waits for the batch, so
+        start_instances always waits when jobs are held.
+
+        Every job posted gets an id of its own, so identical jobs posted together
+        (replicates) all run. Jobs also have a content key (see job_key), salted
+        with job_salt, and daemons record each job that succeeds in a completion
+        index in the blob store under its key. With skip_done, post_jobs skips jobs
+        whose identical run already succeeded, and so do the daemons, so
+        resubmitting a sweep only reruns what failed.
+
+        Jobs can be spread over several job queues with different priorities (see
+        job_queue_specs). A job goes to the queue named by its queue argument, or
+        else to the first queue that takes jobs of its expected_runtime, so short
+        and urgent jobs don't wait behind long batch jobs. Daemons poll the queues
+        in weighted order, see QueuePoller.
+
+        Daemons hold each job's message under a lease while it runs, so the jobs
+        of an instance that dies go back to the queue and are retried, up to
+        max_job_retries times. SQS keeps a message invisible for at most 12 hours
+        after it was received, so a job that runs longer than that is started again
+        by another daemon, which counts as a retry (see Lease).
+
+        When instances run several jobs at once, each job is pinned to cpus of its
+        own (pin_cpus) and its BLAS/OpenMP thread pools are sized to them. With
+        memory_per_core, in bytes or 'auto' for an even share of the machine, a job
+        is also limited to that much memory per core it runs on, see JobIsolation.
+
+        With a warm pool (see WarmPool), finished instances are parked instead of
+        terminated, and later launches resume them before reserving new ones.
+
+        Sweeps too large to hold in memory can be posted from a file of job specs
+        with the stream.py command line tool, see StreamSubmitter.
+
+        The queues, blob store and instances come from the backend set in the
+        config file (see get_backend). With the local backend, image_name and
+        keypair_name are ignored and each "instance" is a Daemon process on
+        this machine.
     """
     
     def __init__(self, image_name, keypair_name, instance_type='m1.small',
                  security_groups=['default'], num_instances=1,
-                 num_jobs_per_instance=1, quit_when_done=True, wait_for_completion=False, instance_name=False):
-        
-        self.conn = boto.ec2.connect_to_region(config.get('ec2', 'region'))
+                 num_jobs_per_instance=1, quit_when_done=True, wait_for_completion=False, instance_name=False,
+                 num_submit_threads=4, job_buffer_size=100, num_cores_per_instance=None, upload_code=True,
+                 array_chunk_size=1000, input_cache_size=10*1024**3, max_job_retries=3, job_salt='',
+                 pin_cpus=True, memory_per_core=None, skip_done=False):
         
-        imgs = self.conn.get_all_images([image_name])
-        if len(imgs) < 1:
-            raise ConfigException('Cannot locate image by name: %s' % image_name)
-        self.image = imgs[0]
+        self.backend = get_backend()
+        self.conn = None
+        self.image = None
+        if not self.backend.is_local:
+            self.conn = boto.ec2.connect_to_region(config.get('ec2', 'region'))
+
+        #only needed to start instances, a launcher can just post jobs
+        if not self.backend.is_local and image_name is not None:
+            imgs = self.conn.get_all_images([image_name])
+            if len(imgs) < 1:
+                raise ConfigException('Cannot locate image by name: %s' % image_name)
+            self.image = imgs[0]
+
+        self.pool = None
+        (pool_size, pool_linger, pool_max_idle) = pool_options()
+        if pool_size > 0 and self.image is not None:
+            self.pool = WarmPool(self.conn, self.image.id, instance_type, keypair_name, pool_size,
+                                 linger=pool_linger, max_idle=pool_max_idle)
         
-        self.sqs = boto.connect_sqs()
-        qname = config.get('sqs', 'job_queue')
-        self.job_queue = self.sqs.get_queue(qname)
-        if self.job_queue is None:
-            raise ConfigException('Cannot connect to SQS queue: %s' % qname)
+        self.queue_specs = job_queue_specs()
+        qnames = [name for (name, weight, max_runtime) in self.queue_specs]
+        self.job_queues = dict([(qname, self.backend.connect_queue(qname)) for qname in qnames])
+        self.submitters = dict([(qname, BatchSubmitter(qname, num_threads=num_submit_threads, backend=self.backend))
+                                for qname in qnames])
+        self.job_queue = self.job_queues[qnames[-1]]
+        self.submitter = self.submitters[qnames[-1]]
+        self.status_submitter = BatchSubmitter(config.get('sqs', 'status_queue'), backend=self.backend)
         
         self.keypair_name = keypair_name
         self.security_groups = security_groups
         self.instance_type = instance_type
         self.num_instances = num_instances
         self.num_jobs_per_instance = num_jobs_per_instance        
+        self.num_cores_per_instance = num_cores_per_instance
         self.jobs = []
+        self.job_buffer = []
+        self.job_buffer_size = job_buffer_size
         self.instances=[]
+        #instances are added by the bring up threads and retired by the autoscaler
+        self.instances_lock = threading.Lock()
         self.application_script_file = None
         self.quit_when_done=quit_when_done
         self.wait_for_completion=wait_for_completion
         self.instance_name = instance_name
+        self.upload_code = upload_code
+        self.code_hash = None
+        self.batch_id = None
+        self.num_batch_jobs = 0
+        self.array_chunk_size = array_chunk_size
+        self.input_cache_size = input_cache_size
+        self.pin_cpus = pin_cpus
+        self.memory_per_core = memory_per_core
+        self.max_job_retries = max_job_retries
+        self.job_salt = job_salt
+        self.skip_done = skip_done
+        self.graph = JobGraph()
+        #status messages are deleted once read, so one monitor keeps the statuses of every batch
+        self.monitor = None
+
+    def get_monitor(self):
+        """ The BatchMonitor that reads the status messages of every batch this launcher waits for. """
+        if self.monitor is None:
+            self.monitor = BatchMonitor(backend=self.backend)
+        return self.monitor
+
+    def ssh_options(self):
+        """ Options shared by every ssh/scp call, connections to an instance reuse a single master connection. """
+        return ['-o', 'StrictHostKeyChecking=no',
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=/tmp/ezcluster-ssh-%r@%h:%p',
+                '-o', 'ControlPersist=600',
+                '-i', config.get('ec2', 'keypair_file')]
 
     def is_ssh_running(self, instance):
+        if self.backend.is_local:
+            return instance.update() == 'running'
         host_str = '%s@%s' % (config.get('ec2', 'user'), instance.public_dns_name)
-        ret_code = subprocess.call(['ssh', '-o', 'ConnectTimeout=15',
-                                    '-o', 'StrictHostKeyChecking=no',
-                                    '-i', config.get('ec2', 'keypair_file'),
-                                    host_str, 'exit'], shell=False, close_fds=True)
+        ret_code = subprocess.call(['ssh', '-o', 'ConnectTimeout=15'] + self.ssh_options() +
+                                   [host_str, 'exit'], shell=False, close_fds=True)
         return ret_code == 0
         
     def scp(self, instance, src_file, dest_file):
         dest_str = '%s@%s:%s' % (config.get('ec2', 'user'), instance.public_dns_name, dest_file)
-        cmds = ['scp', '-o', 'StrictHostKeyChecking=no',
-                '-i', config.get('ec2', 'keypair_file'),
-                src_file, dest_str]
+        cmds = ['scp'] + self.ssh_options() + [src_file, dest_str]
         subprocess.call(cmds, shell=False, close_fds=True)
         
-    def scmd(self, instance, cmd, use_shell=False, remote_output_file='/dev/null'):        
+    def scmd(self, instance, cmd, use_shell=False, remote_output_file='/dev/null', input=None):
+        """ Run a command on the instance in the background. If input is given, it is
+            piped to the command's stdin and the command runs in the foreground.
+        """
         host_str = '%s@%s' % (config.get('ec2', 'user'), instance.public_dns_name)        
-        cstr = '""nohup %s >> %s 2>> %s < /dev/null &""' %\
-                (cmd, remote_output_file, remote_output_file)
-        cmds = ['ssh', '-o', 'StrictHostKeyChecking=no',
-                '-i', config.get('ec2', 'keypair_file'),
-                host_str, cstr]
+        if input is None:
+            cstr = '""nohup %s >> %s 2>> %s < /dev/null &""' %\
+                    (cmd, remote_output_file, remote_output_file)
+        else:
+            cstr = cmd
+        cmds = ['ssh'] + self.ssh_options() + [host_str, cstr]
         #print ' '.join(cmds)
-        proc = subprocess.Popen(cmds, shell=False, close_fds=True)
-        proc.communicate()
+        stdin = None
+        if input is not None:
+            stdin = subprocess.PIPE
+        proc = subprocess.Popen(cmds, shell=False, close_fds=True, stdin=stdin)
+        proc.communicate(input)
         ret_code = proc.poll()
         return ret_code
     
     
-    def generate_job_id(self):
-        s = '%0.6f' % time.time()
-        md5 = hashlib.md5()
-        md5.update(s)
-        return md5.hexdigest()    
+    def make_job_id(self, j):
+        """ A new id for a job or job array, and the content key of a job (see job_key), salted with job_salt.
+
+            The elements of a job array get their keys from the array's salt.
+        """
+        if isinstance(j, JobArray):
+            j.salt = self.job_salt
+        else:
+            j.key = job_key(j.cmds, j.inputs, j.outputs, self.job_salt)
+        return new_job_id()
+
+    def job_keys(self, j):
+        """ Content keys of a job, or of the elements of a job array, in the order of job_ids. """
+        if isinstance(j, JobArray):
+            return j.element_keys()
+        return [j.key]
+
+    def find_done(self, keys, max_lookups=1000):
+        """ The content keys among keys that are in the completion index, done/<key> in the blob store.
+
+            Up to max_lookups keys are looked up one by one over num_submit_threads
+            connections, more than that by listing the whole index. With max_lookups
+            None, keys are always looked up one by one.
+        """
+        keys = set(keys)
+        if len(keys) == 0:
+            return set()
+        if max_lookups is not None and len(keys) > max_lookups:
+            store = self.backend.connect_blob_store()
+            return set([os.path.basename(name) for name in store.list('done')]) & keys
+        work = Queue()
+        for key in keys:
+            work.put(key)
+        done = set()
+        lock = threading.Lock()
+
+        def worker():
+            store = self.backend.connect_blob_store()
+            while True:
+                key = work.get()
+                if key is None:
+                    break
+                if store.exists('done/%s' % key):
+                    with lock:
+                        done.add(key)
+
+        threads = [threading.Thread(target=worker) for k in range(min(self.submitter.num_threads, len(keys)))]
+        for t in threads:
+            work.put(None)
+            t.start()
+        for t in threads:
+            t.join()
+        return done
+
+    def mark_done(self, jobs, max_lookups=1000):
+        """ Add the ids of jobs, and job array elements, whose content key is in the completion index
+            to graph.done, see find_done. Returns a tuple (# done, # looked up).
+        """
+        ids_by_key = {}
+        for j in jobs:
+            for (jid, key) in zip(self.graph.job_ids(j), self.job_keys(j)):
+                ids_by_key.setdefault(key, []).append(jid)
+        num_done = 0
+        for key in self.find_done(ids_by_key.keys(), max_lookups=max_lookups):
+            self.graph.done.update(ids_by_key[key])
+            num_done += len(ids_by_key[key])
+        return (num_done, sum([len(ids) for ids in ids_by_key.values()]))
         
-    def add_batch_job(self, cmds, num_cpus=1, expected_runtime=-1, log_file_template=None):
-        """ Adds a job to the local queue, job will be posted to SQS queue with call to post_jobs """
-        j = Job(cmds, num_cpus=num_cpus, expected_runtime=expected_runtime, log_file_template=log_file_template)
+    def add_batch_job(self, cmds, num_cpus=1, expected_runtime=-1, log_file_template=None, depends_on=[], inputs={},
+                      outputs=[], queue=None):
+        """ Adds a job to the local queue, job will be posted to SQS queue with call to post_jobs.
+
+            depends_on is a list of Jobs, JobArrays, job ids or batch ids the job waits
+            for, see JobGraph. inputs are staged through the worker's input cache and
+            outputs are uploaded when the job exits, see Job. queue names the job queue
+            to post to, by default it is picked from expected_runtime, see route_job.
+            Returns the Job, so later jobs can depend on it.
+        """
+        j = Job(cmds, num_cpus=num_cpus, expected_runtime=expected_runtime, log_file_template=log_file_template,
+                inputs=inputs, outputs=outputs)
+        j.depends_on = list(depends_on)
+        j.queue = queue
         self.jobs.append(j)
+        return j
     
-    def add_job(self, cmds, num_cpus=1, expected_runtime=-1, log_file_template=None, batch_id=None):
-        """ Skips the local queue and posts job directly to SQS queue """ 
-        j = Job(cmds, num_cpus=num_cpus, expected_runtime=expected_runtime, log_file_template=log_file_template)
+    def add_batch_job_array(self, cmds, params={}, num_elements=None, num_cpus=1, expected_runtime=-1,
+                            log_file_template=None, depends_on=[], inputs={}, outputs=[], queue=None):
+        """ Adds a job array to the local queue, see JobArray. Each element runs as its own job with
+            its own id, log file and status, but the array is posted as a few messages. The whole
+            array waits for depends_on and goes to queue, see add_batch_job. Returns the JobArray.
+        """
+        ja = JobArray(cmds, params, num_cpus=num_cpus, expected_runtime=expected_runtime,
+                      log_file_template=log_file_template, num_elements=num_elements, inputs=inputs,
+                      outputs=outputs)
+        ja.depends_on = list(depends_on)
+        ja.queue = queue
+        self.jobs.append(ja)
+        return ja
+    
+    def add_job(self, cmds, num_cpus=1, expected_runtime=-1, log_file_template=None, batch_id=None, buffered=False,
+                inputs={}, outputs=[], queue=None):
+        """ Skips the local queue and posts job directly to SQS queue, see add_batch_job for queue.
+
+            If buffered is True, the job is held in a small buffer that is sent
+            with batch requests once it holds job_buffer_size jobs, or when
+            flush_jobs is called.
+        """
+        j = Job(cmds, num_cpus=num_cpus, expected_runtime=expected_runtime, log_file_template=log_file_template,
+                inputs=inputs, outputs=outputs)
         j.batch_id = batch_id
-        self.post_job(j)
+        j.queue = queue
+        if not buffered:
+            self.post_job(j)
+            return
+        j.id = self.make_job_id(j)
+        self.job_buffer.append(j)
+        if len(self.job_buffer) >= self.job_buffer_size:
+            self.flush_jobs()
+
+    def flush_jobs(self):
+        """ Posts any buffered jobs from add_job to the SQS queue """
+        jobs = self.job_buffer
+        self.job_buffer = []
+        return self.submit_jobs(jobs)
 
-    def post_jobs(self, batch_id=None):
-        """ Takes jobs in local queue and posts them to SQS queue """
+    def post_jobs(self, batch_id=None, skip_done=None):
+        """ Takes jobs in local queue and posts them to SQS queue, jobs with dependencies are held back.
+
+            skip_done defaults to the launcher's. If it is True, jobs (and job array
+            elements) whose content key is in the completion index are not posted at
+            all, and the daemons skip the ones that succeed elsewhere before they run.
+        """
         if batch_id is None:
             batch_id = random_string(10)
-        for k,j in enumerate(self.jobs):
+        if skip_done is None:
+            skip_done = self.skip_done
+        jobs = self.jobs
+        for j in jobs:
             j.batch_id = batch_id
-            self.post_job(j, id=self.generate_job_id())
+            j.id = self.make_job_id(j)
+            j.skip_done = skip_done
+
+        ids = set()
+        for j in jobs:
+            ids.update(self.graph.job_ids(j))
+        if skip_done:
+            (num_done, num_jobs) = self.mark_done(jobs)
+            if num_done > 0:
+                print '%d of %d jobs are already done, skipping them' % (num_done, num_jobs)
+        jobs = [j for j in jobs if not set(self.graph.job_ids(j)) <= self.graph.done]
+
+        self.batch_id = batch_id
+        self.num_batch_jobs = len(ids - self.graph.done)
+        ready = self.graph.add_batch(batch_id, jobs)
+        if len(ready) < len(jobs):
+            print 'Holding %d jobs until their dependencies finish' % self.graph.num_held()
+        num_failed = self.submit_jobs(ready)
+        #jobs that depend on batches that finished before this one was posted go out right away
+        if self.monitor is not None and self.graph.num_held() > 0:
+            self.release_jobs(self.monitor)
+        return num_failed
+
+    def pending_parts(self, ja):
+        """ Sub arrays of a job array that cover the elements that are not done yet. """
+        parts = []
+        run_start = None
+        for k,eid in enumerate(self.graph.job_ids(ja) + [None]):
+            if eid is None or eid in self.graph.done:
+                if run_start is not None:
+                    parts.append(ja.sub_array(ja.start + run_start, ja.start + k))
+                    run_start = None
+            elif run_start is None:
+                run_start = k
+        return parts
+
+    def release_jobs(self, monitor):
+        """ Post the held jobs whose dependencies have finished, and cancel the ones whose dependencies failed.
+
+            Each cancelled job gets a 'finished' status message with 'cancelled' set,
+            so monitors count it as done.
+        """
+        (released, cancelled) = self.graph.update(monitor)
+        if len(released) > 0:
+            print 'Dependencies finished, releasing %d jobs' % len(released)
+            self.submit_jobs(released)
+        if len(cancelled) > 0:
+            bodies = []
+            for j in cancelled:
+                jobs = [j]
+                if isinstance(j, JobArray):
+                    jobs = [j.element(index) for index in range(j.start, j.end)]
+                    jobs = [ej for ej in jobs if ej.id not in self.graph.done]
+                for ej in jobs:
+                    status_msg = {'type':'job_status',
+                                  'job':ej.to_dict(),
+                                  'batch_id':str(ej.batch_id),
+                                  'instance':None,
+                                  'last_update':time.time(),
+                                  'status':'finished',
+                                  'ret_code':None,
+                                  'cancelled':True}
+                    bodies.append(json.dumps(status_msg))
+            print 'Dependencies failed, cancelling %d jobs' % len(bodies)
+            self.status_submitter.submit(bodies)
+
+    def submit_jobs(self, jobs, verbose=True, failed=None):
+        """ Posts jobs that already have ids to their SQS queues using batch sends, returns the number that failed.
+
+            If failed is a list, a (queue name, message body) pair is appended to it for every message that failed.
+        """
+        bodies = {}
+        for j in jobs:
+            qbodies = bodies.setdefault(route_job(self.queue_specs, j), [])
+            if isinstance(j, JobArray):
+                for part in self.pending_parts(j):
+                    qbodies.extend([self.job_message_body(ja) for ja in part.split(self.array_chunk_size)])
+            else:
+                qbodies.append(self.job_message_body(j))
+        num_failed = 0
+        for (qname, qbodies) in bodies.iteritems():
+            num_failed += self.submitters[qname].submit(qbodies, verbose=verbose)
+            if failed is not None:
+                failed.extend([(qname, body) for body in self.submitters[qname].failed_bodies])
+        return num_failed
+
+    def job_message_body(self, j):
+        ji = j.to_dict()
+        ji['batch_id'] = str(j.batch_id)
+        ji['max_retries'] = self.max_job_retries
+        ji['posted_on'] = time.time()
+        ji['skip_done'] = getattr(j, 'skip_done', self.skip_done)
+        return json.dumps(ji)
             
     def post_job(self, j, id=None):
         """ Posts a single job to SQS queue """
         if id is None:
-            id = self.generate_job_id()            
+            id = self.make_job_id(j)
         j.id = id
-        ji = j.to_dict()        
-        ji['batch_id'] = str(j.batch_id)            
-        msg = self.job_queue.new_message(body=json.dumps(ji))
-        self.job_queue.write(msg)
+        queue = self.job_queues[route_job(self.queue_specs, j)]
+        queue.write(queue.new_message(body=self.job_message_body(j)))
 
     def set_application_script(self, file_name):
         self.application_script_file = file_name
                 
-    def start_instances(self, timeout_after=1800):
+    def start_instances(self, timeout_after=1800, num_init_threads=10, poll_time=5.0):
         """ Starts the number of instances specified in the constructor.
         
             The steps it takes to do this are as follows:
-            1) Start each instance with the specified security group, keypair, and insatnce type.
+            0) Upload the ezcluster code bundle to S3 if it has changed (see send_self_tgz_to_s3)
+            1) Claim instances from the warm pool, if there is one, and reserve the rest with one
+               request, with the specified security group, keypair, and instance type.
             2) Wait for each instance to be in a running state with a working SSH connection
             3) Initialize each instance by copying over some files and running a script (see initialize_instance)
+
+            Steps 2 and 3 run in parallel over a pool of num_init_threads threads, so each
+            instance starts its daemon as soon as it is ready.
         """ 
         
-        #send_self_tgz_to_s3()
-        instances_pending = []
-        print 'Starting %d instances...' % self.num_instances
-        for k in range(self.num_instances):
-            res = self.image.run(key_name=self.keypair_name,
+        if self.upload_code and not self.backend.is_local:
+            self.code_hash = send_self_tgz_to_s3()
+        ready_times = self.add_instances(self.num_instances, timeout_after=timeout_after,
+                                         num_init_threads=num_init_threads, poll_time=poll_time)
+
+        if len(ready_times) > 0:
+            print 'Time to first ready instance: %0.1fs, time to all ready: %0.1fs' % \
+                  (min(ready_times.values()), max(ready_times.values()))
+        if len(ready_times) < self.num_instances:
+            print 'Timed out! Only %d instances were started...' % len(ready_times)
+        if self.graph.num_held() > 0 and not self.wait_for_completion:
+            print 'Waiting for batch %s, %d jobs are held until their dependencies finish' % \
+                  (self.batch_id, self.graph.num_held())
+        if self.wait_for_completion or self.graph.num_held() > 0:
+            if self.batch_id is not None:
+                self.wait_for_batch()
+            else:
+                self.wait_for_instances()
+
+    def add_instances(self, num_instances, timeout_after=1800, num_init_threads=10, poll_time=5.0):
+        """ Claim num_instances more instances from the warm pool, reserve the rest with one request
+            and bring them all up, see bring_up_instances.
+
+            Returns a dictionary of instance id to seconds until the instance was initialized.
+        """
+        start_time = time.time()
+        print 'Starting %d instances...' % num_instances
+        if self.backend.is_local:
+            return self.start_local_workers(num_instances, start_time)
+        if self.image is None:
+            raise ConfigException('No image to start instances from, the launcher was made without an image_name')
+        first_index = len(self.instances)
+        instances = []
+        if self.pool is not None:
+            claimed = self.pool.claim(num_instances)
+            if len(claimed) > 0:
+                num_current = len([inst for (inst, chash) in claimed if chash == str(self.code_hash)])
+                print 'Resuming %d instances from the warm pool, %d of them have the current code bundle' % \
+                      (len(claimed), num_current)
+            instances = [inst for (inst, chash) in claimed]
+        num_new = num_instances - len(instances)
+        if num_new > 0:
+            res = self.image.run(min_count=num_new,
+                                 max_count=num_new,
+                                 key_name=self.keypair_name,
                                  security_groups=self.security_groups,
                                  disable_api_termination=False,
                                  instance_type=self.instance_type)
-            if len(res.instances) < 1:
+            if len(res.instances) < num_new:
                 raise ConfigException('Could not reserve instance for some reason...')
-            if self.instance_name:
+            instances.extend(res.instances)
+        if self.instance_name:
+            for k,inst in enumerate(instances):
                 try:
-                  self.conn.create_tags([res.instances[0].id], {"Name": self.instance_name + ( ':' + str(k) if self.num_instances > 1 else '' )})
+                  self.conn.create_tags([inst.id], {"Name": self.instance_name + ( ':' + str(first_index+k) if self.num_instances > 1 else '' )})
                 except:
                   pass # do nothing
 
-            instances_pending.append(res.instances[0])
-        
-        #give the startup a bit of time
-        print 'Giving the startup 30 seconds...'
-        time.sleep(30.0)
-        
-        start_time = time.time()
-        timed_out = False
-        while len(instances_pending) > 0 and not timed_out:
-            for k,inst in enumerate(instances_pending):
+        return self.bring_up_instances(instances, start_time, timeout_after=timeout_after,
+                                       num_init_threads=num_init_threads, poll_time=poll_time)
+
+    def start_local_workers(self, num_workers, start_time):
+        """ Start Daemon processes on this machine in place of instances, they are ready right away. """
+        env = {'NUM_JOBS_PER_INSTANCE':self.num_jobs_per_instance,
+               'NUM_CORES':self.num_cores_per_instance,
+               'INPUT_CACHE_SIZE':self.input_cache_size,
+               #workers share this machine, pinning their jobs would stack them on the same cpus
+               'PIN_CPUS':False,
+               'MEMORY_PER_CORE':self.memory_per_core}
+        ready_times = {}
+        for w in self.backend.start_workers(num_workers, env, self.quit_when_done):
+            w.ready_time = time.time()
+            with self.instances_lock:
+                self.instances.append(w)
+            ready_times[w.id] = w.ready_time - start_time
+        return ready_times
+
+    def terminate_instances(self, instance_ids):
+        """ Terminate instances, or with a warm pool, park and stop as many as it has room for. """
+        with self.instances_lock:
+            instances = list(self.instances)
+        if self.backend.is_local:
+            for inst in instances:
+                if inst.id in instance_ids:
+                    inst.terminate()
+            return
+        if self.pool is not None:
+            parked = [inst.id for inst in instances if inst.id in instance_ids and self.pool.park(inst, self.code_hash)]
+            if len(parked) > 0:
+                self.conn.stop_instances(instance_ids=parked)
+            instance_ids = [iid for iid in instance_ids if iid not in parked]
+        if len(instance_ids) > 0:
+            self.conn.terminate_instances(instance_ids=instance_ids)
+
+    def drain_pool(self):
+        """ Terminate every instance in the warm pool, returns their ids. """
+        if self.pool is None:
+            return []
+        return self.pool.drain()
+
+    def bring_up_instances(self, instances, start_time, timeout_after=1800, num_init_threads=10, poll_time=5.0,
+                           max_init_tries=3):
+        """ Wait for reserved instances to run SSH and initialize them in parallel.
+
+            The state of all pending instances is checked with a single request per pass,
+            and each running instance is handed to a pool of threads that probe SSH and call
+            initialize_instance, up to max_init_tries times. Instances that never come up
+            within timeout_after seconds or fail every try are terminated, so they don't
+            keep running without a daemon. Returns a dictionary of instance id to seconds
+            from start_time until the instance was initialized.
+        """
+        ready_times = {}
+        failed = []
+        lock = threading.Lock()
+        running = Queue()
+
+        def init(inst):
+            for k in range(max_init_tries):
                 try:
-                    if inst.update() == 'running' and self.is_ssh_running(inst):
-                        self.initialize_instance(inst)
-                        self.instances.append(inst)
-                        del instances_pending[k]
-                        break
-                except:
-                    pass
-            time.sleep(5.0)
-            timed_out = (time.time() - start_time) > timeout_after
-            
-        if timed_out:
-            print 'Timed out! Only %d instances were started...' % \
-                  (self.num_instances - len(instances_pending))
-        if self.wait_for_completion:
-            self.wait_for_instances()
+                    while not self.is_ssh_running(inst):
+                        if (time.time() - start_time) > timeout_after:
+                            raise ConfigException('SSH never came up')
+                        time.sleep(poll_time)
+                    self.initialize_instance(inst)
+                    return True
+                except Exception, e:
+                    print 'Could not initialize instance %s (try %d of %d): %s' % \
+                          (inst.id, k + 1, max_init_tries, str(e))
+                    if (time.time() - start_time) > timeout_after:
+                        return False
+            return False
+
+        def worker():
+            while True:
+                inst = running.get()
+                if inst is None:
+                    break
+                if not init(inst):
+                    with lock:
+                        failed.append(inst)
+                    continue
+                inst.ready_time = time.time()
+                with self.instances_lock:
+                    self.instances.append(inst)
+                with lock:
+                    ready_times[inst.id] = inst.ready_time - start_time
+                print 'Instance %s ready after %0.1fs' % (inst.public_dns_name, ready_times[inst.id])
+
+        threads = [threading.Thread(target=worker) for k in range(min(num_init_threads, len(instances)))]
+        for t in threads:
+            t.start()
+
+        pending = dict([(inst.id, inst) for inst in instances])
+        while len(pending) > 0 and (time.time() - start_time) < timeout_after:
+            time.sleep(poll_time)
+            try:
+                reservations = self.conn.get_all_instances(instance_ids=pending.keys())
+            except Exception:
+                continue
+            for r in reservations:
+                for inst in r.instances:
+                    if inst.state == 'running' and inst.id in pending:
+                        del pending[inst.id]
+                        running.put(inst)
+
+        for t in threads:
+            running.put(None)
+        for t in threads:
+            t.join()
+
+        #instances that never ran or never initialized
+        failed_ids = [inst.id for inst in failed] + pending.keys()
+        if len(failed_ids) > 0:
+            print 'Terminating %d instances that could not be brought up' % len(failed_ids)
+            with self.instances_lock:
+                self.instances[:] = [inst for inst in self.instances if inst.id not in failed_ids]
+            try:
+                self.conn.terminate_instances(instance_ids=failed_ids)
+            except Exception, e:
+                print 'Could not terminate instances %s: %s' % (', '.join(failed_ids), str(e))
+        return ready_times
     
-    def fill_template_and_scp(self, instance, params, template_file, dest_file):
-        tpl = ScriptTemplate(template_file)
-        str = tpl.fill(params)
-        tfile = tempfile.NamedTemporaryFile('w', delete=False)
-        tfile.write(str)
-        tfile.close()
-        self.scp(instance, tfile.name, dest_file)
-        os.remove(tfile.name)
+    def add_to_archive(self, tf, name, data, mode):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = mode
+        info.mtime = time.time()
+        tf.addfile(info, StringIO(data))
+
+    def create_init_archive(self, instance):
+        """ Render the templates and collect the files an instance needs into an in-memory tar archive. """
+
+        params = {}
+        params['ACCESS_KEY'] = self.conn.access_key
+        params['SECRET_KEY'] = self.conn.secret_key
+        params['REGION_URL'] = 'http://%s' % self.conn.region.endpoint
+        params['DNS_NAME'] = instance.public_dns_name
+        params['INSTANCE_ID'] = instance.id
+        params['NUM_JOBS_PER_INSTANCE'] = self.num_jobs_per_instance
+        params['NUM_CORES'] = self.num_cores_per_instance
+        params['INPUT_CACHE_SIZE'] = self.input_cache_size
+        params['PIN_CPUS'] = self.pin_cpus
+        params['MEMORY_PER_CORE'] = self.memory_per_core
+        params['BUCKET'] = config.get('s3', 'bucket')
+        params['QUIT_WHEN_EMPTY'] = self.quit_when_done
+        params['CODE_HASH'] = self.code_hash
+
+        buf = StringIO()
+        tf = tarfile.open(fileobj=buf, mode='w')
+        self.add_to_archive(tf, 's3cfg', ScriptTemplate(os.path.join(SH_DIR, 's3cfg')).fill(params), 0600)
+        for (src_file, dest_name) in [(config.get('ec2', 'cert_file'), 'cert.pem'),
+                                      (config.get('ec2', 'private_key_file'), 'private_key.pem')]:
+            f = open(src_file, 'r')
+            self.add_to_archive(tf, dest_name, f.read(), 0600)
+            f.close()
+        self.add_to_archive(tf, 'start-daemon.sh',
+                            ScriptTemplate(os.path.join(SH_DIR, 'start-daemon.sh')).fill(params), 0500)
+        if self.application_script_file is not None:
+            self.add_to_archive(tf, 'application-script.sh',
+                                ScriptTemplate(self.application_script_file).fill(params), 0500)
+        tf.close()
+        return buf.getvalue()
     
     def initialize_instance(self, instance):
-        """ Initialize a started EC2 instance. T
+        """ Initialize a started EC2 instance.
         
             The instance is assumed to have ec2-api-tools, s3cmd, and python
             installed, as well as a running SSH daemon. All uploaded files are
-            stored in /tmp. The following steps are taken:
+            stored in /tmp. The following files are rendered and streamed over
+            as one tar archive on a single (shared) SSH connection:
             
-            1) Send over an s3cmd config file filled in the right keys to /tmp/s3cmd
-            2) Send over cert and private key to /tmp/cert.pem and /tmp/private_key.pem
-            3) Send over a shell script to /tmp/start-daemon.sh that sets the right
+            1) An s3cmd config file filled in the right keys, moved to ~/.s3cfg
+            2) The cert and private key, to /tmp/cert.pem and /tmp/private_key.pem
+            3) A shell script, /tmp/start-daemon.sh, that sets the right
                environment variables, gets ezcluster installed from S3, and then starts
                a daemon.
-            4) Start the shell script.
+            4) The application script, if there is one, to /tmp/application-script.sh
+
+            The same remote command unpacks the archive and starts the shell script.
         """
         
         print 'Initializing instance: %s' % instance.public_dns_name
         
-        #copy s3cfg file
-        params = {}
-        params['ACCESS_KEY'] = self.conn.access_key
-        params['SECRET_KEY'] = self.conn.secret_key
-        self.fill_template_and_scp(instance, params,
-                                   os.path.join(SH_DIR, 's3cfg'),
-                                   '~/.s3cfg')
-        
-        #copy files over to instance
-        self.scp(instance, config.get('ec2', 'cert_file'), '/tmp/cert.pem')
-        self.scp(instance, config.get('ec2', 'private_key_file'), '/tmp/private_key.pem')
-        
-        params = {}
-        params['ACCESS_KEY'] = self.conn.access_key
-        params['SECRET_KEY'] = self.conn.secret_key
-        params['REGION_URL'] = 'http://%s' % self.conn.region.endpoint
-        params['DNS_NAME'] = instance.public_dns_name
-        params['INSTANCE_ID'] = instance.id
-        params['NUM_JOBS_PER_INSTANCE'] = self.num_jobs_per_instance
-        params['BUCKET'] = config.get('s3', 'bucket')
-        params['QUIT_WHEN_EMPTY'] = self.quit_when_done
-         
-        self.fill_template_and_scp(instance, params,
-                                   os.path.join(SH_DIR, 'start-daemon.sh'),
-                                   '/tmp/start-daemon.sh')
-        self.scmd(instance, 'chmod 500 /tmp/start-daemon.sh')
-        
-        if self.application_script_file is not None:
-            self.fill_template_and_scp(instance, params,
-                                       self.application_script_file,
-                                       '/tmp/application-script.sh')
-            self.scmd(instance, 'chmod 500 /tmp/application-script.sh')
-        
-        self.scmd(instance, '/tmp/start-daemon.sh', remote_output_file='/tmp/ezcluster-daemon-startup.log')        
+        archive = self.create_init_archive(instance)
+        log_file = '/tmp/ezcluster-daemon-startup.log'
+        cmd = 'tar xpf - -C /tmp && mv /tmp/s3cfg ~/.s3cfg && '\
+              '(nohup /tmp/start-daemon.sh >> %s 2>> %s < /dev/null &)' % (log_file, log_file)
+        ret_code = self.scmd(instance, cmd, input=archive)
+        if ret_code != 0:
+            raise ConfigException('Initializing instance %s failed, ret_code=%d' % (instance.id, ret_code))
                 
     def launch(self):
         self.post_jobs()        
         self.start_instances()
 
+    def simulate(self, configs=None, runtimes={}, default_runtime=None, startup_delay=120.0, startup_stagger=0.0,
+                 dispatch_overhead=0.0, idle_timeout=30.0, verbose=True):
+        """ Dry run: predict how the queued jobs would run, without posting them or starting anything.
+
+            Each configuration in configs is a dictionary of instance_type, num_instances,
+            num_jobs_per_instance, num_cores, speed and hourly_price, the ones left out
+            are taken from the launcher (num_cores defaults to num_jobs_per_instance if
+            num_cores_per_instance is None). runtimes maps job content keys to historical
+            runtimes, see historical_runtimes. Returns a list of results with the predicted makespan,
+            utilization, instance hours and cost of each configuration, see Planner.
+        """
+        jobs = []
+        for j in self.jobs:
+            runtime = float(j.expected_runtime or -1)
+            if runtime <= 0:
+                runtime = default_runtime
+            if isinstance(j, JobArray):
+                j.salt = self.job_salt
+                keys = [None] * len(j)
+                if len(runtimes) > 0:
+                    keys = j.element_keys()
+                jobs.extend([(j.num_cpus, runtimes.get(key, runtime)) for key in keys])
+            elif len(runtimes) > 0:
+                key = job_key(j.cmds, j.inputs, j.outputs, self.job_salt)
+                jobs.append((j.num_cpus, runtimes.get(key, runtime)))
+            else:
+                jobs.append((j.num_cpus, runtime))
+        if None in [runtime for (ncpus, runtime) in jobs]:
+            raise ConfigException('Some jobs have no expected_runtime or historical runtime, set default_runtime')
+
+        base = {'instance_type':self.instance_type,
+                'num_instances':self.num_instances,
+                'num_jobs_per_instance':self.num_jobs_per_instance,
+                'num_cores':self.num_cores_per_instance or self.num_jobs_per_instance}
+        if configs is None:
+            configs = [{}]
+        full_configs = []
+        for c in configs:
+            config = dict(base)
+            config.update(c)
+            full_configs.append(config)
+        planner = Planner(jobs, startup_delay=startup_delay, startup_stagger=startup_stagger,
+                          dispatch_overhead=dispatch_overhead, idle_timeout=idle_timeout)
+        results = planner.sweep(full_configs)
+        if verbose:
+            print_plan(results)
+        return results
+
+    def autoscale(self, max_instances, min_instances=0, target_time=3600.0, idle_time=120.0,
+                  check_interval=60.0, timeout_after=None):
+        """ Post the jobs and add or retire instances with the queued work until they are done, see Autoscaler. """
+        self.post_jobs()
+        if self.upload_code and not self.backend.is_local:
+            self.code_hash = send_self_tgz_to_s3()
+        scaler = Autoscaler(self, max_instances, min_instances=min_instances, target_time=target_time,
+                            idle_time=idle_time, check_interval=check_interval)
+        scaler.run(timeout_after=timeout_after)
+        return scaler
+
+    def wait_for_batch(self, batch_id=None, num_jobs=None, timeout_after=None):
+        """ Wait for the jobs of a batch to finish by reading their status messages, see BatchMonitor.
+
+            Defaults to the batch posted by the last call to post_jobs. The number of jobs
+            of a batch posted by this launcher is looked up, other batches need num_jobs.
+        """
+        if batch_id is None:
+            batch_id = self.batch_id
+            num_jobs = self.num_batch_jobs
+        if num_jobs is None:
+            if batch_id not in self.graph.batch_sizes:
+                raise ConfigException('Batch %s was not posted by this launcher, num_jobs is needed to wait for it' % batch_id)
+            num_jobs = self.graph.batch_sizes[batch_id]
+        return self.get_monitor().wait_for_batch(batch_id, num_jobs, timeout_after=timeout_after,
+                                                 callback=self.release_jobs)
+
     def wait_for_instances(self):
         instances_active=True
         print('waiting for completion')
@@ -0,0 +1,81 @@
+from ezcluster.core import *
+
+logger = logging.getLogger('daemon')
+
+#SQS keeps a message invisible for at most 12 hours after it was received
+MAX_VISIBILITY = 43200
+
+
+class Lease():
+    """ A job queue message held by a daemon while its jobs wait or run.
+
+        The message stays invisible in the queue as long as the daemon keeps
+        renewing the lease, and is only deleted once every job in it has
+        completed. If the daemon dies, the lease runs out and the message comes
+        back for another daemon to run, so the receive count of a message is the
+        number of times its jobs were started. All elements claimed from a job
+        array chunk share the chunk's lease. whole is True when the message holds
+        a single job, which can then be given back without writing a new message.
+
+        A lease can't be held for more than MAX_VISIBILITY seconds (12 hours) after
+        the message was received, SQS refuses to renew it past that. The message of
+        a job that runs longer comes back to the queue, the job is started again
+        elsewhere and that counts as one of its retries.
+    """
+
+    def __init__(self, queue, msg, num_jobs=1, whole=False):
+        self.queue = queue
+        self.msg = msg
+        self.num_jobs = num_jobs
+        self.whole = whole
+        self.received_on = getattr(msg, 'received_on', time.time())
+
+    def receive_count(self):
+        attributes = getattr(self.msg, 'attributes', None) or {}
+        return int(attributes.get('ApproximateReceiveCount', 1))
+
+    def renew(self, visibility_timeout):
+        """ Keep the message invisible for another visibility_timeout seconds, returns False if it was lost.
+
+            Past MAX_VISIBILITY, the lease is only renewed up to the limit, and once
+            it is reached the renewal fails.
+        """
+        held = time.time() - self.received_on
+        if held + visibility_timeout > MAX_VISIBILITY:
+            remaining = int(MAX_VISIBILITY - held)
+            if remaining <= 0:
+                logger.error('Cannot renew the lease on a message held for %0.0fs, SQS keeps messages invisible for '
+                             'at most %ds after they are received, its jobs will run again' % (held, MAX_VISIBILITY))
+                return False
+            visibility_timeout = remaining
+        try:
+            return self.msg.change_visibility(visibility_timeout) is not False
+        except Exception, e:
+            logger.error('Renewing the lease on a message held for %0.0fs was refused: %s' % (held, str(e)))
+            return False
+
+    def job_done(self):
+        """ Called once for every job in the lease that completed, the message is deleted after the last one. """
+        self.num_jobs -= 1
+        if self.num_jobs == 0:
+            self.queue.delete_message(self.msg)
+
+    def release(self, job_info, delay=0):
+        """ Give a job that won't run here back to the queue, visible again after delay seconds.
+
+            A message that holds just this job and was received once is kept and made
+            visible again, which costs a single request. Every receive counts towards
+            the retry limit, so a message given back before is replaced by a new one
+            (see repost) instead, and a job that is given back over and over counts at
+            most one start it never made.
+        """
+        if self.whole and self.num_jobs == 1 and self.receive_count() <= 1:
+            if self.renew(delay):
+                self.num_jobs = 0
+                return
+        self.repost(job_info, delay=delay)
+
+    def repost(self, job_info, delay=0):
+        """ Give a job back to the queue as a new message with job_info as its body, so its receive count starts over. """
+        self.queue.write(self.queue.new_message(body=json.dumps(job_info)), delay_seconds=delay)
+        self.job_done()
@@ -0,0 +1,350 @@
+import errno
+import shutil
+import itertools
+
+from ezcluster.core import *
+
+
+class LocalBackend():
+    """ Runs a whole cluster on one machine.
+
+        Queues are directories of message files, blobs are files in a directory
+        and workers are local Daemon processes, all under the directory given by
+        the 'root' option of the [local] config section (default
+        /tmp/ezcluster-local). The queues and messages have the same interface
+        as the boto SQS ones, see AWSBackend.
+
+        To stand in for the real services in benchmarks, every queue and blob
+        store request can be delayed by 'latency' seconds, and every worker by
+        'startup_delay' seconds before its daemon starts. Each option can be
+        overridden by an environment variable: EZCLUSTER_LOCAL_ROOT,
+        EZCLUSTER_LOCAL_LATENCY and EZCLUSTER_LOCAL_STARTUP_DELAY.
+    """
+
+    is_local = True
+
+    def __init__(self):
+        self.root = self.get_option('root', '/tmp/ezcluster-local')
+        self.latency = float(self.get_option('latency', 0.0))
+        self.startup_delay = float(self.get_option('startup_delay', 0.0))
+
+    def get_option(self, name, default):
+        val = default
+        if config.has_option('local', name):
+            val = config.get('local', name)
+        return os.environ.get('EZCLUSTER_LOCAL_%s' % name.upper(), val)
+
+    def connect_queue(self, qname):
+        return LocalQueue(os.path.join(self.root, 'queues', qname), latency=self.latency)
+
+    def connect_blob_store(self):
+        return DirectoryBlobStore(os.path.join(self.root, 'blobs'), latency=self.latency)
+
+    def get_instance(self, instance_id):
+        return LocalInstance(instance_id)
+
+    def start_workers(self, num_workers, env, quit_when_empty):
+        """ Start num_workers Daemon processes, env is added to their environment. """
+        workers = []
+        for k in range(num_workers):
+            instance_id = 'local-%d-%s' % (os.getpid(), random_string(8))
+            output_dir = os.path.join(self.root, 'workers', instance_id)
+            os.makedirs(output_dir)
+            wenv = dict(os.environ)
+            wenv.update(dict([(name, str(val)) for name,val in env.iteritems()]))
+            wenv['EC2_INSTANCE_ID'] = instance_id
+            wenv['EC2_DNS_NAME'] = 'localhost'
+            wenv['EZCLUSTER_OUTPUT_DIR'] = output_dir
+            wenv['PYTHONPATH'] = os.path.join(SRC_DIR, 'python') + os.pathsep + wenv.get('PYTHONPATH', '')
+            cmds = [sys.executable, os.path.join(SRC_DIR, 'python', 'ezcluster', 'daemon.py'), str(quit_when_empty)]
+            if self.startup_delay > 0:
+                cmds = ['sh', '-c', 'sleep %f && exec "$0" "$@"' % self.startup_delay] + cmds
+            proc = subprocess.Popen(cmds, env=wenv, close_fds=True)
+            workers.append(LocalInstance(instance_id, proc))
+        return workers
+
+
+class LocalInstance():
+    """ A worker process. Inside the daemon itself there's no process to hold, and terminate does nothing. """
+
+    def __init__(self, instance_id, proc=None):
+        self.id = instance_id
+        self.proc = proc
+        self.public_dns_name = 'localhost'
+
+    def update(self):
+        if self.proc is None or self.proc.poll() is None:
+            return 'running'
+        return 'terminated'
+
+    def terminate(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+
+class LocalMessage():
+
+    def __init__(self, queue=None, body=None, path=None):
+        self.queue = queue
+        self.body = body
+        self.path = path
+        self.attributes = {}
+
+    def get_body(self):
+        return self.body
+
+    def get_body_encoded(self):
+        return self.body
+
+    def change_visibility(self, visibility_timeout):
+        return self.queue.change_message_visibility(self, visibility_timeout)
+
+
+class BatchResults():
+    def __init__(self):
+        self.results = []
+        self.errors = []
+
+
+class LocalQueue():
+    """ A message queue in a directory, safe to share between processes.
+
+        Each message is a file. Visible messages live in visible/ and are
+        claimed by renaming them into inflight/, with the number of times they
+        were received and the time they become visible again appended to the name. Renames are atomic, so only one
+        reader can claim a message. Expired messages are moved back to visible/
+        by whoever reads next.
+    """
+
+    def __init__(self, qdir, latency=0.0):
+        self.name = os.path.basename(qdir)
+        self.qdir = qdir
+        self.latency = latency
+        self.visible_dir = os.path.join(qdir, 'visible')
+        self.inflight_dir = os.path.join(qdir, 'inflight')
+        self.tmp_dir = os.path.join(qdir, 'tmp')
+        for d in [self.visible_dir, self.inflight_dir, self.tmp_dir]:
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+        self.counter = itertools.count()
+
+    def new_message(self, body=None):
+        return LocalMessage(queue=self, body=body)
+
+    def request(self):
+        """ Called once per queue request, to add the configured latency. """
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def write(self, msg, delay_seconds=None):
+        self.request()
+        self.write_message(msg, delay_seconds)
+        return msg
+
+    def write_message(self, msg, delay_seconds=None):
+        #names sort in the order the messages were written
+        name = '%017.6f-%d-%d-%s' % (time.time(), os.getpid(), self.counter.next(), random_string(6))
+        tmp_file = os.path.join(self.tmp_dir, name)
+        f = open(tmp_file, 'w')
+        f.write(msg.get_body())
+        f.close()
+        if delay_seconds:
+            #a delayed message waits in inflight/ as if it had been received 0 times
+            os.rename(tmp_file, os.path.join(self.inflight_dir, '%s@%0.6f' % (name, time.time() + delay_seconds)))
+        else:
+            os.rename(tmp_file, os.path.join(self.visible_dir, name))
+
+    def write_batch(self, messages):
+        self.request()
+        res = BatchResults()
+        for (entry_id, body, delay) in messages:
+            self.write_message(self.new_message(body=body), delay)
+            res.results.append({'id':entry_id})
+        return res
+
+    def requeue_expired(self):
+        now = time.time()
+        for fname in os.listdir(self.inflight_dir):
+            (name, sep, deadline) = fname.rpartition('@')
+            if float(deadline) <= now:
+                try:
+                    os.rename(os.path.join(self.inflight_dir, fname), os.path.join(self.visible_dir, name))
+                except OSError:
+                    pass
+
+    def claim(self, name, visibility_timeout):
+        #the receive count is kept in the name, after a '~'
+        (base, sep, count) = name.rpartition('~')
+        if len(sep) == 0:
+            (base, count) = (name, 0)
+        count = int(count) + 1
+        path = os.path.join(self.inflight_dir, '%s~%d@%0.6f' % (base, count, time.time() + visibility_timeout))
+        try:
+            os.rename(os.path.join(self.visible_dir, name), path)
+        except OSError:
+            return None
+        try:
+            f = open(path, 'r')
+            body = f.read()
+            f.close()
+        except IOError:
+            return None
+        msg = LocalMessage(queue=self, body=body, path=path)
+        msg.attributes['ApproximateReceiveCount'] = str(count)
+        return msg
+
+    def get_messages(self, num_messages=1, visibility_timeout=30, attributes=None, wait_time_seconds=0, poll_time=0.05):
+        self.request()
+        start_time = time.time()
+        msgs = []
+        while True:
+            self.requeue_expired()
+            for name in sorted(os.listdir(self.visible_dir)):
+                msg = self.claim(name, visibility_timeout)
+                if msg is not None:
+                    msgs.append(msg)
+                    if len(msgs) >= num_messages:
+                        break
+            if len(msgs) > 0 or (time.time() - start_time) >= wait_time_seconds:
+                return msgs
+            time.sleep(poll_time)
+
+    def read(self, visibility_timeout=30):
+        msgs = self.get_messages(1, visibility_timeout=visibility_timeout)
+        if len(msgs) == 0:
+            return None
+        return msgs[0]
+
+    def change_message_visibility(self, msg, visibility_timeout):
+        self.request()
+        (name, sep, deadline) = os.path.basename(msg.path).rpartition('@')
+        if visibility_timeout <= 0:
+            new_path = os.path.join(self.visible_dir, name)
+        else:
+            new_path = os.path.join(self.inflight_dir, '%s@%0.6f' % (name, time.time() + visibility_timeout))
+        try:
+            os.rename(msg.path, new_path)
+        except OSError:
+            #the message expired and went back to the queue, or was deleted
+            return False
+        msg.path = new_path
+        return True
+
+    def delete_message(self, msg):
+        self.request()
+        try:
+            os.remove(msg.path)
+        except OSError:
+            return False
+        return True
+
+    def delete_message_batch(self, messages):
+        self.request()
+        for msg in messages:
+            try:
+                os.remove(msg.path)
+            except OSError:
+                pass
+
+    def get_attributes(self, attributes='All'):
+        self.request()
+        return {'ApproximateNumberOfMessages':len(os.listdir(self.visible_dir)),
+                'ApproximateNumberOfMessagesNotVisible':len(os.listdir(self.inflight_dir))}
+
+    def count(self):
+        return len(os.listdir(self.visible_dir))
+
+
+class DirectoryBlobStore():
+    """ Stores blobs as files under a directory. """
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+
+    def request(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def key_name(self, name):
+        return os.path.join(self.root, name)
+
+    def make_dirs(self, path):
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def url(self, name):
+        return 'file://%s' % self.key_name(name)
+
+    def put(self, name, data):
+        self.request()
+        path = self.key_name(name)
+        self.make_dirs(path)
+        tmp_file = '%s.tmp-%d-%s' % (path, os.getpid(), random_string(6))
+        f = open(tmp_file, 'wb')
+        f.write(data)
+        f.close()
+        os.rename(tmp_file, path)
+
+    def put_file(self, name, file_name):
+        f = open(file_name, 'rb')
+        self.put(name, f.read())
+        f.close()
+
+    def start_multipart(self, name):
+        """ Parts are kept in a directory of their own until the upload is completed. """
+        self.request()
+        upload_id = random_string(16)
+        os.makedirs(os.path.join(self.root, '.multipart', upload_id))
+        return upload_id
+
+    def put_part(self, name, upload_id, part_num, fp, size):
+        self.request()
+        f = open(os.path.join(self.root, '.multipart', upload_id, '%05d' % part_num), 'wb')
+        f.write(fp.read(size))
+        f.close()
+
+    def complete_multipart(self, name, upload_id):
+        self.request()
+        part_dir = os.path.join(self.root, '.multipart', upload_id)
+        path = self.key_name(name)
+        self.make_dirs(path)
+        tmp_file = '%s.tmp-%d-%s' % (path, os.getpid(), random_string(6))
+        f = open(tmp_file, 'wb')
+        for part_name in sorted(os.listdir(part_dir)):
+            pf = open(os.path.join(part_dir, part_name), 'rb')
+            shutil.copyfileobj(pf, f)
+            pf.close()
+        f.close()
+        os.rename(tmp_file, path)
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+    def cancel_multipart(self, name, upload_id):
+        self.request()
+        shutil.rmtree(os.path.join(self.root, '.multipart', upload_id), ignore_errors=True)
+
+    def get_file(self, name, file_name):
+        if not self.exists(name):
+            raise KeyError(name)
+        shutil.copyfile(self.key_name(name), file_name)
+
+    def exists(self, name):
+        self.request()
+        return os.path.exists(self.key_name(name))
+
+    def list(self, prefix):
+        """ Names of all the blobs under prefix. """
+        self.request()
+        names = []
+        for (dirpath, dirnames, filenames) in os.walk(self.key_name(prefix)):
+            names.extend([os.path.relpath(os.path.join(dirpath, fname), self.root)
+                          for fname in filenames if '.tmp-' not in fname])
+        return names
@@ -0,0 +1,152 @@
+import zlib
+import errno
+import select
+import threading
+from Queue import Queue, Full
+
+from ezcluster.core import *
+
+logger = logging.getLogger('daemon')
+
+
+class LogShipper():
+    """ Uploads log chunks, and other small blobs, to the blob store from a small pool of threads.
+
+        Each thread makes its own blob store connection with connect_blob_store
+        and keeps it for all of its uploads. At most
+        max_pending chunks wait in memory; past that, upload blocks, which in turn
+        stops reading from the job's pipe until S3 catches up. Uploads that must not
+        wait (block=False) skip that limit and go out before the queued chunks.
+    """
+
+    def __init__(self, connect_blob_store, num_threads=2, max_pending=16, max_retries=3):
+        self.connect_blob_store = connect_blob_store
+        self.max_retries = max_retries
+        self.uploads = Queue(max_pending)
+        self.overflow = []
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.worker) for k in range(num_threads)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def upload(self, key_name, data, block=True):
+        """ Queue a string to be uploaded to key_name, without waiting for room in the queue unless block. """
+        if block:
+            self.uploads.put((key_name, data))
+            return
+        try:
+            self.uploads.put_nowait((key_name, data))
+        except Full:
+            with self.lock:
+                self.overflow.append((key_name, data))
+
+    def next_overflow(self):
+        with self.lock:
+            if len(self.overflow) > 0:
+                return self.overflow.pop(0)
+        return None
+
+    def worker(self):
+        store = self.connect_blob_store()
+        while True:
+            item = self.next_overflow()
+            if item is None:
+                item = self.uploads.get()
+            if item is None:
+                #closing, finish the overflow first and pass the stop on to this thread again
+                item = self.next_overflow()
+                if item is None:
+                    break
+                self.uploads.put(None)
+            (key_name, data) = item
+            for k in range(self.max_retries):
+                try:
+                    store.put(key_name, data)
+                    logger.debug('Copied %d bytes to %s' % (len(data), store.url(key_name)))
+                    break
+                except Exception:
+                    logger.warning('Error copying log to %s' % store.url(key_name))
+                    try:
+                        store = self.connect_blob_store()
+                    except Exception:
+                        time.sleep(1.0)
+
+    def close(self):
+        """ Wait for all queued uploads to finish and stop the threads. """
+        for t in self.threads:
+            self.uploads.put(None)
+        for t in self.threads:
+            t.join()
+
+
+class LogStream():
+    """ Ships a job's output to the blob store while the job runs.
+
+        A thread reads the job's stdout/stderr pipe and compresses it. Every
+        chunk_size bytes of compressed output, or every flush_interval seconds, the
+        data goes to the LogShipper as a complete gzip member under
+        <key_prefix>.gz.00000, <key_prefix>.gz.00001, ... Concatenating the chunks
+        in order gives a single valid gzip file.
+    """
+
+    def __init__(self, shipper, pipe, key_prefix, chunk_size=1048576, flush_interval=60.0):
+        self.shipper = shipper
+        self.pipe = pipe
+        self.fd = pipe.fileno()
+        self.key_prefix = key_prefix
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.num_chunks = 0
+        self.num_bytes = 0
+        self.new_chunk()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_chunk(self):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.chunk = []
+        self.chunk_bytes = 0
+        self.chunk_raw_bytes = 0
+        self.chunk_start = time.time()
+
+    def flush(self):
+        """ Finish the current gzip member and hand it to the shipper. """
+        if self.chunk_raw_bytes == 0:
+            self.chunk_start = time.time()
+            return
+        self.chunk.append(self.compressor.flush())
+        key_name = '%s.gz.%05d' % (self.key_prefix, self.num_chunks)
+        self.shipper.upload(key_name, ''.join(self.chunk))
+        self.num_chunks += 1
+        self.new_chunk()
+
+    def run(self):
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.time() - self.chunk_start))
+            try:
+                (readable, w, x) = select.select([self.fd], [], [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if len(readable) > 0:
+                data = os.read(self.fd, 65536)
+                if not data:
+                    break
+                self.num_bytes += len(data)
+                self.chunk_raw_bytes += len(data)
+                cdata = self.compressor.compress(data)
+                self.chunk.append(cdata)
+                self.chunk_bytes += len(cdata)
+            if self.chunk_bytes >= self.chunk_size or (time.time() - self.chunk_start) >= self.flush_interval:
+                self.flush()
+        self.flush()
+        self.pipe.close()
+
+    def is_done(self):
+        return not self.thread.is_alive()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
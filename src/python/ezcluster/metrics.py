@@ -0,0 +1,126 @@
+import resource
+
+from ezcluster.core import *
+
+
+def job_usage(rusage, start_time, end_time, num_cpus):
+    """ The resources a finished job used, from the rusage returned by os.wait4, as a dictionary for its status message.
+
+        Times are in seconds and max_rss in bytes. The rusage covers the job's process and
+        every child process it waited for. cpu_utilization is the CPU time over the cores
+        the job asked for and its wall time, 1.0 when it kept them all busy.
+    """
+    wall_time = end_time - start_time
+    cpu_time = rusage.ru_utime + rusage.ru_stime
+    return {'started_on':start_time,
+            'finished_on':end_time,
+            'wall_time':wall_time,
+            'user_time':rusage.ru_utime,
+            'system_time':rusage.ru_stime,
+            'cpu_utilization':cpu_time / (max(int(num_cpus), 1) * max(wall_time, 1e-6)),
+            #kilobytes on Linux
+            'max_rss':rusage.ru_maxrss * 1024,
+            'io_read_blocks':rusage.ru_inblock,
+            'io_write_blocks':rusage.ru_oublock,
+            'major_page_faults':rusage.ru_majflt,
+            'context_switches':rusage.ru_nvcsw + rusage.ru_nivcsw}
+
+
+class DaemonMetrics():
+    """ Counters of the work done by a daemon, written to a text file for scraping.
+
+        Busy slot and core seconds and idle seconds are integrated over time from the
+        number of running jobs, see update, so slot_utilization is the fraction of the
+        slots that were running a job since the daemon started. queue_wait is the time
+        from a job being posted to it starting. The file uses the Prometheus text
+        format, so it can be read by node_exporter's textfile collector, and is
+        replaced atomically every interval seconds.
+    """
+
+    def __init__(self, path, instance_id, num_slots, num_cores, interval=15.0):
+        self.path = path
+        self.instance_id = instance_id
+        self.num_slots = num_slots
+        self.num_cores = num_cores
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_update = self.start_time
+        self.last_write = 0.0
+        self.num_running = 0
+        self.num_busy_cores = 0
+        self.busy_slot_seconds = 0.0
+        self.busy_core_seconds = 0.0
+        self.idle_seconds = 0.0
+        self.counters = dict([(name, 0) for name in ['jobs_started', 'jobs_finished', 'jobs_failed', 'jobs_memoized']])
+        self.sums = dict([(name, 0.0) for name in ['queue_wait', 'wall_time', 'user_time', 'system_time',
+                                                    'io_read_blocks', 'io_write_blocks']])
+        self.max_rss = 0
+
+    def update(self, num_running, num_busy_cores):
+        """ Account for the time since the last update, then record the current number of running jobs and busy cores. """
+        now = time.time()
+        dt = now - self.last_update
+        self.busy_slot_seconds += self.num_running * dt
+        self.busy_core_seconds += self.num_busy_cores * dt
+        if self.num_running == 0:
+            self.idle_seconds += dt
+        self.last_update = now
+        self.num_running = num_running
+        self.num_busy_cores = num_busy_cores
+
+    def job_started(self, queue_wait=None):
+        self.counters['jobs_started'] += 1
+        if queue_wait is not None:
+            self.sums['queue_wait'] += max(queue_wait, 0.0)
+
+    def job_finished(self, status_msg):
+        self.counters['jobs_finished'] += 1
+        if status_msg.get('memoized', False):
+            self.counters['jobs_memoized'] += 1
+        if status_msg.get('ret_code') != 0:
+            self.counters['jobs_failed'] += 1
+        for name in ['wall_time', 'user_time', 'system_time', 'io_read_blocks', 'io_write_blocks']:
+            self.sums[name] += status_msg.get(name, 0)
+        self.max_rss = max(self.max_rss, status_msg.get('max_rss', 0))
+
+    def values(self):
+        """ A list of (metric name, type, value) for the metrics file. """
+        self.update(self.num_running, self.num_busy_cores)
+        uptime = max(time.time() - self.start_time, 1e-6)
+        return [('uptime_seconds', 'gauge', uptime),
+                ('slots', 'gauge', self.num_slots),
+                ('cores', 'gauge', self.num_cores),
+                ('running_jobs', 'gauge', self.num_running),
+                ('busy_cores', 'gauge', self.num_busy_cores),
+                ('busy_slot_seconds_total', 'counter', self.busy_slot_seconds),
+                ('busy_core_seconds_total', 'counter', self.busy_core_seconds),
+                ('idle_seconds_total', 'counter', self.idle_seconds),
+                ('slot_utilization', 'gauge', self.busy_slot_seconds / (max(self.num_slots, 1) * uptime)),
+                ('core_utilization', 'gauge', self.busy_core_seconds / (max(self.num_cores, 1) * uptime)),
+                ('jobs_started_total', 'counter', self.counters['jobs_started']),
+                ('jobs_finished_total', 'counter', self.counters['jobs_finished']),
+                ('jobs_failed_total', 'counter', self.counters['jobs_failed']),
+                ('jobs_memoized_total', 'counter', self.counters['jobs_memoized']),
+                ('job_queue_wait_seconds_total', 'counter', self.sums['queue_wait']),
+                ('job_wall_seconds_total', 'counter', self.sums['wall_time']),
+                ('job_user_cpu_seconds_total', 'counter', self.sums['user_time']),
+                ('job_system_cpu_seconds_total', 'counter', self.sums['system_time']),
+                ('job_io_read_blocks_total', 'counter', self.sums['io_read_blocks']),
+                ('job_io_write_blocks_total', 'counter', self.sums['io_write_blocks']),
+                ('job_max_rss_bytes', 'gauge', self.max_rss),
+                ('daemon_max_rss_bytes', 'gauge', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)]
+
+    def write(self, force=False):
+        """ Replace the metrics file, at most once every interval seconds unless force is True. """
+        if not force and time.time() - self.last_write < self.interval:
+            return
+        self.last_write = time.time()
+        lines = []
+        for (name, mtype, value) in self.values():
+            lines.append('# TYPE ezcluster_%s %s' % (name, mtype))
+            lines.append('ezcluster_%s{instance="%s"} %s' % (name, self.instance_id, repr(float(value))))
+        tmp_file = '%s.tmp-%s' % (self.path, random_string(6))
+        f = open(tmp_file, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        os.rename(tmp_file, self.path)
@@ -0,0 +1,160 @@
+from ezcluster.core import *
+from ezcluster.backend import get_backend
+
+
+class BatchMonitor():
+    """ Reads job status messages posted by the daemons and keeps track of batches.
+
+        Status messages are drained from the status queue ten at a time and
+        deleted in batches. The latest status of every job is kept in memory,
+        indexed by batch_id and job id, so a batch is known to be done as soon as
+        its last job reports in. Jobs cancelled by the Launcher because a
+        dependency failed are reported as finished, with 'cancelled' set.
+    """
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = get_backend()
+        self.status_queue = backend.connect_queue(config.get('sqs', 'status_queue'))
+        self.batches = {}
+        self.job_status = {}
+        self.finish_times = {}
+        self.instances = {}
+
+    def poll(self, wait_time=20, max_messages=1000):
+        """ Drain up to max_messages status messages from the queue, returns the number read.
+
+            The first read long-polls for up to wait_time seconds, reading stops
+            as soon as the queue comes back empty.
+        """
+        num_read = 0
+        while num_read < max_messages:
+            msgs = self.status_queue.get_messages(num_messages=10, wait_time_seconds=wait_time)
+            if len(msgs) == 0:
+                break
+            wait_time = 0
+            for msg in msgs:
+                try:
+                    self.add_status(json.loads(msg.get_body()))
+                except ValueError:
+                    print 'Could not parse status message: %s' % msg.get_body()
+            self.status_queue.delete_message_batch(msgs)
+            num_read += len(msgs)
+        return num_read
+
+    def add_status(self, status_msg):
+        if status_msg.get('type') != 'job_status':
+            return
+        batch_id = str(status_msg.get('batch_id'))
+        job_id = status_msg['job']['id']
+        jobs = self.batches.setdefault(batch_id, {})
+        #messages can arrive out of order, never go back from finished to running
+        if job_id in jobs and jobs[job_id]['status'] == 'finished':
+            return
+        jobs[job_id] = status_msg
+        self.job_status[job_id] = status_msg
+        if status_msg['status'] == 'finished':
+            self.finish_times.setdefault(batch_id, []).append(time.time())
+
+        #keep track of which jobs each instance is running and when it was last heard from
+        if status_msg.get('instance') is None:
+            return
+        inst = self.instances.setdefault(status_msg['instance'], {'running':set(), 'last_update':0.0})
+        inst['last_update'] = time.time()
+        if status_msg['status'] == 'finished':
+            inst['running'].discard(job_id)
+        else:
+            inst['running'].add(job_id)
+
+    def batch_stats(self, batch_id, num_jobs=None, window=300.0):
+        """ Summarize a batch: job counts, failures by return code, throughput and ETA.
+
+            Throughput is the number of jobs finished per second over the last
+            window seconds. The ETA needs the total number of jobs in the batch.
+            The mean wall time and CPU utilization and the largest max_rss of the
+            jobs that ran are taken from their resource usage, see job_usage.
+        """
+        jobs = self.batches.get(batch_id, {})
+        num_finished = 0
+        num_running = 0
+        num_cancelled = 0
+        failures = {}
+        usages = []
+        for status_msg in jobs.values():
+            if status_msg['status'] == 'finished':
+                num_finished += 1
+                if status_msg.get('cancelled', False):
+                    num_cancelled += 1
+                    continue
+                if 'wall_time' in status_msg:
+                    usages.append(status_msg)
+                ret_code = status_msg.get('ret_code', 0)
+                if ret_code != 0:
+                    failures[ret_code] = failures.get(ret_code, 0) + 1
+            else:
+                num_running += 1
+
+        now = time.time()
+        recent = [t for t in self.finish_times.get(batch_id, []) if now - t <= window]
+        throughput = 0.0
+        if len(recent) > 0:
+            throughput = len(recent) / max(now - min(recent), 1.0)
+
+        stats = {'batch_id':batch_id,
+                 'num_finished':num_finished,
+                 'num_running':num_running,
+                 'num_failed':sum(failures.values()),
+                 'num_cancelled':num_cancelled,
+                 'failures':failures,
+                 'throughput':throughput,
+                 'eta':None,
+                 'mean_wall_time':None,
+                 'mean_cpu_utilization':None,
+                 'max_rss':None}
+        if len(usages) > 0:
+            stats['mean_wall_time'] = sum([u['wall_time'] for u in usages]) / len(usages)
+            stats['mean_cpu_utilization'] = sum([u['cpu_utilization'] for u in usages]) / len(usages)
+            stats['max_rss'] = max([u['max_rss'] for u in usages])
+        if num_jobs is not None and throughput > 0:
+            stats['eta'] = max(num_jobs - num_finished, 0) / throughput
+        return stats
+
+    def report(self, batch_id, num_jobs=None):
+        stats = self.batch_stats(batch_id, num_jobs=num_jobs)
+        total_str = '?'
+        if num_jobs is not None:
+            total_str = '%d' % num_jobs
+        eta_str = 'unknown'
+        if stats['eta'] is not None:
+            eta_str = '%0.0fs' % stats['eta']
+        print 'Batch %s: %d/%s finished, %d running, %d failed %s, %d cancelled, %0.2f jobs/sec, ETA %s' % \
+              (batch_id, stats['num_finished'], total_str, stats['num_running'],
+               stats['num_failed'], str(stats['failures']), stats['num_cancelled'], stats['throughput'], eta_str)
+        if stats['mean_wall_time'] is not None:
+            print 'Batch %s: mean wall time %0.1fs, mean CPU utilization %0.2f, max RSS %0.1f MB' % \
+                  (batch_id, stats['mean_wall_time'], stats['mean_cpu_utilization'], stats['max_rss'] / 1024.0**2)
+        return stats
+
+    def wait_for_batch(self, batch_id, num_jobs, timeout_after=None, report_interval=60.0, callback=None):
+        """ Consume status messages until all num_jobs jobs of the batch have finished.
+
+            If given, callback is called with the monitor after every poll. Returns the
+            final batch stats, or None if timeout_after seconds pass first.
+        """
+        if num_jobs is None:
+            raise ConfigException('The number of jobs of batch %s is needed to wait for it' % batch_id)
+        start_time = time.time()
+        last_report = start_time
+        while True:
+            self.poll()
+            if callback is not None:
+                callback(self)
+            stats = self.batch_stats(batch_id, num_jobs=num_jobs)
+            if stats['num_finished'] >= num_jobs:
+                return self.report(batch_id, num_jobs=num_jobs)
+            if time.time() - last_report >= report_interval:
+                self.report(batch_id, num_jobs=num_jobs)
+                last_report = time.time()
+            if timeout_after is not None and (time.time() - start_time) > timeout_after:
+                print 'Timed out waiting for batch %s' % batch_id
+                return None
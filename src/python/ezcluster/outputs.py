@@ -0,0 +1,201 @@
+import glob
+import threading
+from Queue import Queue
+
+from ezcluster.core import *
+
+logger = logging.getLogger('daemon')
+
+
+class OutputUpload():
+    """ The uploads of a single job's output files.
+
+        done is set once every file is in the blob store or has failed, see stats.
+    """
+
+    def __init__(self, job_id, files, on_done=None):
+        self.job_id = job_id
+        self.files = files
+        self.on_done = on_done
+        self.num_bytes = sum([os.path.getsize(path) for (path, key_name) in files])
+        self.num_pending = len(files)
+        self.urls = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.start_time = time.time()
+        self.end_time = None
+        if self.num_pending == 0:
+            self.finish()
+
+    def file_done(self, url=None, error=None):
+        with self.lock:
+            if url is not None:
+                self.urls.append(url)
+            if error is not None:
+                self.errors.append(error)
+            self.num_pending -= 1
+            finished = self.num_pending == 0
+        if finished:
+            self.finish()
+
+    def finish(self):
+        self.end_time = time.time()
+        self.done.set()
+        if self.on_done is not None:
+            self.on_done()
+
+    def is_done(self):
+        return self.done.is_set()
+
+    def wait(self):
+        self.done.wait()
+
+    def stats(self):
+        elapsed = self.end_time - self.start_time
+        return {'outputs':sorted(self.urls),
+                'output_errors':self.errors,
+                'output_bytes':self.num_bytes,
+                'output_upload_time':elapsed,
+                'output_throughput':self.num_bytes / max(elapsed, 1e-6)}
+
+
+class MultipartFile():
+    """ A file being sent in parts, the thread that sends the last part completes the upload. """
+
+    def __init__(self, upload, path, key_name, upload_id, num_parts):
+        self.upload = upload
+        self.path = path
+        self.key_name = key_name
+        self.upload_id = upload_id
+        self.num_pending = num_parts
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def part_done(self, ok):
+        """ Returns True for the last part to finish. """
+        with self.lock:
+            self.num_pending -= 1
+            if not ok:
+                self.failed = True
+            return self.num_pending == 0
+
+
+class OutputUploader():
+    """ Uploads job output files to the blob store from a pool of threads, off the dispatch path.
+
+        Each thread makes its own blob store connection and reuses it. Files of
+        at least part_size bytes are sent as multipart uploads, with their parts
+        spread over the threads, and smaller files are sent whole. Output files
+        go under outputs/<batch_id>/<job_id>/.
+    """
+
+    def __init__(self, connect_blob_store, num_threads=4, part_size=8*1024**2, max_retries=3):
+        self.connect_blob_store = connect_blob_store
+        self.part_size = part_size
+        self.max_retries = max_retries
+        self.tasks = Queue()
+        self.threads = [threading.Thread(target=self.worker) for k in range(num_threads)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def find_files(self, patterns, key_prefix, cwd=None):
+        """ Expand the output paths or globs into a tuple ([(path, key name), ...], [error, ...]).
+
+            Relative paths are taken from cwd, the daemon's working directory by default.
+        """
+        paths = []
+        errors = []
+        for pattern in patterns:
+            if cwd is not None:
+                pattern = os.path.join(cwd, pattern)
+            matches = sorted([p for p in glob.glob(pattern) if os.path.isfile(p)])
+            if len(matches) == 0:
+                errors.append('No output files match %s' % pattern)
+            paths.extend([os.path.abspath(p) for p in matches if os.path.abspath(p) not in paths])
+        if len(paths) == 0:
+            return ([], errors)
+        base_dir = os.path.dirname(os.path.commonprefix([os.path.dirname(p) + os.sep for p in paths]))
+        return ([(p, os.path.join(key_prefix, os.path.relpath(p, base_dir))) for p in paths], errors)
+
+    def upload(self, j, patterns, on_done=None):
+        """ Start uploading the outputs of job j, returns an OutputUpload. """
+        (files, errors) = self.find_files(patterns, os.path.join('outputs', str(j.batch_id), j.id),
+                                          cwd=getattr(j, 'work_dir', None))
+        upload = OutputUpload(j.id, files, on_done=on_done)
+        upload.errors.extend(errors)
+        for (path, key_name) in files:
+            self.tasks.put(('file', upload, path, key_name))
+        return upload
+
+    def retry(self, store, f, *args):
+        """ Call f(store, *args), reconnecting and retrying on errors.
+
+            Returns a tuple (store to keep using, error message or None).
+        """
+        error = None
+        for k in range(self.max_retries):
+            try:
+                f(store, *args)
+                return (store, None)
+            except Exception, e:
+                error = str(e)
+                try:
+                    store = self.connect_blob_store()
+                except Exception:
+                    time.sleep(1.0)
+        return (store, error)
+
+    def worker(self):
+        store = self.connect_blob_store()
+        while True:
+            task = self.tasks.get()
+            if task[0] == 'file':
+                (kind, upload, path, key_name) = task
+                size = os.path.getsize(path)
+                if size < self.part_size:
+                    (store, error) = self.retry(store, lambda s: s.put_file(key_name, path))
+                    self.file_done(store, upload, key_name, error)
+                    continue
+                try:
+                    upload_id = store.start_multipart(key_name)
+                except Exception, e:
+                    self.file_done(store, upload, key_name, str(e))
+                    continue
+                num_parts = (size + self.part_size - 1) / self.part_size
+                mf = MultipartFile(upload, path, key_name, upload_id, num_parts)
+                for part_num in range(1, num_parts+1):
+                    self.tasks.put(('part', mf, part_num))
+            elif task[0] == 'part':
+                (kind, mf, part_num) = task
+                (store, error) = self.retry(store, self.send_part, mf, part_num)
+                if not mf.part_done(error is None):
+                    continue
+                if mf.failed:
+                    try:
+                        store.cancel_multipart(mf.key_name, mf.upload_id)
+                    except Exception:
+                        pass
+                    self.file_done(store, mf.upload, mf.key_name, 'Upload of %s failed' % mf.path)
+                    continue
+                (store, error) = self.retry(store, lambda s: s.complete_multipart(mf.key_name, mf.upload_id))
+                self.file_done(store, mf.upload, mf.key_name, error)
+
+    def send_part(self, store, mf, part_num):
+        offset = (part_num - 1) * self.part_size
+        size = min(self.part_size, os.path.getsize(mf.path) - offset)
+        f = open(mf.path, 'rb')
+        try:
+            f.seek(offset)
+            store.put_part(mf.key_name, mf.upload_id, part_num, f, size)
+        finally:
+            f.close()
+
+    def file_done(self, store, upload, key_name, error):
+        if error is None:
+            logger.debug('Uploaded output %s' % store.url(key_name))
+            upload.file_done(url=store.url(key_name))
+        else:
+            logger.error('Could not upload output %s: %s' % (key_name, error))
+            upload.file_done(error='%s: %s' % (key_name, error))
@@ -0,0 +1,151 @@
+from ezcluster.core import *
+
+logger = logging.getLogger('daemon')
+
+POOL_TAG = 'ezcluster-pool'
+PARKED_ON_TAG = 'ezcluster-parked-on'
+CODE_HASH_TAG = 'ezcluster-code-hash'
+
+
+def pool_options():
+    """ The warm pool settings from the [pool] config section, as a tuple (size, linger, max_idle).
+
+        size is the most instances the pool keeps, 0 (the default) turns the pool off.
+        A parked instance stays running for linger seconds, then it is stopped, and a
+        stopped instance is terminated after max_idle seconds in the pool.
+    """
+    opts = {'size':0, 'linger':300.0, 'max_idle':86400.0}
+    for name in opts.keys():
+        if config.has_option('pool', name):
+            try:
+                opts[name] = type(opts[name])(config.get('pool', name))
+            except ValueError:
+                raise ConfigException('Bad [pool] %s: %s' % (name, config.get('pool', name)))
+    return (opts['size'], opts['linger'], opts['max_idle'])
+
+
+class WarmPool():
+    """ Finished EC2 instances kept for the next launch instead of being terminated.
+
+        A daemon that runs out of work parks its instance: it tags it as parked
+        and keeps it running for linger seconds, then stops it. A launch claims
+        compatible parked instances (same image, instance type and keypair) before
+        reserving new ones, lingering ones first, and starts the stopped ones, so
+        the instance only has to pick up the init archive and start a daemon. The
+        code bundle is checked against the claiming launch's code hash by
+        start-daemon.sh, which only fetches it when it changed, and resumes from
+        its local bundle cache otherwise.
+
+        Members are found by their tags, so the pool is shared by every launcher
+        and daemon of the account, and claiming is not atomic: two launches
+        racing for the same instance both initialize it, and the second daemon
+        replaces the first. The pool never holds more than size instances, and
+        instances parked for more than max_idle seconds are terminated, every
+        time an instance is parked or claimed.
+    """
+
+    def __init__(self, conn, image_id, instance_type, key_name, size, linger=300.0, max_idle=86400.0):
+        self.conn = conn
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.key_name = key_name
+        self.size = size
+        self.linger = linger
+        self.max_idle = max_idle
+
+    def members(self):
+        """ Parked instances, compatible or not, oldest first. """
+        filters = {'tag:%s' % POOL_TAG:'parked',
+                   'instance-state-name':['running', 'stopping', 'stopped']}
+        members = []
+        for r in self.conn.get_all_instances(filters=filters):
+            members.extend(r.instances)
+        return sorted(members, key=parked_on)
+
+    def is_compatible(self, inst):
+        return inst.image_id == self.image_id and inst.instance_type == self.instance_type and \
+               inst.key_name == self.key_name
+
+    def expire(self, keep=0):
+        """ Terminate the instances parked for more than max_idle seconds, and then the oldest
+            ones until at most size - keep are left. Returns the remaining members.
+        """
+        now = time.time()
+        members = self.members()
+        expired = [inst for inst in members if now - parked_on(inst) > self.max_idle]
+        left = [inst for inst in members if inst not in expired]
+        num_over = len(left) - max(self.size - keep, 0)
+        if num_over > 0:
+            expired.extend(left[:num_over])
+            left = left[num_over:]
+        if len(expired) > 0:
+            logger.info('Terminating %d instances from the warm pool' % len(expired))
+            self.conn.terminate_instances(instance_ids=[inst.id for inst in expired])
+        return left
+
+    def claim(self, num_instances):
+        """ Take up to num_instances compatible instances out of the pool and start the stopped ones.
+
+            Returns a list of (instance, code hash it was parked with).
+        """
+        members = [inst for inst in self.expire() if self.is_compatible(inst) and inst.state != 'stopping']
+        #lingering instances first, then the most recently stopped
+        members.sort(key=lambda inst: (inst.state != 'running', -parked_on(inst)))
+        claimed = members[:num_instances]
+        if len(claimed) == 0:
+            return []
+        ids = [inst.id for inst in claimed]
+        self.conn.create_tags(ids, {POOL_TAG:'claimed'})
+        stopped = [inst.id for inst in claimed if inst.state == 'stopped']
+        if len(stopped) > 0:
+            self.conn.start_instances(instance_ids=stopped)
+        return [(inst, inst.tags.get(CODE_HASH_TAG)) for inst in claimed]
+
+    def park(self, instance, code_hash=None):
+        """ Put an instance in the pool, returns False if the pool is full and the instance should be terminated. """
+        if self.size <= 0:
+            return False
+        left = self.expire(keep=1)
+        if len([inst for inst in left if inst.id != instance.id]) >= self.size:
+            return False
+        self.conn.create_tags([instance.id], {POOL_TAG:'parked',
+                                              PARKED_ON_TAG:'%0.0f' % time.time(),
+                                              CODE_HASH_TAG:str(code_hash)})
+        return True
+
+    def stop(self, instance):
+        """ Stop a parked instance, unless it was claimed in the meantime. Returns True if it was stopped. """
+        instance.update()
+        if instance.tags.get(POOL_TAG) != 'parked':
+            return False
+        self.conn.stop_instances(instance_ids=[instance.id])
+        return True
+
+    def linger_until_claimed(self, instance, poll_time=10.0):
+        """ Wait up to linger seconds for a launch to claim a parked instance, then stop it.
+
+            Returns True if the instance was claimed, in which case the claiming launch
+            starts a new daemon on it.
+        """
+        start_time = time.time()
+        while time.time() - start_time < self.linger:
+            time.sleep(poll_time)
+            try:
+                instance.update()
+            except Exception, e:
+                logger.warning('Could not check the pool tag of %s: %s' % (instance.id, str(e)))
+                continue
+            if instance.tags.get(POOL_TAG) != 'parked':
+                return True
+        return not self.stop(instance)
+
+    def drain(self):
+        """ Terminate every instance in the pool. """
+        ids = [inst.id for inst in self.members()]
+        if len(ids) > 0:
+            self.conn.terminate_instances(instance_ids=ids)
+        return ids
+
+
+def parked_on(inst):
+    return float(inst.tags.get(PARKED_ON_TAG, 0))
@@ -0,0 +1,122 @@
+from ezcluster.core import *
+
+
+def job_queue_specs():
+    """ The job queues from the config file, highest priority first, as a list of (name, weight, max_runtime).
+
+        [sqs] job_queue is always the last, lowest priority queue, with a weight of 1.
+        [sqs] priority_queues adds queues in front of it, as a comma separated list of
+        name:weight or name:weight:max_runtime entries, for example
+
+            priority_queues=ezcluster_urgent:8, ezcluster_short:4:300
+
+        Daemons poll the queues in proportion to their weights, see QueuePoller. A queue
+        with a max_runtime takes the jobs expected to run for at most max_runtime
+        seconds, see route_job.
+    """
+    specs = []
+    if config.has_option('sqs', 'priority_queues'):
+        for entry in config.get('sqs', 'priority_queues').split(','):
+            if len(entry.strip()) == 0:
+                continue
+            fields = [f.strip() for f in entry.split(':')]
+            if len(fields) not in [2, 3]:
+                raise ConfigException('Bad priority queue %s, expected name:weight[:max_runtime]' % entry.strip())
+            try:
+                weight = float(fields[1])
+                max_runtime = None
+                if len(fields) == 3:
+                    max_runtime = float(fields[2])
+            except ValueError:
+                raise ConfigException('Bad priority queue %s, expected name:weight[:max_runtime]' % entry.strip())
+            if weight <= 0:
+                raise ConfigException('Priority queue %s needs a positive weight' % fields[0])
+            specs.append((fields[0], weight, max_runtime))
+    specs.append((config.get('sqs', 'job_queue'), 1.0, None))
+    names = [name for (name, weight, max_runtime) in specs]
+    if len(set(names)) < len(names):
+        raise ConfigException('Job queues are listed more than once: %s' % ', '.join(names))
+    return specs
+
+
+def route_job(specs, j):
+    """ Name of the job queue a job or job array is posted to.
+
+        A queue named by the job's queue attribute wins. Otherwise a job with a positive
+        expected_runtime goes to the highest priority queue whose max_runtime covers it,
+        and every other job goes to job_queue.
+    """
+    names = [name for (name, weight, max_runtime) in specs]
+    queue = getattr(j, 'queue', None)
+    if queue is not None:
+        if queue not in names:
+            raise ConfigException('Unknown job queue %s, the queues are %s' % (queue, ', '.join(names)))
+        return queue
+    runtime = float(j.expected_runtime or -1)
+    if runtime > 0:
+        for (name, weight, max_runtime) in specs:
+            if max_runtime is not None and runtime <= max_runtime:
+                return name
+    return names[-1]
+
+
+class QueuePoller():
+    """ Takes messages from several job queues in weighted order (stride scheduling).
+
+        Every queue has a pass value. Queues are polled lowest pass first, ties going
+        to the higher priority queue, until one of them hands out messages, and that
+        queue's pass moves forward by 1/weight. An empty queue stays in front, so urgent
+        jobs are taken as soon as they show up, but while every queue has work each one
+        gets a weight/total share of the polls, so the long jobs in job_queue are never
+        starved. A queue can't bank credit while it is empty: when it is passed over,
+        its pass is brought up to that of the queue that hands out the messages.
+    """
+
+    def __init__(self, queues, weights):
+        self.queues = queues
+        self.weights = weights
+        self.passes = [0.0] * len(queues)
+        self.ranks = dict([(q.name, k) for k,q in enumerate(queues)])
+
+    def rank(self, queue):
+        """ Priority of a queue, 0 for the highest. """
+        return self.ranks.get(queue.name, len(self.queues))
+
+    def order(self):
+        return sorted(range(len(self.queues)), key=lambda k: (self.passes[k], k))
+
+    def get_messages(self, num_messages=1, visibility_timeout=60, wait_time_seconds=0, queues=None):
+        """ Returns a tuple (queue, messages) from the first queue in weighted order that has any,
+            or (None, []).
+
+            With several queues, they are all checked without waiting first, so an empty
+            queue in front doesn't hold up the others, and only if every one is empty are
+            they long polled, splitting wait_time_seconds between them. queues are other
+            connections to the same queues, in the same order, to read from instead, for a
+            poll from another thread.
+        """
+        if queues is None:
+            queues = self.queues
+        waits = [wait_time_seconds]
+        if len(self.queues) > 1:
+            waits = [0]
+            if wait_time_seconds > 0:
+                waits.append(int(max(1, wait_time_seconds / len(self.queues))))
+        for wait in waits:
+            empty = []
+            for k in self.order():
+                msgs = queues[k].get_messages(num_messages=num_messages, visibility_timeout=visibility_timeout,
+                                                   attributes=['ApproximateReceiveCount'], wait_time_seconds=wait)
+                if len(msgs) == 0:
+                    empty.append(k)
+                    continue
+                #for the visibility limit, see Lease
+                for msg in msgs:
+                    msg.received_on = time.time()
+                for e in empty:
+                    self.passes[e] = max(self.passes[e], self.passes[k])
+                self.passes[k] += 1.0 / self.weights[k]
+                low = min(self.passes)
+                self.passes = [p - low for p in self.passes]
+                return (queues[k], msgs)
+        return (None, [])
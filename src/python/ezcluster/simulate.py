@@ -0,0 +1,293 @@
+import heapq
+import multiprocessing
+from collections import deque
+
+from ezcluster.core import *
+
+
+def historical_runtimes(monitor):
+    """ Wall times of the jobs that succeeded in the batches read by a BatchMonitor, as a dictionary of
+        job content key to seconds.
+
+        Content keys are derived from the job's command, inputs and outputs (see job_key), so
+        these are looked up again when the same jobs are planned for a new batch.
+    """
+    runtimes = {}
+    for status_msg in monitor.job_status.values():
+        key = status_msg['job'].get('key')
+        if key is not None and status_msg['status'] == 'finished' and status_msg.get('ret_code') == 0 and \
+           'wall_time' in status_msg:
+            runtimes[key] = status_msg['wall_time']
+    return runtimes
+
+
+def job_runs(jobs):
+    """ Compress a list of (num_cpus, runtime) in post order into runs of identical jobs, as (num_cpus, runtime, count). """
+    runs = []
+    for (ncpus, runtime) in jobs:
+        if len(runs) > 0 and runs[-1][0] == ncpus and runs[-1][1] == runtime:
+            runs[-1][2] += 1
+        else:
+            runs.append([ncpus, runtime, 1])
+    return [tuple(r) for r in runs]
+
+
+def simulate_dispatch(runs, num_instances, num_jobs_per_instance, num_cores, startup_delay=120.0,
+                      startup_stagger=0.0, dispatch_overhead=0.0, idle_timeout=30.0):
+    """ Discrete-event simulation of a batch running on a set of daemons, returns a dictionary of predictions.
+
+        runs is a list of (num_cpus, runtime, count) runs of identical jobs, in the order
+        they are posted, see job_runs. All instances are launched at time 0, and instance
+        k starts taking jobs at startup_delay + k*startup_stagger. Like the daemon, an
+        instance with a free slot takes the earliest posted job that fits on its free
+        cores, a job asking for more cores than an instance has gets the whole instance,
+        and every job start costs dispatch_overhead seconds of its slot. An instance
+        quits idle_timeout seconds after its last job.
+
+        Identical jobs that start together on an instance end together, so they are
+        simulated as a single event. Once every slot runs jobs of the same run and they
+        all end within one runtime of each other, the schedule repeats itself every
+        runtime, so whole rounds of the run are skipped at once (see fast_forward). A
+        batch of a few job shapes costs a few events per instance rather than one per
+        job. When the cores can never run out (the largest job times
+        num_jobs_per_instance fits), only slots are tracked, in a heap of (free time,
+        instance, # slots).
+    """
+    if num_instances < 1 or num_jobs_per_instance < 1 or num_cores < 1:
+        raise ConfigException('A configuration needs at least one instance, slot and core')
+    ready_times = [startup_delay + k*startup_stagger for k in range(num_instances)]
+    last_end = list(ready_times)
+    runs = [(min(max(int(ncpus), 1), num_cores), float(runtime), count) for (ncpus, runtime, count) in runs]
+    max_cores = max([ncpus for (ncpus, runtime, count) in runs] or [1])
+    if max_cores * num_jobs_per_instance <= num_cores:
+        slots = [(ready_times[k], k, num_jobs_per_instance) for k in range(num_instances)]
+        heapq.heapify(slots)
+        num_slots = num_instances * num_jobs_per_instance
+        for (ncpus, runtime, count) in runs:
+            duration = dispatch_overhead + runtime
+            if count == 1:
+                #the common case of jobs that all differ, a single heap update
+                (t, k, n) = slots[0]
+                end = t + duration
+                if n == 1:
+                    heapq.heapreplace(slots, (end, k, 1))
+                else:
+                    heapq.heapreplace(slots, (t, k, n - 1))
+                    heapq.heappush(slots, (end, k, 1))
+                if end > last_end[k]:
+                    last_end[k] = end
+                continue
+            next_check = 0
+            while count > 0:
+                next_check -= 1
+                if count >= num_slots and next_check <= 0:
+                    #at most one check per pass over the heap
+                    next_check = len(slots)
+                    (slots, num_rounds) = fast_forward(slots, duration, count / num_slots, last_end)
+                    count -= num_rounds * num_slots
+                    if count == 0:
+                        break
+                (t, k, n) = heapq.heappop(slots)
+                #take in the other slots of the instance that are free at the same time
+                while len(slots) > 0 and slots[0][0] == t and slots[0][1] == k:
+                    n += heapq.heappop(slots)[2]
+                m = min(n, count)
+                end = t + duration
+                heapq.heappush(slots, (end, k, m))
+                if m < n:
+                    heapq.heappush(slots, (t, k, n - m))
+                count -= m
+                if end > last_end[k]:
+                    last_end[k] = end
+    else:
+        #one FIFO of [post order, runtime, count] per job size, an instance takes the earliest head that fits
+        sizes = {}
+        seq = 0
+        for (ncpus, runtime, count) in runs:
+            sizes.setdefault(ncpus, deque()).append([seq, runtime, count])
+            seq += count
+        size_fifos = sorted(sizes.items())
+        free_slots = [num_jobs_per_instance] * num_instances
+        free_cores = [num_cores] * num_instances
+        #(time, instance, cores per job, # jobs), cores is 0 for the instance starting up, else jobs ended
+        events = [(ready_times[k], k, 0, 0) for k in range(num_instances)]
+        heapq.heapify(events)
+        next_check = 0
+        while len(events) > 0:
+            next_check -= 1
+            if next_check <= 0:
+                next_check = len(events)
+                pending = [(fifo[0][0], size, fifo) for (size, fifo) in sizes.iteritems() if len(fifo) > 0]
+                #skip ahead once every instance is full with jobs of the earliest posted run
+                if len(pending) > 0 and self_similar(events, free_slots, free_cores, min(pending)[1],
+                                                     min([size for (seq, size, fifo) in pending])):
+                    (seq, size, fifo) = min(pending)
+                    head = fifo[0]
+                    num_running = sum([e[3] for e in events])
+                    (events, num_rounds) = fast_forward(events, dispatch_overhead + head[1], head[2] / num_running,
+                                                        last_end)
+                    head[0] += num_rounds * num_running
+                    head[2] -= num_rounds * num_running
+                    if head[2] == 0:
+                        fifo.popleft()
+            (now, k, ncpus, n) = heapq.heappop(events)
+            num_free = free_slots[k] + n
+            cores = free_cores[k] + ncpus * n
+            #like the daemon, collect every job of the instance that ended by now before refilling
+            while len(events) > 0 and events[0][0] == now and events[0][1] == k:
+                (now, k, ncpus, n) = heapq.heappop(events)
+                num_free += n
+                cores += ncpus * n
+            while num_free > 0:
+                best = None
+                for (size, fifo) in size_fifos:
+                    if size <= cores and fifo and (best is None or fifo[0][0] < best_fifo[0][0]):
+                        (best, best_fifo) = (size, fifo)
+                if best is None:
+                    break
+                head = best_fifo[0]
+                m = min(num_free, cores / best, head[2])
+                end = now + dispatch_overhead + head[1]
+                heapq.heappush(events, (end, k, best, m))
+                num_free -= m
+                cores -= best * m
+                head[0] += m
+                head[2] -= m
+                if head[2] == 0:
+                    best_fifo.popleft()
+                if end > last_end[k]:
+                    last_end[k] = end
+            free_slots[k] = num_free
+            free_cores[k] = cores
+
+    makespan = max(last_end)
+    instance_seconds = sum([t + idle_timeout for t in last_end])
+    busy_seconds = sum([runtime * count for (ncpus, runtime, count) in runs])
+    busy_core_seconds = sum([ncpus * runtime * count for (ncpus, runtime, count) in runs])
+    return {'num_jobs':sum([count for (ncpus, runtime, count) in runs]),
+            'makespan':makespan,
+            'instance_hours':instance_seconds / 3600.0,
+            'slot_utilization':busy_seconds / (num_jobs_per_instance * instance_seconds),
+            'core_utilization':busy_core_seconds / (num_cores * instance_seconds)}
+
+
+def self_similar(events, free_slots, free_cores, size, min_size):
+    """ True if every event is the end of jobs of size cores and no instance has room for a job of min_size cores.
+
+        Each job that ends is then replaced by a job of the same size, from the earliest
+        posted run, and the cores left over on each instance stay too few for anything else.
+    """
+    if len(events) == 0:
+        return False
+    for e in events:
+        if e[2] != size:
+            return False
+    for k in range(len(free_slots)):
+        if free_slots[k] > 0 and free_cores[k] >= min_size:
+            return False
+    return True
+
+
+def fast_forward(events, duration, max_rounds, last_end):
+    """ Skip up to max_rounds rounds of a run of identical jobs that fills every slot.
+
+        events is a heap of tuples that start with (time, instance), for the slots or jobs
+        that free up at time on the instance, each refilled with a job of the run. If they
+        all free up within duration of each other, each one is refilled exactly once per
+        round, in the same order, and moves on by duration. Returns a tuple (heap, number
+        of rounds skipped), the heap is unchanged if the schedule doesn't repeat yet.
+    """
+    times = [e[0] for e in events]
+    if duration <= 0 or max_rounds < 1 or max(times) - min(times) >= duration:
+        return (events, 0)
+    shift = max_rounds * duration
+    #a uniform shift keeps the heap order
+    events = [(e[0] + shift,) + e[1:] for e in events]
+    for e in events:
+        if e[0] > last_end[e[1]]:
+            last_end[e[1]] = e[0]
+    return (events, max_rounds)
+
+
+def simulate_key(planner_args, key):
+    """ Run the simulation for a cache key of Planner, in a worker process of Planner.sweep. """
+    (runs, kwargs) = planner_args
+    (num_instances, num_jobs_per_instance, num_cores, speed) = key
+    if speed != 1.0:
+        runs = [(ncpus, runtime / speed, count) for (ncpus, runtime, count) in runs]
+    return simulate_dispatch(runs, num_instances, num_jobs_per_instance, num_cores, **kwargs)
+
+
+def init_sweep_worker(runs, kwargs):
+    global sweep_args
+    sweep_args = (runs, kwargs)
+
+
+def sweep_worker(key):
+    return simulate_key(sweep_args, key)
+
+
+class Planner():
+    """ Predicts makespan, utilization and cost of a list of jobs for candidate launch configurations.
+
+        jobs is a list of (num_cpus, runtime) in post order, see Launcher.simulate for
+        where the runtimes come from. A configuration is a dictionary with
+        num_instances, num_jobs_per_instance and num_cores, and optionally instance_type,
+        speed (runtimes are divided by it) and hourly_price. Dependencies are not
+        modeled, every job is taken to be posted at time 0.
+
+        Results of configurations that simulate the same schedule (the same instances,
+        slots, cores and speed) are cached, so sweeping prices costs one simulation
+        per distinct shape, and sweep spreads the distinct shapes over num_procs
+        processes.
+    """
+
+    def __init__(self, jobs, startup_delay=120.0, startup_stagger=0.0, dispatch_overhead=0.0, idle_timeout=30.0):
+        self.runs = job_runs(jobs)
+        self.kwargs = {'startup_delay':startup_delay,
+                       'startup_stagger':startup_stagger,
+                       'dispatch_overhead':dispatch_overhead,
+                       'idle_timeout':idle_timeout}
+        self.cache = {}
+
+    def key(self, config):
+        return (int(config['num_instances']), int(config['num_jobs_per_instance']), int(config['num_cores']),
+                float(config.get('speed', 1.0)))
+
+    def run(self, config):
+        key = self.key(config)
+        if key not in self.cache:
+            self.cache[key] = simulate_key((self.runs, self.kwargs), key)
+        res = dict(config)
+        res.update(self.cache[key])
+        res['cost'] = None
+        if config.get('hourly_price') is not None:
+            res['cost'] = res['instance_hours'] * float(config['hourly_price'])
+        return res
+
+    def sweep(self, configs, num_procs=None):
+        """ Run every configuration, returns the list of results. num_procs defaults to the number of cores. """
+        if num_procs is None:
+            num_procs = multiprocessing.cpu_count()
+        keys = sorted(set([self.key(c) for c in configs]) - set(self.cache.keys()))
+        if num_procs > 1 and len(keys) > 1:
+            pool = multiprocessing.Pool(min(num_procs, len(keys)), initializer=init_sweep_worker,
+                                        initargs=(self.runs, self.kwargs))
+            try:
+                self.cache.update(zip(keys, pool.map(sweep_worker, keys)))
+            finally:
+                pool.terminate()
+        return [self.run(c) for c in configs]
+
+
+def print_plan(results):
+    """ Print simulation results as a table, fastest first. """
+    print '%-12s %9s %6s %6s %12s %10s %8s %8s %10s' % ('type', 'instances', 'slots', 'cores', 'makespan',
+                                                       'inst-hours', 'slot-use', 'core-use', 'cost')
+    for res in sorted(results, key=lambda r: r['makespan']):
+        cost_str = '-'
+        if res['cost'] is not None:
+            cost_str = '%0.2f' % res['cost']
+        print '%-12s %9d %6d %6d %11.0fs %10.1f %8.2f %8.2f %10s' % \
+              (res.get('instance_type') or '-', res['num_instances'], res['num_jobs_per_instance'], res['num_cores'],
+               res['makespan'], res['instance_hours'], res['slot_utilization'], res['core_utilization'], cost_str)
@@ -0,0 +1,247 @@
+import argparse
+import threading
+from Queue import Queue
+
+from ezcluster.core import *
+from ezcluster.launcher import Launcher
+
+
+def job_from_spec(spec):
+    """ A Job, or a JobArray if the spec has params or num_elements, from a job spec dictionary.
+
+        The keys are the arguments of Launcher.add_batch_job and add_batch_job_array:
+        cmds (or command), num_cpus, expected_runtime, log_file_template, inputs,
+        outputs and queue, plus params and num_elements for arrays. Dependencies
+        can't be streamed, they need the Python API.
+    """
+    if 'depends_on' in spec:
+        raise ConfigException('depends_on is not supported when streaming jobs')
+    cmds = spec.get('cmds', spec.get('command'))
+    if cmds is None:
+        raise ConfigException('Job spec has no cmds')
+    kwargs = {'num_cpus':int(spec.get('num_cpus', 1)),
+              'expected_runtime':spec.get('expected_runtime', -1),
+              'inputs':spec.get('inputs', {}),
+              'outputs':spec.get('outputs', [])}
+    if 'params' in spec or 'num_elements' in spec:
+        j = JobArray(cmds, spec.get('params', {}), num_elements=spec.get('num_elements'),
+                     log_file_template=spec.get('log_file_template'), **kwargs)
+    else:
+        j = Job(cmds, log_file_template=spec.get('log_file_template'), **kwargs)
+    j.queue = spec.get('queue')
+    return j
+
+
+class StreamSubmitter():
+    """ Posts a stream of job specs, one JSON object per line, in chunks of chunk_size jobs.
+
+        Lines are parsed by a reader thread, which stays at most max_pending_chunks
+        chunks ahead of the posting, so memory is bounded however long the stream is.
+        Each chunk goes through Launcher.submit_jobs. With skip_done, jobs whose content
+        key is in the completion index are skipped, as in post_jobs, looking up the keys
+        of each chunk one by one rather than reading the whole index.
+
+        After every chunk the checkpoint file is replaced with the batch id and the
+        number of lines whose jobs were posted, so an interrupted submit run again
+        with the same checkpoint skips those lines and keeps adding to the same batch.
+        A job's id is its batch id and line number, so the chunk that was being posted,
+        which is posted again on resume, has the same ids the second time and the
+        monitor counts each of its jobs once. Identical lines are different jobs and all
+        run. A chunk with messages that could not be posted stops the run, and the
+        checkpoint keeps those messages, which are the only ones of the chunk posted
+        again on resume, before the lines after it.
+    """
+
+    def __init__(self, launcher, checkpoint_file=None, chunk_size=1000, max_pending_chunks=2, skip_done=False,
+                 report_interval=10.0):
+        self.launcher = launcher
+        self.checkpoint_file = checkpoint_file
+        self.chunk_size = chunk_size
+        self.max_pending_chunks = max_pending_chunks
+        self.skip_done = skip_done
+        self.report_interval = report_interval
+        self.state = {'batch_id':None, 'num_lines':0, 'num_jobs':0, 'num_skipped':0, 'submit_time':0.0,
+                      'unsent':[]}
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            f = open(checkpoint_file, 'r')
+            self.state.update(json.load(f))
+            f.close()
+            print 'Resuming batch %s after line %d, %d jobs already posted' % \
+                  (self.state['batch_id'], self.state['num_lines'], self.state['num_jobs'])
+
+    def write_checkpoint(self):
+        if self.checkpoint_file is None:
+            return
+        tmp_file = '%s.tmp-%s' % (self.checkpoint_file, random_string(6))
+        f = open(tmp_file, 'w')
+        json.dump(self.state, f)
+        f.close()
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def read_chunks(self, lines, chunks):
+        """ Parse lines into chunks of (number of the last line, [(line number, job)]), then put None, or the
+            exception that stopped it.
+        """
+        try:
+            line_num = 0
+            jobs = []
+            for line in lines:
+                line_num += 1
+                if line_num <= self.state['num_lines']:
+                    continue
+                line = line.strip()
+                if len(line) > 0 and not line.startswith('#'):
+                    try:
+                        jobs.append((line_num, job_from_spec(json.loads(line))))
+                    except (ValueError, ConfigException), e:
+                        raise ConfigException('Bad job spec on line %d: %s' % (line_num, str(e)))
+                if len(jobs) >= self.chunk_size:
+                    chunks.put((line_num, jobs))
+                    jobs = []
+            if len(jobs) > 0 or line_num > self.state['num_lines']:
+                chunks.put((line_num, jobs))
+            chunks.put(None)
+        except Exception, e:
+            chunks.put(e)
+
+    def post_chunk(self, chunk, failed):
+        """ Post one chunk, returns a tuple (# jobs posted, # jobs already done, # messages that failed).
+
+            A (queue name, message body) pair is appended to failed for every message that failed.
+        """
+        launcher = self.launcher
+        jobs = []
+        for (line_num, j) in chunk:
+            j.batch_id = self.state['batch_id']
+            launcher.make_job_id(j)
+            j.id = '%s-%d' % (j.batch_id, line_num)
+            j.skip_done = self.skip_done
+            jobs.append(j)
+        #only the done ids of this chunk are kept
+        done = launcher.graph.done
+        done.clear()
+        if self.skip_done:
+            launcher.mark_done(jobs, max_lookups=None)
+        num_jobs = 0
+        num_skipped = 0
+        ready = []
+        for j in jobs:
+            ids = set(launcher.graph.job_ids(j))
+            num_skipped += len(ids & done)
+            if ids <= done:
+                continue
+            num_jobs += len(ids - done)
+            ready.append(j)
+        num_failed = launcher.submit_jobs(ready, verbose=False, failed=failed)
+        #don't keep the element ids of every array of the stream
+        for j in jobs:
+            launcher.graph.array_elements.pop(j.id, None)
+        return (num_jobs, num_skipped, num_failed)
+
+    def post_unsent(self):
+        """ Post the messages the last run could not, returns the number that failed again. """
+        bodies = {}
+        for (qname, body) in self.state['unsent']:
+            bodies.setdefault(qname, []).append(body)
+        unsent = []
+        for (qname, qbodies) in bodies.iteritems():
+            submitter = self.launcher.submitters[qname]
+            submitter.submit(qbodies, verbose=False)
+            unsent.extend([(qname, body) for body in submitter.failed_bodies])
+        print 'Posted %d messages left from the last run' % (len(self.state['unsent']) - len(unsent))
+        self.state['unsent'] = unsent
+        self.write_checkpoint()
+        return len(unsent)
+
+    def report(self, start_time, num_jobs):
+        elapsed = time.time() - start_time
+        print 'Line %d: %d jobs posted, %d already done, %0.1f jobs/sec sustained, %0.1f jobs/sec this run' % \
+              (self.state['num_lines'], self.state['num_jobs'], self.state['num_skipped'],
+               self.state['num_jobs'] / max(self.state['submit_time'], 1e-6), num_jobs / max(elapsed, 1e-6))
+
+    def submit(self, lines, batch_id=None):
+        """ Post the job specs in an iterable of lines, returns the batch id. """
+        if self.state['batch_id'] is None:
+            self.state['batch_id'] = batch_id or random_string(10)
+        elif batch_id is not None and batch_id != self.state['batch_id']:
+            raise ConfigException('The checkpoint is for batch %s, not %s' % (self.state['batch_id'], batch_id))
+        self.launcher.batch_id = self.state['batch_id']
+        print 'Submitting batch %s' % self.state['batch_id']
+
+        self.launcher.graph.done = set()
+        if len(self.state['unsent']) > 0:
+            num_failed = self.post_unsent()
+            if num_failed > 0:
+                raise ConfigException('Could not post %d messages left from the last run, stopping. '
+                                      'Run again to retry them' % num_failed)
+
+        chunks = Queue(maxsize=self.max_pending_chunks)
+        reader = threading.Thread(target=self.read_chunks, args=(lines, chunks))
+        reader.daemon = True
+        reader.start()
+
+        #submit_time adds up the time of every run, for the sustained rate
+        prev_submit_time = self.state['submit_time']
+        start_time = time.time()
+        last_report = start_time
+        num_jobs = 0
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            (line_num, jobs) = chunk
+            failed = []
+            (num_posted, num_skipped, num_failed) = self.post_chunk(jobs, failed)
+            num_jobs += num_posted
+            self.state['num_lines'] = line_num
+            self.state['num_jobs'] += num_posted
+            self.state['num_skipped'] += num_skipped
+            self.state['submit_time'] = prev_submit_time + time.time() - start_time
+            self.state['unsent'] = failed
+            self.write_checkpoint()
+            if num_failed > 0:
+                raise ConfigException('Could not post %d messages of the jobs up to line %d, stopping. '
+                                      'Run again to retry them and resume from line %d' % (num_failed, line_num,
+                                                                                          line_num + 1))
+            if time.time() - last_report >= self.report_interval:
+                self.report(start_time, num_jobs)
+                last_report = time.time()
+        self.report(start_time, num_jobs)
+        self.launcher.num_batch_jobs = self.state['num_jobs']
+        return self.state['batch_id']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Post jobs from a JSON lines file or stdin, one job spec per line '
+                                                 '(see job_from_spec), without holding them all in memory.')
+    parser.add_argument('input', nargs='?', default='-', help='file of job specs, - for stdin')
+    parser.add_argument('--checkpoint', help='progress file to resume from, defaults to <input>.checkpoint '
+                                             '(none for stdin)')
+    parser.add_argument('--batch-id', help='batch id, new by default')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='jobs posted at a time')
+    parser.add_argument('--max-pending-chunks', type=int, default=2, help='chunks parsed ahead of the posting')
+    parser.add_argument('--submit-threads', type=int, default=4, help='threads sending to each queue')
+    parser.add_argument('--max-retries', type=int, default=3, help='max_job_retries of the jobs')
+    parser.add_argument('--salt', default='', help='job_salt of the job ids')
+    parser.add_argument('--skip-done', action='store_true', help='skip jobs that already succeeded')
+    parser.add_argument('--report-interval', type=float, default=10.0, help='seconds between progress reports')
+    parser.add_argument('--wait', action='store_true', help='wait for the batch to finish')
+    args = parser.parse_args()
+
+    checkpoint_file = args.checkpoint
+    if checkpoint_file is None and args.input != '-':
+        checkpoint_file = args.input + '.checkpoint'
+    launcher = Launcher(None, None, num_submit_threads=args.submit_threads, max_job_retries=args.max_retries,
+                        job_salt=args.salt, skip_done=args.skip_done)
+    submitter = StreamSubmitter(launcher, checkpoint_file=checkpoint_file, chunk_size=args.chunk_size,
+                                max_pending_chunks=args.max_pending_chunks, skip_done=args.skip_done,
+                                report_interval=args.report_interval)
+    if args.input == '-':
+        lines = sys.stdin
+    else:
+        lines = open(args.input, 'r')
+    batch_id = submitter.submit(lines, batch_id=args.batch_id)
+    if args.wait:
+        launcher.wait_for_batch()
@@ -0,0 +1,118 @@
+import threading
+from Queue import Queue
+
+from ezcluster.core import *
+from ezcluster.backend import get_backend
+
+#SQS limits for a single SendMessageBatch request
+MAX_BATCH_MESSAGES = 10
+MAX_BATCH_BYTES = 262144
+
+
+class BatchSubmitter():
+    """ Posts message bodies to a job queue using batch sends.
+
+        Bodies are packed into batches of at most MAX_BATCH_MESSAGES messages and
+        MAX_BATCH_BYTES bytes, and the batches are sent by a small pool of threads,
+        each holding its own queue connection from the backend. When only some
+        entries of a batch fail, just those entries are sent again, up to
+        max_retries times. The bodies that still could not be sent are kept in
+        failed_bodies after submit.
+    """
+
+    def __init__(self, queue_name, num_threads=4, max_retries=5, retry_sleep=1.0, backend=None):
+        self.queue_name = queue_name
+        self.backend = backend
+        if self.backend is None:
+            self.backend = get_backend()
+        self.num_threads = num_threads
+        self.max_retries = max_retries
+        self.retry_sleep = retry_sleep
+        self.lock = threading.Lock()
+        self.failed_bodies = []
+
+    def connect_queue(self):
+        return self.backend.connect_queue(self.queue_name)
+
+    def make_batches(self, queue, bodies):
+        """ Encode bodies and pack them into batches of (body, encoded body) that respect the SQS limits. """
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for body in bodies:
+            enc_body = queue.new_message(body=body).get_body_encoded()
+            nbytes = len(enc_body)
+            if nbytes > MAX_BATCH_BYTES:
+                raise ConfigException('Message of %d bytes is too large for SQS' % nbytes)
+            if len(batch) == MAX_BATCH_MESSAGES or batch_bytes + nbytes > MAX_BATCH_BYTES:
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append((body, enc_body))
+            batch_bytes += nbytes
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def send_batch(self, queue, batch):
+        """ Send a single batch, retrying the failed entries. Returns the bodies that could not be sent. """
+        pending = dict([(str(k), entry) for k,entry in enumerate(batch)])
+        num_tries = 0
+        while len(pending) > 0 and num_tries <= self.max_retries:
+            if num_tries > 0:
+                time.sleep(self.retry_sleep*num_tries)
+            num_tries += 1
+            entries = [(entry_id, enc_body, 0) for entry_id,(body, enc_body) in pending.iteritems()]
+            try:
+                res = queue.write_batch(entries)
+            except Exception, e:
+                print 'Batch send to %s failed, retrying: %s' % (self.queue_name, str(e))
+                continue
+            for r in res.results:
+                del pending[r['id']]
+        return [body for (body, enc_body) in pending.values()]
+
+    def submit(self, bodies, verbose=True):
+        """ Send an iterable of message bodies to the queue. Returns the number of messages that failed to send.
+
+            Failures are always printed, the send rate only if verbose is True.
+        """
+
+        start_time = time.time()
+        batches = self.make_batches(self.connect_queue(), bodies)
+        num_msgs = sum([len(b) for b in batches])
+        self.failed_bodies = []
+        if num_msgs == 0:
+            return 0
+
+        work = Queue()
+        for b in batches:
+            work.put(b)
+
+        def worker():
+            queue = self.connect_queue()
+            while True:
+                b = work.get()
+                if b is None:
+                    break
+                failed = self.send_batch(queue, b)
+                if len(failed) > 0:
+                    with self.lock:
+                        self.failed_bodies.extend(failed)
+
+        num_threads = min(self.num_threads, len(batches))
+        threads = [threading.Thread(target=worker) for k in range(num_threads)]
+        for t in threads:
+            work.put(None)
+            t.start()
+        for t in threads:
+            t.join()
+
+        num_failed = len(self.failed_bodies)
+        elapsed = time.time() - start_time
+        if verbose:
+            print 'Posted %d messages in %d batches to %s in %0.2fs (%0.1f jobs/sec)' % \
+                  (num_msgs - num_failed, len(batches), self.queue_name, elapsed, num_msgs / max(elapsed, 1e-6))
+        if num_failed > 0:
+            print 'Failed to post %d messages to %s' % (num_failed, self.queue_name)
+        return num_failed
@@ -9,20 +9,46 @@ export EC2_DNS_NAME=#DNS_NAME#
 export AWS_ACCESS_KEY_ID=#ACCESS_KEY#
 export AWS_SECRET_ACCESS_KEY=#SECRET_KEY#
 export NUM_JOBS_PER_INSTANCE=#NUM_JOBS_PER_INSTANCE#
+export NUM_CORES=#NUM_CORES#
+export INPUT_CACHE_SIZE=#INPUT_CACHE_SIZE#
+export PIN_CPUS=#PIN_CPUS#
+export MEMORY_PER_CORE=#MEMORY_PER_CORE#
 
 export PYTHONPATH=$PYTHONPATH:/tmp/ezcluster/src/python
 
-mkdir /home/ubuntu/.matplotlib
-mkdir /home/ubuntu/.matplotlib/tex.cache
+mkdir -p /home/ubuntu/.matplotlib/tex.cache
 chmod -R 777 /home/ubuntu/.matplotlib
 
 
-echo "Copying ezcluster from S3"
-#copy ezcluster from S3
+#copy ezcluster from S3, code bundles are keyed by content hash and cached locally
+export CODE_HASH=#CODE_HASH#
+BUNDLE_CACHE=$HOME/.ezcluster/bundles
 cd /tmp
-s3cmd get s3://#BUCKET#/ezcluster.tgz
-tar xvzf ezcluster.tgz
-rm ezcluster.tgz
+if [ "$CODE_HASH" == "None" ]
+then
+    echo "Copying ezcluster from S3"
+    s3cmd get s3://#BUCKET#/ezcluster.tgz
+    tar xzf ezcluster.tgz
+    rm ezcluster.tgz
+elif [ -f /tmp/ezcluster/.bundle-hash ] && [ "`cat /tmp/ezcluster/.bundle-hash`" == "$CODE_HASH" ]
+then
+    echo "ezcluster bundle $CODE_HASH is already unpacked"
+else
+    mkdir -p $BUNDLE_CACHE
+    if [ ! -f $BUNDLE_CACHE/$CODE_HASH.tgz ]
+    then
+        echo "Copying ezcluster bundle $CODE_HASH from S3"
+        s3cmd get --force s3://#BUCKET#/bundles/ezcluster-$CODE_HASH.tgz $BUNDLE_CACHE/$CODE_HASH.tgz.part
+        mv $BUNDLE_CACHE/$CODE_HASH.tgz.part $BUNDLE_CACHE/$CODE_HASH.tgz
+    else
+        echo "Using cached ezcluster bundle $CODE_HASH"
+    fi
+    rm -rf /tmp/ezcluster
+    tar xzf $BUNDLE_CACHE/$CODE_HASH.tgz
+    echo $CODE_HASH > /tmp/ezcluster/.bundle-hash
+    #only keep the 5 most recent bundles
+    ls -t $BUNDLE_CACHE/*.tgz | tail -n +6 | xargs -r rm -f
+fi
 
 echo "Sourcing application script..."
 if [ -f /tmp/application-script.sh ]
@@ -32,7 +58,15 @@ fi
 
 echo "PYTHONPATH=$PYTHONPATH"
 
+#an instance resumed from the warm pool may still run the daemon that parked it
+PID_FILE=/tmp/ezcluster-daemon.pid
+if [ -f $PID_FILE ] && kill `cat $PID_FILE` 2> /dev/null
+then
+    echo "Stopped parked daemon `cat $PID_FILE`"
+fi
+
 #run ezcluster Daemon
 echo "Starting daemon..."
 python /tmp/ezcluster/src/python/ezcluster/daemon.py #QUIT_WHEN_EMPTY# &
+echo $! > $PID_FILE
 echo "Daemon started... all done!"
\ No newline at end of file